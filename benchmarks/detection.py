@@ -0,0 +1,201 @@
+"""
+Mask R-CNN
+Throughput and latency benchmark of MaskRCNN.detect().
+
+Builds the model in inference mode with random weights (nothing to
+download) and runs detect() on synthetic images over a grid of settings.
+Each setting runs in a fresh process so that the peak RSS is its own.
+
+Usage:
+
+    # Default grid, results saved to detection.json
+    python3 benchmarks/detection.py --output=detection.json
+
+    # Custom grid
+    python3 benchmarks/detection.py --batch-sizes=1,2 --image-sizes=2710x3384 \\
+        --resize-modes=square,aspect --backbones=resnet50 --post-nms=500,1000
+
+    # Compare with a stored baseline. Exits with status 1 on regressions.
+    python3 benchmarks/detection.py --compare=baseline.json --tolerance=0.1
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+
+
+def case_name(case):
+    """Unique name of a benchmark setting. Used to match baseline results."""
+    return "bs{batch_size}_{image_size}_{resize_mode}_{backbone}_nms{post_nms}".format(**case)
+
+
+def make_config(case):
+    """Returns the inference config of a benchmark setting."""
+    from mrcnn.config import Config
+
+    class BenchmarkConfig(Config):
+        NAME = "benchmark"
+        # COCO sized heads
+        NUM_CLASSES = 1 + 80
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = case["batch_size"]
+        BACKBONE = case["backbone"]
+        IMAGE_RESIZE_MODE = case["resize_mode"]
+        # pad64 needs a multiple of 64. 0 means no upscaling.
+        IMAGE_MIN_DIM = 0 if case["resize_mode"] == "pad64" else Config.IMAGE_MIN_DIM
+        POST_NMS_ROIS_INFERENCE = case["post_nms"]
+        # Random weights give low scores. Keep all detections so that the
+        # post-processing does as much work as with a trained model.
+        DETECTION_MIN_CONFIDENCE = 0
+
+    return BenchmarkConfig()
+
+
+def run_case(case):
+    """Builds the model of one setting and times detect(). Runs in its own
+    process. Returns a dict of results.
+    """
+    from mrcnn import model as modellib
+    from mrcnn import profiling
+
+    config = make_config(case)
+    model = modellib.MaskRCNN(mode="inference", config=config,
+                              model_dir=tempfile.gettempdir())
+    height, width = case["image_height"], case["image_width"]
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+              for _ in range(config.BATCH_SIZE)]
+
+    # Warm up. The first runs include graph setup and autotuning.
+    for _ in range(case["warmup"]):
+        model.detect(images)
+    if case["profile"]:
+        model.profiler = profiling.Profiler()
+    times = []
+    for _ in range(case["repeat"]):
+        start = time.perf_counter()
+        model.detect(images)
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    result = dict(case)
+    result.update({
+        "name": case_name(case),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "images_per_second": float(config.BATCH_SIZE * 1000 / times.mean()),
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    if model.profiler is not None:
+        result["stages"] = model.profiler.summary()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each setting against the baseline. Returns the
+    names of the settings that are slower by more than tolerance.
+    """
+    baseline = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    print("\n{:48} {:>12} {:>12} {:>8}".format("", "base p50", "p50", "change"))
+    for r in results:
+        b = baseline.get(r["name"])
+        if b is None:
+            print("{:48} {:>12} {:12.2f} {:>8}".format(r["name"], "-", r["p50_ms"], "new"))
+            continue
+        change = r["p50_ms"] / b["p50_ms"] - 1
+        slower = change > tolerance or \
+            r["images_per_second"] < b["images_per_second"] / (1 + tolerance)
+        if slower:
+            regressions.append(r["name"])
+        print("{:48} {:12.2f} {:12.2f} {:+7.1%}{}".format(
+            r["name"], b["p50_ms"], r["p50_ms"], change, "  REGRESSION" if slower else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark MaskRCNN.detect() on synthetic images.')
+    parser.add_argument('--batch-sizes', default="1,2",
+                        help='Comma separated batch sizes (default=1,2)')
+    parser.add_argument('--image-sizes', default="1024x1024,2710x3384",
+                        help='Comma separated HEIGHTxWIDTH of the input images '
+                             '(default=1024x1024,2710x3384)')
+    parser.add_argument('--resize-modes', default="square,pad64,aspect",
+                        help='Comma separated IMAGE_RESIZE_MODEs (default=square,pad64,aspect)')
+    parser.add_argument('--backbones', default="resnet50,resnet101",
+                        help='Comma separated backbones (default=resnet50,resnet101)')
+    parser.add_argument('--post-nms', default="1000",
+                        help='Comma separated POST_NMS_ROIS_INFERENCE values (default=1000)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Timed runs per setting (default=20)')
+    parser.add_argument('--warmup', type=int, default=3,
+                        help='Untimed runs per setting (default=3)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Also record per-stage timings (mrcnn.profiling)')
+    parser.add_argument('--output', default=None,
+                        help='Save the results to this JSON file')
+    parser.add_argument('--compare', default=None, metavar="BASELINE",
+                        help='Compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed slowdown vs the baseline (default=0.1)')
+    args = parser.parse_args()
+
+    cases = []
+    for batch_size, image_size, resize_mode, backbone, post_nms in itertools.product(
+            args.batch_sizes.split(","), args.image_sizes.split(","),
+            args.resize_modes.split(","), args.backbones.split(","),
+            args.post_nms.split(",")):
+        height, width = [int(v) for v in image_size.split("x")]
+        cases.append({
+            "batch_size": int(batch_size), "image_size": image_size,
+            "image_height": height, "image_width": width,
+            "resize_mode": resize_mode, "backbone": backbone,
+            "post_nms": int(post_nms), "repeat": args.repeat,
+            "warmup": args.warmup, "profile": args.profile,
+        })
+
+    # One fresh process per setting: separate TF graphs and peak RSS
+    pool = multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1)
+    results = []
+    print("{:48} {:>10} {:>10} {:>10} {:>10}".format(
+        "", "p50 (ms)", "p95 (ms)", "img/s", "RSS (MB)"))
+    for case in cases:
+        r = pool.apply(run_case, (case,))
+        results.append(r)
+        print("{:48} {:10.2f} {:10.2f} {:10.2f} {:10.0f}".format(
+            r["name"], r["p50_ms"], r["p95_ms"], r["images_per_second"],
+            r["peak_rss_mb"]))
+    pool.close()
+    pool.join()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n{} regression(s) over {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Mask R-CNN
+Benchmark of the backbone feature cache (mrcnn/feature_cache.py) against
+recomputing the features, as train(layers="heads") does without it.
+
+The cache replaces the image loading and the ResNet backbone with reads
+of the stored C2-C5 maps: about 60 MB per 1024x1024 image in float16, C2
+being half of it. That only pays off if the disk delivers it faster than
+the backbone runs, so measure on the disk and GPU of the training
+machine before setting FEATURE_CACHE_DIR. Per image, it times:
+
+- cache, cold: FeatureCache.load_features() of a cache of random
+  features, with the files evicted from the page cache first, so the reads
+  come from disk. This is the case of caches larger than the RAM.
+- cache, warm: the same reads from the page cache.
+- recompute: reading and decoding JPEG images, resizing and molding them,
+  and running the backbone with random weights. The images are evicted
+  from the page cache too.
+
+Usage:
+
+    # Cache and images in a directory on the training disk
+    python3 benchmarks/feature_cache.py --dir=/data/scratch --images=64
+
+    # Cache reads only, without building the backbone
+    python3 benchmarks/feature_cache.py --skip-backbone
+"""
+
+import os
+import sys
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+
+from weight_loading import evict
+
+
+def make_config(batch_size, backbone):
+    """Training config of a benchmark setting."""
+    from mrcnn.config import Config
+
+    class BenchmarkConfig(Config):
+        NAME = "benchmark"
+        NUM_CLASSES = 1 + 80
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = batch_size
+        BACKBONE = backbone
+
+    return BenchmarkConfig()
+
+
+def level_shapes(config):
+    """[(height, width, channels)] of C2 to C5, as the model computes them."""
+    return [(int(math.ceil(config.IMAGE_SHAPE[0] / stride)),
+             int(math.ceil(config.IMAGE_SHAPE[1] / stride)), channels)
+            for stride, channels in zip(config.BACKBONE_STRIDES[:4],
+                                        [256, 512, 1024, 2048])]
+
+
+def write_images(directory, count, size, rng):
+    """Writes smooth random JPEG images, which compress and decode like
+    photos rather than like noise. Returns their paths.
+    """
+    import skimage.io
+    from mrcnn import utils
+
+    paths = []
+    for i in range(count):
+        small = rng.randint(0, 256, (size // 32, size // 32, 3)).astype(np.uint8)
+        image = utils.resize(small, (size, size), order=1, preserve_range=True)
+        path = os.path.join(directory, "image_{}.jpg".format(i))
+        skimage.io.imsave(path, image.astype(np.uint8))
+        paths.append(path)
+    return paths
+
+
+def build_cache(path, config, count, rng):
+    """Writes a FeatureCache of random features and minimal ground truth."""
+    from mrcnn.feature_cache import FeatureCache
+
+    shapes = level_shapes(config)
+    mask_shape = config.MINI_MASK_SHAPE
+
+    def batches():
+        for start in range(0, count, config.BATCH_SIZE):
+            size = min(config.BATCH_SIZE, count - start)
+            features = [rng.rand(size, *shape).astype(np.float16) for shape in shapes]
+            gts = [(np.zeros(config.IMAGE_META_SIZE, np.float32),
+                    np.array([1], np.int32), np.array([[0, 0, 10, 10]], np.int32),
+                    np.ones(tuple(mask_shape) + (1,), bool))] * size
+            yield features, gts
+
+    FeatureCache.build(path, list(range(count)), shapes, mask_shape, batches())
+    return FeatureCache(path)
+
+
+def time_cache(path, count, batch_size, cold):
+    """Returns the seconds per image of reading all the features."""
+    from mrcnn.feature_cache import FeatureCache
+
+    cache = FeatureCache(path)
+    if cold:
+        for i in range(len(cache.level_shapes)):
+            evict(os.path.join(path, "c{}.npy".format(i + 2)))
+    start = time.perf_counter()
+    for i in range(0, count, batch_size):
+        cache.load_features(range(i, min(i + batch_size, count)))
+    return (time.perf_counter() - start) / count
+
+
+def time_recompute(paths, config):
+    """Returns the seconds per image of loading the images and running the
+    backbone on them.
+    """
+    import keras.layers as KL
+    import keras.models as KM
+    from mrcnn import utils
+    from mrcnn import model as modellib
+
+    input_image = KL.Input(shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+    outputs = modellib.resnet_graph(input_image, config.BACKBONE,
+                                    stage5=True, train_bn=False)[1:]
+    backbone = KM.Model(input_image, outputs, name="backbone")
+
+    dataset = utils.Dataset()
+    dataset.add_class("benchmark", 1, "object")
+    for i, path in enumerate(paths):
+        dataset.add_image("benchmark", image_id=i, path=path)
+    dataset.prepare()
+
+    def run(image_ids):
+        images = []
+        for image_id in image_ids:
+            image = dataset.load_image(image_id)
+            image = utils.resize_image(
+                image, min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+                min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)[0]
+            images.append(modellib.mold_image(image, config))
+        backbone.predict(np.stack(images))
+
+    # Warm up: graph setup and cuDNN autotuning
+    run(dataset.image_ids[:config.BATCH_SIZE])
+    for path in paths:
+        evict(path)
+    start = time.perf_counter()
+    for i in range(0, len(paths), config.BATCH_SIZE):
+        run(dataset.image_ids[i:i + config.BATCH_SIZE])
+    return (time.perf_counter() - start) / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the backbone feature cache against recomputing.')
+    parser.add_argument('--dir', default=None,
+                        help='Directory of the cache and the images, on the disk '
+                             'to measure. By default, a temporary directory.')
+    parser.add_argument('--images', type=int, default=32,
+                        help='Number of images (default=32)')
+    parser.add_argument('--batch-size', type=int, default=2,
+                        help='Images per batch (default=2)')
+    parser.add_argument('--backbone', default="resnet101",
+                        help='resnet50 or resnet101 (default=resnet101)')
+    parser.add_argument('--skip-backbone', action='store_true',
+                        help="Time the cache reads only")
+    args = parser.parse_args()
+
+    config = make_config(args.batch_size, args.backbone)
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    rng = np.random.RandomState(0)
+    try:
+        cache_path = os.path.join(work_dir, "features")
+        cache = build_cache(cache_path, config, args.images, rng)
+        image_mb = sum(int(np.prod(s)) for s in cache.level_shapes) * 2 / 2 ** 20
+        print("Cache of {} images, {:.1f} MB per image".format(args.images, image_mb))
+        if not evict(os.path.join(cache_path, "c2.npy")):
+            print("posix_fadvise isn't available. Reads may come from the page cache.")
+
+        results = [("cache, cold", time_cache(cache_path, args.images, args.batch_size, True)),
+                   ("cache, warm", time_cache(cache_path, args.images, args.batch_size, False))]
+        if not args.skip_backbone:
+            paths = write_images(work_dir, args.images, config.IMAGE_MAX_DIM, rng)
+            results.append(("recompute", time_recompute(paths, config)))
+
+        print("{:14} {:>10} {:>10}".format("", "ms/image", "MB/s"))
+        for name, seconds in results:
+            print("{:14} {:10.1f} {:>10}".format(
+                name, seconds * 1000,
+                "{:.0f}".format(image_mb / seconds) if name.startswith("cache") else "-"))
+        if not args.skip_backbone:
+            print("Cold cache speedup over recomputing: {:.2f}x".format(
+                results[2][1] / results[0][1]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
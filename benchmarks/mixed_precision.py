@@ -0,0 +1,149 @@
+"""
+Mask R-CNN
+Training step time and memory of mixed precision vs float32.
+
+Trains on the synthetic shapes dataset (samples/shapes) with random
+weights, once per precision, each in a fresh process. Reports the median
+and 95th percentile time of a training step, the peak GPU memory (if
+there's a GPU) and the peak RSS, and the loss after the timed steps as a
+sanity check.
+
+Usage:
+
+    # float32 vs float16 (GPU)
+    python3 benchmarks/mixed_precision.py
+
+    # float32 vs bfloat16 (CPU with oneDNN), bigger images
+    python3 benchmarks/mixed_precision.py --precisions=float32,bfloat16 \\
+        --image-size=256 --output=mixed_precision.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+sys.path.append(os.path.join(ROOT_DIR, "samples/shapes"))
+
+
+def run_case(case):
+    """Trains for a few steps in one precision. Runs in its own process.
+    Returns a dict of results.
+    """
+    import tensorflow as tf
+    from mrcnn import model as modellib
+    from shapes import ShapesConfig, ShapesDataset
+
+    class BenchmarkConfig(ShapesConfig):
+        IMAGES_PER_GPU = case["batch_size"]
+        IMAGE_MIN_DIM = case["image_size"]
+        IMAGE_MAX_DIM = case["image_size"]
+        MIXED_PRECISION = None if case["precision"] == "float32" else case["precision"]
+
+    config = BenchmarkConfig()
+    dataset = ShapesDataset()
+    dataset.load_shapes(config.BATCH_SIZE * 4, config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1])
+    dataset.prepare()
+
+    model = modellib.MaskRCNN(mode="training", config=config,
+                              model_dir=tempfile.gettempdir())
+    model.set_trainable(".*", verbose=0)
+    model.compile(config.LEARNING_RATE, config.LEARNING_MOMENTUM)
+    sequence = modellib.TrainingSequence(dataset, config, shuffle=False,
+                                         batch_size=config.BATCH_SIZE)
+    batches = [sequence[i] for i in range(len(sequence))]
+
+    peak_gpu = None
+    if tf.test.is_gpu_available():
+        from tensorflow.contrib.memory_stats import MaxBytesInUse
+        peak_gpu = MaxBytesInUse()
+
+    # Warm up. The first steps include graph optimization and autotuning.
+    for i in range(case["warmup"]):
+        model.keras_model.train_on_batch(*batches[i % len(batches)])
+    times = []
+    losses = []
+    for i in range(case["repeat"]):
+        start = time.perf_counter()
+        outputs = model.keras_model.train_on_batch(*batches[i % len(batches)])
+        times.append(time.perf_counter() - start)
+        losses.append(float(np.atleast_1d(outputs)[0]))
+
+    times = np.array(times) * 1000
+    result = dict(case)
+    result.update({
+        "name": "{precision}_bs{batch_size}_{image_size}".format(**case),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "images_per_second": float(config.BATCH_SIZE * 1000 / times.mean()),
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_gpu_mb": None,
+        "final_loss": losses[-1],
+    })
+    if peak_gpu is not None:
+        import keras.backend as K
+        result["peak_gpu_mb"] = K.get_session().run(peak_gpu) / 2 ** 20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare mixed precision and float32 training steps.')
+    parser.add_argument('--precisions', default="float32,float16",
+                        help='Comma separated precisions: float32, float16, '
+                             'bfloat16 (default=float32,float16)')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='Images per step (default=8)')
+    parser.add_argument('--image-size', type=int, default=128,
+                        help='Side of the shapes images, multiple of 64 (default=128)')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='Timed steps per precision (default=50)')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='Untimed steps per precision (default=5)')
+    parser.add_argument('--output', default=None,
+                        help='Save the results to this JSON file')
+    args = parser.parse_args()
+
+    # One fresh process per precision: separate sessions and peak memory
+    pool = multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1)
+    results = []
+    print("{:28} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "", "p50 (ms)", "p95 (ms)", "img/s", "GPU (MB)", "RSS (MB)", "loss"))
+    for precision in args.precisions.split(","):
+        case = {"precision": precision, "batch_size": args.batch_size,
+                "image_size": args.image_size, "repeat": args.repeat,
+                "warmup": args.warmup}
+        r = pool.apply(run_case, (case,))
+        results.append(r)
+        gpu = "-" if r["peak_gpu_mb"] is None else "{:.0f}".format(r["peak_gpu_mb"])
+        print("{:28} {:10.2f} {:10.2f} {:10.2f} {:>10} {:10.0f} {:10.3f}".format(
+            r["name"], r["p50_ms"], r["p95_ms"], r["images_per_second"], gpu,
+            r["peak_rss_mb"], r["final_loss"]))
+    pool.close()
+    pool.join()
+
+    # Speedup of each precision over the first one
+    base = results[0]
+    for r in results[1:]:
+        print("{} vs {}: {:.2f}x step time".format(
+            r["precision"], base["precision"], base["p50_ms"] / r["p50_ms"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Mask R-CNN
+Microbenchmark of the in-graph IoU matrix (overlaps_graph).
+
+Compares the current implementation, which broadcasts [N, 1] box
+coordinates against [1, M] ones, against the previous one that tiled
+boxes1 and boxes2 into [N * M, 4] tensors and reshaped the result.
+Reports the run time and the memory the op allocates, from the step
+stats of a traced run.
+
+Usage:
+
+    # 2000 proposals against 100 GT boxes, as in detection_targets_graph()
+    python3 benchmarks/overlaps_graph.py
+
+    # Other sizes
+    python3 benchmarks/overlaps_graph.py --boxes1=6000 --boxes2=200
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+from mrcnn import model as modellib
+
+
+def legacy_overlaps_graph(boxes1, boxes2):
+    """The previous overlaps_graph(). Kept here as the baseline."""
+    b1 = tf.reshape(tf.tile(tf.expand_dims(boxes1, 1),
+                            [1, 1, tf.shape(boxes2)[0]]), [-1, 4])
+    b2 = tf.tile(boxes2, [tf.shape(boxes1)[0], 1])
+    b1_y1, b1_x1, b1_y2, b1_x2 = tf.split(b1, 4, axis=1)
+    b2_y1, b2_x1, b2_y2, b2_x2 = tf.split(b2, 4, axis=1)
+    y1 = tf.maximum(b1_y1, b2_y1)
+    x1 = tf.maximum(b1_x1, b2_x1)
+    y2 = tf.minimum(b1_y2, b2_y2)
+    x2 = tf.minimum(b1_x2, b2_x2)
+    intersection = tf.maximum(x2 - x1, 0) * tf.maximum(y2 - y1, 0)
+    b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
+    b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
+    union = b1_area + b2_area - intersection
+    iou = intersection / union
+    return tf.reshape(iou, [tf.shape(boxes1)[0], tf.shape(boxes2)[0]])
+
+
+def random_boxes(count, min_size=0.01, max_size=0.6):
+    """Random boxes in normalized coordinates [count, (y1, x1, y2, x2)]."""
+    size = np.random.uniform(min_size, max_size, (count, 2))
+    corner = np.random.uniform(0, 1, (count, 2)) * (1 - size)
+    return np.concatenate([corner, corner + size], axis=1).astype(np.float32)
+
+
+def time_op(sess, op, feed, repeat):
+    """Returns the run times of an op in milliseconds. Warms up first."""
+    for _ in range(3):
+        sess.run(op, feed)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sess.run(op, feed)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def allocated_bytes(sess, op, feed):
+    """Returns (total, largest) bytes of the tensors allocated by one run
+    of an op, from the step stats of a traced run.
+    """
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    metadata = tf.RunMetadata()
+    sess.run(op, feed, options=options, run_metadata=metadata)
+    sizes = [output.tensor_description.allocation_description.requested_bytes
+             for device in metadata.step_stats.dev_stats
+             for node in device.node_stats
+             for output in node.output]
+    return sum(sizes), max(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark overlaps_graph against the previous implementation.')
+    parser.add_argument('--boxes1', type=int, default=2000,
+                        help='Boxes in the first set, e.g. proposals (default=2000)')
+    parser.add_argument('--boxes2', type=int, default=100,
+                        help='Boxes in the second set, e.g. GT boxes (default=100)')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='Timed runs per implementation (default=100)')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    boxes1 = random_boxes(args.boxes1)
+    boxes2 = random_boxes(args.boxes2)
+
+    input1 = tf.placeholder(tf.float32, [None, 4])
+    input2 = tf.placeholder(tf.float32, [None, 4])
+    legacy = legacy_overlaps_graph(input1, input2)
+    current = modellib.overlaps_graph(input1, input2)
+    feed = {input1: boxes1, input2: boxes2}
+
+    with tf.Session() as sess:
+        a, b = sess.run([legacy, current], feed)
+        max_diff = np.abs(a - b).max()
+
+        print("Boxes: {} x {}".format(args.boxes1, args.boxes2))
+        print("Max difference vs legacy: {:.3g}".format(max_diff))
+        print("{:20} {:>10} {:>10} {:>14} {:>14}".format(
+            "", "p50 (ms)", "p95 (ms)", "allocated (MB)", "largest (MB)"))
+        for name, op in [("legacy (tile)", legacy), ("broadcast", current)]:
+            times = time_op(sess, op, feed, args.repeat)
+            total, largest = allocated_bytes(sess, op, feed)
+            print("{:20} {:10.2f} {:10.2f} {:14.2f} {:14.2f}".format(
+                name, np.percentile(times, 50), np.percentile(times, 95),
+                total / 2 ** 20, largest / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
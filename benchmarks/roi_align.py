@@ -0,0 +1,158 @@
+"""
+Mask R-CNN
+Microbenchmark of the multi-level ROIAlign layer (PyramidROIAlign).
+
+Compares the current implementation, which partitions the boxes by level
+and stitches the results back in order, against the previous one that
+looped over the levels with tf.where() and restored the order by sorting.
+
+Usage:
+
+    # 1000 ROIs on a 1024x1024 image, batch of 1
+    python3 benchmarks/roi_align.py
+
+    # Try other sizes and 4 samples per bin
+    python3 benchmarks/roi_align.py --rois=2000 --batch=2 --sampling-ratio=2
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+from mrcnn import model as modellib
+
+
+def legacy_pyramid_roi_align(boxes, image_meta, feature_maps, pool_shape):
+    """The previous PyramidROIAlign.call(). Kept here as the baseline."""
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
+    h = y2 - y1
+    w = x2 - x1
+    image_shape = modellib.parse_image_meta_graph(image_meta)['image_shape'][0]
+    image_area = tf.cast(image_shape[0] * image_shape[1], tf.float32)
+    roi_level = modellib.log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
+    roi_level = tf.minimum(5, tf.maximum(
+        2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
+    roi_level = tf.squeeze(roi_level, 2)
+
+    pooled = []
+    box_to_level = []
+    for i, level in enumerate(range(2, 6)):
+        ix = tf.where(tf.equal(roi_level, level))
+        level_boxes = tf.gather_nd(boxes, ix)
+        box_indices = tf.cast(ix[:, 0], tf.int32)
+        box_to_level.append(ix)
+        level_boxes = tf.stop_gradient(level_boxes)
+        box_indices = tf.stop_gradient(box_indices)
+        pooled.append(tf.image.crop_and_resize(
+            feature_maps[i], level_boxes, box_indices, pool_shape,
+            method="bilinear"))
+
+    pooled = tf.concat(pooled, axis=0)
+    box_to_level = tf.concat(box_to_level, axis=0)
+    box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
+    box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
+                             axis=1)
+    sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
+    ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
+        box_to_level)[0]).indices[::-1]
+    ix = tf.gather(box_to_level[:, 2], ix)
+    pooled = tf.gather(pooled, ix)
+    shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
+    return tf.reshape(pooled, shape)
+
+
+def random_boxes(batch, count, min_size=0.01, max_size=0.6):
+    """Random boxes in normalized coordinates [batch, count, (y1, x1, y2, x2)]."""
+    size = np.random.uniform(min_size, max_size, (batch, count, 2))
+    corner = np.random.uniform(0, 1, (batch, count, 2)) * (1 - size)
+    return np.concatenate([corner, corner + size], axis=2).astype(np.float32)
+
+
+def time_op(sess, op, feed, repeat):
+    """Returns the run times of an op in milliseconds. Warms up first."""
+    for _ in range(3):
+        sess.run(op, feed)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sess.run(op, feed)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark PyramidROIAlign against the previous implementation.')
+    parser.add_argument('--rois', type=int, default=1000,
+                        help='ROIs per image (default=1000)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Images per batch (default=1)')
+    parser.add_argument('--image-size', type=int, default=1024,
+                        help='Side of the square input image (default=1024)')
+    parser.add_argument('--channels', type=int, default=256,
+                        help='Feature map depth (default=256)')
+    parser.add_argument('--pool-size', type=int, default=7,
+                        help='Pooled output size (default=7)')
+    parser.add_argument('--sampling-ratio', type=int, default=1,
+                        help='Samples per bin and axis for the new layer (default=1)')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='Timed runs per implementation (default=50)')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    size = args.image_size
+    boxes = random_boxes(args.batch, args.rois)
+    image_meta = np.stack([modellib.compose_image_meta(
+        0, (size, size, 3), (size, size, 3), (0, 0, size, size), 1,
+        np.zeros([2], dtype=np.int32)) for _ in range(args.batch)]).astype(np.float32)
+    feature_maps = [np.random.randn(args.batch, size // stride, size // stride,
+                                    args.channels).astype(np.float32)
+                    for stride in [4, 8, 16, 32]]
+
+    input_boxes = tf.placeholder(tf.float32, [None, None, 4])
+    input_meta = tf.placeholder(tf.float32, [None, image_meta.shape[1]])
+    inputs_maps = [tf.placeholder(tf.float32, [None, None, None, args.channels])
+                   for _ in feature_maps]
+    pool_shape = (args.pool_size, args.pool_size)
+
+    legacy = legacy_pyramid_roi_align(input_boxes, input_meta, inputs_maps,
+                                      pool_shape)
+    current = modellib.PyramidROIAlign(pool_shape)(
+        [input_boxes, input_meta] + inputs_maps)
+    sampled = modellib.PyramidROIAlign(
+        pool_shape, sampling_ratio=args.sampling_ratio)(
+        [input_boxes, input_meta] + inputs_maps)
+
+    feed = {input_boxes: boxes, input_meta: image_meta}
+    feed.update(dict(zip(inputs_maps, feature_maps)))
+
+    with tf.Session() as sess:
+        # Same results as before with one sample per bin
+        a, b = sess.run([legacy, current], feed)
+        max_diff = np.abs(a - b).max()
+
+        print("ROIs: {} x {}  image: {}x{}  channels: {}".format(
+            args.batch, args.rois, size, size, args.channels))
+        print("Max difference vs legacy: {:.3g}".format(max_diff))
+        print("{:28} {:>10} {:>10}".format("", "p50 (ms)", "p95 (ms)"))
+        results = [("legacy (where + top_k sort)", legacy),
+                   ("partition + stitch", current)]
+        if args.sampling_ratio > 1:
+            results.append(("partition + stitch, {} samples".format(
+                args.sampling_ratio ** 2), sampled))
+        for name, op in results:
+            times = time_op(sess, op, feed, args.repeat)
+            print("{:28} {:10.2f} {:10.2f}".format(
+                name, np.percentile(times, 50), np.percentile(times, 95)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Mask R-CNN
+Microbenchmarks of the NumPy hot paths in mrcnn/utils.py.
+
+Times each function of mrcnn/utils.py with realistic inputs, measures its
+peak memory allocation (tracemalloc), and does the same for the frozen
+reference copy in benchmarks/reference_utils.py. The results of both must
+match, so an optimized version can be checked against the original.
+
+Usage:
+
+    # All benchmarks
+    python3 benchmarks/utils_hot_paths.py
+
+    # Only some, and save the results
+    python3 benchmarks/utils_hot_paths.py --filter=overlaps,nms --output=utils.json
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tracemalloc
+from collections import OrderedDict
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mrcnn import utils
+import reference_utils
+
+
+############################################################
+#  Inputs
+############################################################
+
+# Anchors of a 1024x1024 image with the default config: 261,888 anchors
+ANCHOR_SCALES = (32, 64, 128, 256, 512)
+ANCHOR_RATIOS = [0.5, 1, 2]
+BACKBONE_STRIDES = [4, 8, 16, 32, 64]
+
+
+def random_boxes(rng, count, image_size, min_size=8, max_size=400):
+    """Random integer boxes [count, (y1, x1, y2, x2)] inside the image."""
+    size = rng.randint(min_size, max_size, (count, 2))
+    corner = (rng.rand(count, 2) * (image_size - size)).astype(np.int32)
+    return np.concatenate([corner, corner + size], axis=1).astype(np.int32)
+
+
+def box_masks(boxes, image_size):
+    """Masks [image_size, image_size, N] filling an ellipse in each box."""
+    masks = np.zeros([image_size, image_size, len(boxes)], dtype=bool)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        yy, xx = np.ogrid[y1:y2, x1:x2]
+        cy, cx = (y1 + y2 - 1) / 2, (x1 + x2 - 1) / 2
+        ry, rx = max((y2 - y1) / 2, 1), max((x2 - x1) / 2, 1)
+        masks[y1:y2, x1:x2, i] = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    return masks
+
+
+def pyramid_anchors(module):
+    shapes = np.array([[1024 // s, 1024 // s] for s in BACKBONE_STRIDES])
+    return module.generate_pyramid_anchors(ANCHOR_SCALES, ANCHOR_RATIOS, shapes,
+                                           BACKBONE_STRIDES, 1)
+
+
+def detections(rng, image_size, gt_count, pred_count):
+    """Ground truth and predictions for compute_matches() and compute_ap().
+    Half the predictions are jittered copies of GT boxes.
+    """
+    gt_boxes = random_boxes(rng, gt_count, image_size, max_size=image_size // 4)
+    gt_class_ids = rng.randint(1, 5, gt_count).astype(np.int32)
+    jitter = rng.randint(-6, 7, (pred_count // 2, 4))
+    pred_boxes = np.concatenate([
+        np.clip(gt_boxes[rng.randint(0, gt_count, pred_count // 2)] + jitter,
+                0, image_size),
+        random_boxes(rng, pred_count - pred_count // 2, image_size,
+                     max_size=image_size // 4)]).astype(np.int32)
+    pred_boxes[:, 2:] = np.maximum(pred_boxes[:, 2:], pred_boxes[:, :2] + 1)
+    pred_class_ids = rng.randint(1, 5, pred_count).astype(np.int32)
+    pred_scores = rng.rand(pred_count).astype(np.float32)
+    return (gt_boxes, gt_class_ids, box_masks(gt_boxes, image_size),
+            pred_boxes, pred_class_ids, pred_scores,
+            box_masks(pred_boxes, image_size))
+
+
+def rpn_targets_inputs(rng, gt_count):
+    """Float32 anchors, as training uses, and gt_count GT boxes of COCO like
+    counts. The prebuilt anchor index is part of the inputs, as in
+    data_generator().
+    """
+    anchors = pyramid_anchors(reference_utils).astype(np.float32)
+    gt_boxes = random_boxes(rng, gt_count, 1024)
+    gt_class_ids = rng.randint(1, 81, gt_count).astype(np.int32)
+    # A few crowd boxes
+    gt_class_ids[:3] = -gt_class_ids[:3]
+    return anchors, gt_class_ids, gt_boxes, utils.BoxIndex(anchors)
+
+
+def rpn_targets(module, args):
+    """Runs build_rpn_targets(). The current version is in mrcnn/model.py and
+    uses the prebuilt anchor index, as data_generator() does.
+    """
+    from mrcnn.config import Config
+    anchors, gt_class_ids, gt_boxes, anchor_index = args
+    # Same random subsampling in both versions
+    np.random.seed(0)
+    if module is reference_utils:
+        return module.build_rpn_targets((1024, 1024, 3), anchors, gt_class_ids,
+                                        gt_boxes, Config())
+    from mrcnn import model as modellib
+    return modellib.build_rpn_targets((1024, 1024, 3), anchors, gt_class_ids,
+                                      gt_boxes, Config(), anchor_index=anchor_index)
+
+
+############################################################
+#  Benchmarks
+############################################################
+
+# name: (setup(rng) -> args, call(module, args) -> result)
+def sparse_pairs(overlaps, threshold=None):
+    """(rows, columns, values) of the pairs >= threshold of a dense
+    matrix, or of all the entries of a CSR matrix, in row-major order.
+    """
+    if isinstance(overlaps, np.ndarray):
+        rows, cols = np.nonzero(overlaps >= threshold)
+        return rows, cols, overlaps[rows, cols]
+    overlaps = overlaps.tocoo()
+    return overlaps.row, overlaps.col, overlaps.data
+
+
+BENCHMARKS = OrderedDict([
+    ("compute_overlaps", (
+        lambda rng: (pyramid_anchors(reference_utils),
+                     random_boxes(rng, 100, 1024).astype(np.float32)),
+        lambda m, a: m.compute_overlaps(a[0], a[1]))),
+    ("compute_overlaps_sparse", (
+        lambda rng: (lambda anchors: (anchors,
+                                      random_boxes(rng, 100, 1024).astype(np.float32),
+                                      utils.BoxIndex(anchors)))(
+            pyramid_anchors(reference_utils)),
+        # The pairs >= 0.3, as build_rpn_targets() uses them. The reference
+        # thresholds its dense matrix.
+        lambda m, a: sparse_pairs(m.compute_overlaps(a[0], a[1]), 0.3)
+        if m is reference_utils else
+        sparse_pairs(m.compute_overlaps_sparse(a[0], a[1], 0.3, index=a[2])))),
+    ("compute_overlaps_masks", (
+        lambda rng: (box_masks(random_boxes(rng, 100, 512, max_size=200), 512),
+                     box_masks(random_boxes(rng, 50, 512, max_size=200), 512)),
+        lambda m, a: m.compute_overlaps_masks(a[0], a[1]))),
+    ("non_max_suppression", (
+        lambda rng: (random_boxes(rng, 6000, 1024).astype(np.float32),
+                     rng.rand(6000).astype(np.float32)),
+        lambda m, a: m.non_max_suppression(a[0], a[1], 0.7))),
+    ("generate_pyramid_anchors", (
+        lambda rng: (),
+        lambda m, a: pyramid_anchors(m))),
+    ("resize_image", (
+        lambda rng: (rng.randint(0, 256, (2710, 3384, 3)).astype(np.uint8),),
+        lambda m, a: m.resize_image(a[0], min_dim=800, max_dim=1024,
+                                    mode="square")[:4])),
+    ("minimize_mask", (
+        lambda rng: (lambda boxes: (boxes, box_masks(boxes, 1024)))(
+            random_boxes(rng, 50, 1024)),
+        lambda m, a: m.minimize_mask(a[0], a[1], (56, 56)))),
+    ("expand_mask", (
+        lambda rng: (random_boxes(rng, 50, 1024), rng.rand(56, 56, 50) > 0.5),
+        lambda m, a: m.expand_mask(a[0], a[1], (1024, 1024, 3)))),
+    ("unmold_mask", (
+        lambda rng: (rng.rand(100, 28, 28).astype(np.float32),
+                     random_boxes(rng, 100, 1024)),
+        lambda m, a: np.stack([m.unmold_mask(a[0][i], a[1][i], (1024, 1024, 3))
+                               for i in range(len(a[1]))], axis=-1))),
+    ("compute_matches", (
+        lambda rng: detections(rng, 512, 30, 100),
+        lambda m, a: m.compute_matches(*a))),
+    ("compute_ap", (
+        lambda rng: detections(rng, 512, 30, 100),
+        lambda m, a: m.compute_ap(*a))),
+    ("build_rpn_targets_20gt", (lambda rng: rpn_targets_inputs(rng, 20), rpn_targets)),
+    ("build_rpn_targets_50gt", (lambda rng: rpn_targets_inputs(rng, 50), rpn_targets)),
+    ("build_rpn_targets_100gt", (lambda rng: rpn_targets_inputs(rng, 100), rpn_targets)),
+])
+
+
+def assert_equivalent(a, b, atol=1e-5, path="result"):
+    """Raises AssertionError if two results differ. Results can be arrays,
+    scalars or tuples and lists of them. Floats are compared with a
+    tolerance, everything else exactly.
+    """
+    if isinstance(a, (tuple, list)):
+        assert len(a) == len(b), "{}: length {} != {}".format(path, len(a), len(b))
+        for i, (x, y) in enumerate(zip(a, b)):
+            assert_equivalent(x, y, atol, "{}[{}]".format(path, i))
+        return
+    a = np.asarray(a)
+    b = np.asarray(b)
+    assert a.shape == b.shape, "{}: shape {} != {}".format(path, a.shape, b.shape)
+    if a.dtype.kind == "f" or b.dtype.kind == "f":
+        assert np.allclose(a, b, rtol=1e-5, atol=atol, equal_nan=True),\
+            "{}: max difference {}".format(path, np.nanmax(np.abs(a - b)))
+    else:
+        assert np.array_equal(a, b), "{}: values differ".format(path)
+
+
+def measure(fn, repeat):
+    """Returns (median seconds per call, peak bytes allocated by one call)."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(np.median(times)), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark mrcnn/utils.py against its reference copy.')
+    parser.add_argument('--filter', default=None,
+                        help='Comma separated substrings of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timing repeats per function (default=5)')
+    parser.add_argument('--no-reference', action='store_true',
+                        help="Don't time the reference (still checks equivalence)")
+    parser.add_argument('--output', default=None,
+                        help='Save the results to this JSON file')
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS)
+    if args.filter:
+        keys = args.filter.split(",")
+        names = [n for n in names if any(k in n for k in keys)]
+
+    print("{:26} {:>12} {:>12} {:>8} {:>12} {:>12}  {}".format(
+        "", "ref (ms)", "current (ms)", "speedup", "ref (MB)", "current (MB)", "equal"))
+    results = []
+    failed = False
+    for name in names:
+        setup, call = BENCHMARKS[name]
+        inputs = setup(np.random.RandomState(0))
+        ref_fn = lambda: call(reference_utils, inputs)
+        fn = lambda: call(utils, inputs)
+
+        try:
+            assert_equivalent(fn(), ref_fn())
+            equal = "yes"
+        except AssertionError as e:
+            equal = "NO: {}".format(e)
+            failed = True
+
+        current_time, current_mem = measure(fn, args.repeat)
+        if args.no_reference:
+            ref_time, ref_mem = float("nan"), float("nan")
+        else:
+            ref_time, ref_mem = measure(ref_fn, args.repeat)
+        print("{:26} {:12.2f} {:12.2f} {:7.1f}x {:12.1f} {:12.1f}  {}".format(
+            name, ref_time * 1000, current_time * 1000, ref_time / current_time,
+            ref_mem / 2 ** 20, current_mem / 2 ** 20, equal))
+        results.append({"name": name, "reference_ms": ref_time * 1000,
+                        "current_ms": current_time * 1000,
+                        "reference_peak_mb": ref_mem / 2 ** 20,
+                        "current_peak_mb": current_mem / 2 ** 20,
+                        "equivalent": equal == "yes"})
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
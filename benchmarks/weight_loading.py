@@ -0,0 +1,131 @@
+"""
+Mask R-CNN
+Cold start benchmark of MaskRCNN.load_weights(): Keras .h5 files against
+weight archives (mrcnn/weight_archive.py).
+
+Each run is a fresh process that builds the inference model, as
+init_maskrcnn() in pose_model.py does, and loads the weights by name.
+The weight files are evicted from the page cache before each run, so
+the reads come from disk. Reports the build time and the load time.
+
+Usage:
+
+    # COCO weights, converted to an archive in a temporary directory
+    python3 benchmarks/weight_loading.py --weights=mask_rcnn_coco.h5
+
+    # Random weights, nothing to download. Parallel archive reads.
+    python3 benchmarks/weight_loading.py --workers=8
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+
+
+def make_config():
+    """COCO sized inference config."""
+    from mrcnn.config import Config
+
+    class BenchmarkConfig(Config):
+        NAME = "benchmark"
+        NUM_CLASSES = 1 + 80
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = 1
+
+    return BenchmarkConfig()
+
+
+def evict(path):
+    """Drops the pages of a file from the page cache, where supported."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def run_case(path, workers):
+    """Builds the model and loads the weights. Runs in its own process.
+    Returns (build seconds, load seconds, checksum of the weights).
+    """
+    from mrcnn import model as modellib
+
+    start = time.perf_counter()
+    model = modellib.MaskRCNN(mode="inference", config=make_config(),
+                              model_dir=tempfile.gettempdir())
+    build_time = time.perf_counter() - start
+
+    evict(path)
+    start = time.perf_counter()
+    model.load_weights(path, by_name=True, workers=workers)
+    load_time = time.perf_counter() - start
+
+    checksum = float(sum(np.sum(w, dtype=np.float64)
+                         for w in model.keras_model.get_weights()))
+    return build_time, load_time, checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading .h5 weights against weight archives.')
+    parser.add_argument('--weights', default=None,
+                        help='Keras .h5 weights file. By default, random weights '
+                             'of the model are saved and used.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Reader threads of the parallel archive run (default=4)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per format (default=3)')
+    args = parser.parse_args()
+
+    from mrcnn import weight_archive
+
+    work_dir = tempfile.mkdtemp()
+    h5_path = args.weights
+    if h5_path is None:
+        from mrcnn import model as modellib
+        h5_path = os.path.join(work_dir, "random.h5")
+        model = modellib.MaskRCNN(mode="inference", config=make_config(),
+                                  model_dir=work_dir)
+        model.keras_model.save_weights(h5_path)
+        del model
+    archive_path = os.path.join(work_dir, "weights.mrw")
+    start = time.perf_counter()
+    weight_archive.convert_h5(h5_path, archive_path)
+    print("Converted {} in {:.2f}s".format(h5_path, time.perf_counter() - start))
+    if not evict(archive_path):
+        print("posix_fadvise isn't available. Reads may come from the page cache.")
+
+    # One fresh process per run: separate graphs and a cold start
+    context = multiprocessing.get_context("spawn")
+    cases = [(".h5", h5_path, 0), ("archive", archive_path, 0),
+             ("archive, {} threads".format(args.workers), archive_path, args.workers)]
+    print("{:22} {:>10} {:>10}".format("", "build (s)", "load (s)"))
+    checksums = []
+    for name, path, workers in cases:
+        results = []
+        for _ in range(args.repeat):
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_case, (path, workers)))
+        build_times, load_times, sums = zip(*results)
+        checksums.append(sums[0])
+        print("{:22} {:10.2f} {:10.2f}".format(
+            name, np.median(build_times), np.median(load_times)))
+    print("Same weights: {}".format(np.allclose(checksums, checksums[0])))
+
+
+if __name__ == '__main__':
+    main()
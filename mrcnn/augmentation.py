@@ -0,0 +1,162 @@
+"""
+Mask R-CNN
+Batched augmentation of images, boxes and compact masks.
+
+Licensed under the MIT License (see LICENSE for details)
+
+imgaug augments one image at a time, and masks have to go through it as a
+separate uint8 image stack, after which the boxes are extracted from them
+again. BatchAugmenter is limited to transforms that keep boxes axis
+aligned (flips, scaling and shifts), which lets it:
+
+- Express the geometric transform of each image as a source row and a
+  source column for every output row and column. Images are resampled
+  with one indexing operation per batch, utils.CompactMasks only resample
+  their box bitmaps, and the boxes are read from the resampled bitmaps.
+- Apply the photometric transforms (brightness, contrast, noise) to the
+  whole batch as array operations.
+
+Parameters are drawn per image, from a seed if given, so the result of an
+image doesn't depend on the rest of its batch. That's what lets
+model.TrainingSequence run it in the loader workers.
+
+Usage:
+
+    from mrcnn.augmentation import BatchAugmenter
+
+    augmentation = BatchAugmenter(fliplr=0.5, scale=(0.8, 1.2),
+                                  translate=0.1, brightness=20)
+    model.train(dataset_train, dataset_val, learning_rate, epochs, "heads",
+                augmentation=augmentation)
+"""
+
+import numpy as np
+
+
+class BatchAugmenter(object):
+    """Random flips, scaling, shifts, brightness, contrast and noise.
+
+    fliplr: Probability of a horizontal flip.
+    flipud: Probability of a vertical flip.
+    scale: (min, max) Zoom factor, around the image center. Nearest
+        neighbour. Values over 1 crop the image, values under 1 pad it.
+    translate: Maximum shift, as a fraction of the height and width.
+    brightness: Maximum value added to or subtracted from the pixels.
+    contrast: (min, max) Factor of the pixel differences to the image mean.
+    noise: Maximum standard deviation of the Gaussian noise added to the
+        pixels.
+    """
+
+    def __init__(self, fliplr=0.5, flipud=0.0, scale=(1.0, 1.0), translate=0.0,
+                 brightness=0.0, contrast=(1.0, 1.0), noise=0.0):
+        self.fliplr = fliplr
+        self.flipud = flipud
+        self.scale = scale
+        self.translate = translate
+        self.brightness = brightness
+        self.contrast = contrast
+        self.noise = noise
+
+    def sample_params(self, rng, shape):
+        """Draws the transform of one image of the given shape.
+
+        Returns a dict with:
+        rows, cols: Source row of each output row and source column of each
+            output column, -1 where the output is outside the image.
+        brightness, contrast, noise: Photometric parameters.
+        seed: Seed of the noise.
+        """
+        h, w = shape[:2]
+        flip_y = rng.rand() < self.flipud
+        flip_x = rng.rand() < self.fliplr
+        scale = rng.uniform(self.scale[0], self.scale[1])
+        ty, tx = rng.uniform(-self.translate, self.translate, 2) * [h, w]
+        return {
+            "rows": source_index(h, scale, ty, flip_y),
+            "cols": source_index(w, scale, tx, flip_x),
+            "brightness": rng.uniform(-self.brightness, self.brightness),
+            "contrast": rng.uniform(self.contrast[0], self.contrast[1]),
+            "noise": rng.uniform(0, self.noise),
+            "seed": rng.randint(2 ** 31 - 1),
+        }
+
+    def augment(self, images, masks, seeds=None):
+        """Augments a batch.
+
+        images: List of [height, width, channels] images.
+        masks: List of utils.CompactMasks, one per image.
+        seeds: Optional list of seeds, one per image. Uses the global NumPy
+            random state otherwise.
+
+        Returns lists of images, masks and boxes [instances, (y1, x1, y2, x2)],
+        with the same shapes as the inputs. The boxes are those of the
+        augmented masks, as utils.extract_bboxes() gives. Instances that end
+        up outside the image have empty masks and zero boxes. Filter them
+        with masks.areas() > 0.
+        """
+        rngs = [np.random.RandomState(s) for s in seeds] if seeds is not None \
+            else [np.random] * len(images)
+        params = [self.sample_params(rng, image.shape)
+                  for rng, image in zip(rngs, images)]
+
+        out_images = [None] * len(images)
+        # Images of the same shape are transformed together
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault((image.shape, image.dtype.str), []).append(i)
+        for ids in groups.values():
+            batch = self.transform_images(np.stack([images[i] for i in ids]),
+                                          [params[i] for i in ids])
+            for i, image in zip(ids, batch):
+                out_images[i] = image
+
+        out_masks = [m.remap(p["rows"], p["cols"]) for m, p in zip(masks, params)]
+        # Mapping the boxes isn't enough: a row or column on the edge of a
+        # box can be skipped by the zoom or have its pixels cut off
+        out_boxes = [m.extract_bboxes() for m in out_masks]
+        return out_images, out_masks, out_boxes
+
+    def transform_images(self, images, params):
+        """Applies the transforms to a batch [batch, height, width, channels]
+        of images of the same shape. Returns an array of the same dtype.
+        """
+        b = np.arange(images.shape[0])
+        rows = np.stack([p["rows"] for p in params])
+        cols = np.stack([p["cols"] for p in params])
+        # Geometric: one gather for the whole batch
+        out = images[b[:, None, None],
+                     np.maximum(rows, 0)[:, :, None],
+                     np.maximum(cols, 0)[:, None, :]].astype(np.float32)
+        inside = (rows >= 0)[:, :, None] & (cols >= 0)[:, None, :]
+        out *= inside[..., None]
+
+        # Photometric: per image scalars broadcast over the batch
+        contrast = np.array([p["contrast"] for p in params], dtype=np.float32)
+        brightness = np.array([p["brightness"] for p in params], dtype=np.float32)
+        if np.any(contrast != 1):
+            mean = out.mean(axis=(1, 2, 3))
+            out = out * contrast[:, None, None, None] + \
+                (mean * (1 - contrast))[:, None, None, None]
+        if np.any(brightness != 0):
+            out += brightness[:, None, None, None]
+        if self.noise:
+            for i, p in enumerate(params):
+                rng = np.random.RandomState(p["seed"])
+                out[i] += (rng.standard_normal(out.shape[1:]) * p["noise"]).astype(np.float32)
+        if images.dtype == np.uint8:
+            out = np.clip(np.round(out), 0, 255)
+        return out.astype(images.dtype)
+
+
+def source_index(size, scale, shift, flip):
+    """Returns the source position of each output position [size] of a
+    zoom by scale around the center, followed by a shift, of a line of
+    size pixels that is flipped first if flip is True. -1 marks positions
+    outside the source.
+    """
+    center = size / 2
+    src = np.floor((np.arange(size) + 0.5 - center - shift) / scale + center).astype(np.int64)
+    src[(src < 0) | (src >= size)] = -1
+    if flip:
+        src = np.where(src >= 0, size - 1 - src, -1)
+    return src
@@ -84,6 +84,13 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory of the persistent anchor store. If set, anchors are
+    # generated once per image shape, saved there as float32 .npy files and
+    # memory-mapped by all the processes that need them (data generator
+    # workers, inference processes). See utils.load_pyramid_anchors().
+    # If None, every process generates and keeps its own copy.
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can increase this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -103,6 +110,33 @@ class Config(object):
     USE_MINI_MASK = True
     MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
 
+    # Directory of the preprocessed sample cache (see mrcnn/sample_cache.py).
+    # If set, train() stores the resized images, masks and boxes of each
+    # dataset there once, and the data generator reads them instead of
+    # loading and resizing every image again each epoch. None disables it.
+    # Not supported with the "crop" IMAGE_RESIZE_MODE.
+    SAMPLE_CACHE_DIR = None
+
+    # Directory of the backbone feature cache (see mrcnn/feature_cache.py).
+    # If set, train(layers="heads") runs the frozen backbone once on every
+    # image, without augmentation, stores the C2-C5 feature maps there, and
+    # trains the FPN, RPN and heads from them. Needs a ResNet backbone and
+    # images of one shape (no TRAIN_BUCKETS, no "crop" mode), and about
+    # 60 MB of disk per 1024x1024 image, read back every epoch. Check with
+    # benchmarks/feature_cache.py that the disk is faster than the backbone.
+    # None disables it.
+    FEATURE_CACHE_DIR = None
+
+    # Full training state checkpoints (see mrcnn/training_state.py). train()
+    # saves the weights, the optimizer state, the epoch and step, the data
+    # loader position and the NumPy and Python random states to
+    # training_state.npz in the log directory, replacing the previous file
+    # atomically, at the end of each epoch and every TRAINING_STATE_STEPS
+    # steps. 0 saves at the end of epochs only. None disables it. Resume
+    # with MaskRCNN.load_training_state(). The in-graph ROI sampling isn't
+    # restored, so a resumed run isn't an exact replay.
+    TRAINING_STATE_STEPS = 0
+
     # Input image resizing
     # Generally, use the "square" resizing mode for training and predicting
     # and it should work well in most cases. In this mode, images are scaled
@@ -119,6 +153,12 @@ class Config(object):
     #         up before padding. IMAGE_MAX_DIM is ignored in this mode.
     #         The multiple of 64 is needed to ensure smooth scaling of feature
     #         maps up and down the 6 levels of the FPN pyramid (2**6=64).
+    # aspect: Scales like square (IMAGE_MIN_DIM, IMAGE_MIN_SCALE and
+    #         IMAGE_MAX_DIM apply), but pads width and height only to
+    #         multiples of 64 instead of to a square. Images of different
+    #         aspect ratios mold to different shapes, so use it for
+    #         inference with MaskRCNN.detect_bucketed(). The molded images
+    #         are at most IMAGE_MAX_DIM x IMAGE_MAX_DIM (rounded up to 64).
     # crop:   Picks random crops from the image. First, scales the image based
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
@@ -131,6 +171,17 @@ class Config(object):
     # the width and height, or more, even if MIN_IMAGE_DIM doesn't require it.
     # However, in 'square' mode, it can be overruled by IMAGE_MAX_DIM.
     IMAGE_MIN_SCALE = 0
+
+    # Aspect ratio buckets for training. A list of (height, width) molded
+    # image shapes, multiples of 64, for example [(768, 1024), (1024, 768)].
+    # If set, each training image goes to the bucket with the closest aspect
+    # ratio, is scaled to fit it and padded to its shape ("fit" mode of
+    # utils.resize_image()), and batches are made of images of one bucket.
+    # This replaces IMAGE_RESIZE_MODE in training, so datasets with
+    # non-square images waste less of the backbone compute on padding. The
+    # anchors of each bucket are precomputed. Use the "aspect" resize mode
+    # for inference on such datasets. None molds all images to IMAGE_SHAPE.
+    TRAIN_BUCKETS = None
     # Number of color channels per image. RGB = 3, grayscale = 1, RGB-D = 4
     # Changing this requires other changes in the code. See the WIKI for more
     # details: https://github.com/matterport/Mask_RCNN/wiki
@@ -149,10 +200,26 @@ class Config(object):
     # Percent of positive ROIs used to train classifier/mask heads
     ROI_POSITIVE_RATIO = 0.33
 
+    # Online hard example mining (OHEM). If True, the proposals aren't
+    # subsampled at random with ROI_POSITIVE_RATIO. Up to OHEM_CANDIDATE_ROIS
+    # of them (at most POST_NMS_ROIS_TRAINING) go through the classifier
+    # head, and only the TRAIN_ROIS_PER_IMAGE with the highest classifier and
+    # box loss are used in the losses and the mask head. A candidate that
+    # overlaps a harder one by more than OHEM_NMS_THRESHOLD IoU is skipped.
+    USE_OHEM = False
+    OHEM_CANDIDATE_ROIS = 1000
+    OHEM_NMS_THRESHOLD = 0.7
+
     # Pooled ROIs
     POOL_SIZE = 7
     MASK_POOL_SIZE = 14
 
+    # Number of bilinear samples per ROIAlign bin along each axis.
+    # 1 interpolates a single value at the center of each bin. 2 averages
+    # 4 samples per bin, as described in the Mask R-CNN paper, at the cost
+    # of cropping 4x more values.
+    ROI_ALIGN_SAMPLING_RATIO = 1
+
     # Shape of output mask
     # To change this you also need to change the neural network mask branch
     MASK_SHAPE = [28, 28]
@@ -210,6 +277,24 @@ class Config(object):
     # Gradient norm clipping
     GRADIENT_CLIP_NORM = 5.0
 
+    # Gradient accumulation. If > 1, the gradients of this many batches are
+    # averaged before each SGD step, for an effective batch size of
+    # BATCH_SIZE * GRADIENT_ACCUMULATION_STEPS without the memory of the
+    # larger batch. GRADIENT_CLIP_NORM applies to the averaged gradients.
+    # STEPS_PER_EPOCH still counts batches, so an epoch makes
+    # STEPS_PER_EPOCH / GRADIENT_ACCUMULATION_STEPS weight updates. Batch
+    # normalization statistics still come from single batches.
+    GRADIENT_ACCUMULATION_STEPS = 1
+
+    # Mixed precision. None, "float16" or "bfloat16". If set, the graph runs
+    # with TensorFlow's automatic mixed precision rewrite: convolutions and
+    # matmuls in the lower precision, weights in float32, and the losses,
+    # softmax, exp/log of the box deltas and NMS in float32 (see
+    # model.FLOAT32_OPS). float16 (GPU) training uses dynamic loss scaling.
+    # bfloat16 needs a TensorFlow CPU build with oneDNN. MaskRCNN() then
+    # replaces the Keras session of the process with a mixed precision one.
+    MIXED_PRECISION = None
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
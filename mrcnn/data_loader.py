@@ -0,0 +1,330 @@
+"""
+Mask R-CNN
+Multiprocess loader of training batches.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Keras' fit_generator(use_multiprocessing=True) runs a copy of the Python
+generator in each worker, so every worker shuffles the dataset on its own
+and samples repeat within an epoch. It also pickles every batch through a
+pipe. ShardedLoader loads the batches of a model.TrainingSequence instead:
+
+- Batch i of an epoch is loaded by worker i % workers, so each batch is
+  loaded once and the workers never load the same sample.
+- Batches are returned in index order, whichever worker finishes first.
+- Workers write the batch arrays into a multiprocessing.shared_memory block
+  and send only its name. Without shared memory (Python < 3.8) the batches
+  are pickled.
+- The number of batches ready ahead of the training loop is recorded each
+  step. QueueDepthCallback adds it to the training logs. A depth of 0 means
+  the training loop waited for data.
+
+Usage:
+
+    sequence = modellib.TrainingSequence(dataset, config,
+                                         batch_size=config.BATCH_SIZE)
+    loader = ShardedLoader(sequence, workers=8)
+    model.keras_model.fit_generator(loader.generator(), steps_per_epoch=1000,
+                                    callbacks=[QueueDepthCallback(loader)],
+                                    workers=0)
+    loader.close()
+
+Or just call MaskRCNN.train(), which does this.
+"""
+
+import time
+import queue
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+import keras
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    # Python < 3.8. Batches are pickled.
+    shared_memory = None
+
+
+############################################################
+#  Batch Transport
+############################################################
+
+def _flatten(batch):
+    """Splits a batch (inputs, outputs) into a list of arrays and the
+    lengths of inputs and outputs.
+    """
+    inputs, outputs = batch
+    return [np.ascontiguousarray(a) for a in list(inputs) + list(outputs)], \
+        (len(inputs), len(outputs))
+
+
+def _unflatten(arrays, structure):
+    return arrays[:structure[0]], arrays[structure[0]:]
+
+
+def pack_batch(batch, use_shared_memory=True):
+    """Prepares a batch to be sent to another process.
+
+    With shared memory, the arrays are copied into one new shared memory
+    block and only the block name and the array layouts are returned.
+    The receiver must call unpack_batch(), which frees the block.
+    Otherwise the batch is returned as is, to be pickled.
+    """
+    if not use_shared_memory or shared_memory is None:
+        return ("pickle", batch)
+    arrays, structure = _flatten(batch)
+    layouts = []
+    offset = 0
+    for a in arrays:
+        layouts.append((a.shape, a.dtype.str, offset))
+        # Keep each array 64 byte aligned
+        offset += (a.nbytes + 63) // 64 * 64
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for a, (shape, dtype, start) in zip(arrays, layouts):
+        np.ndarray(shape, dtype, buffer=block.buf, offset=start)[...] = a
+    name = block.name
+    block.close()
+    # The receiver unlinks the block. Don't let this process' resource
+    # tracker remove it, or warn about it, when the worker exits.
+    resource_tracker.unregister(block._name, "shared_memory")
+    return ("shm", name, layouts, structure)
+
+
+def unpack_batch(message):
+    """Returns the batch (inputs, outputs) of a message made by
+    pack_batch(). Shared memory blocks are copied out and freed.
+    """
+    if message[0] == "pickle":
+        return message[1]
+    _, name, layouts, structure = message
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = [np.ndarray(shape, dtype, buffer=block.buf, offset=start).copy()
+                  for shape, dtype, start in layouts]
+    finally:
+        block.close()
+        block.unlink()
+    return _unflatten(arrays, structure)
+
+
+############################################################
+#  Loader
+############################################################
+
+def _worker_loop(sequence, worker_id, workers, start_epoch, start_index, slots,
+                 results, stop, use_shared_memory):
+    """Loads the batches of a worker's shard, epoch after epoch, from batch
+    start_index of start_epoch, until stop is set. A slot is taken for each
+    batch and given back by the consumer, which limits how far ahead a
+    worker goes.
+    """
+    epoch = start_epoch
+    try:
+        while not stop.is_set():
+            sequence.set_epoch(epoch)
+            for index in range(worker_id, len(sequence), workers):
+                if epoch == start_epoch and index < start_index:
+                    continue
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                batch = sequence[index]
+                results.put((epoch, index, pack_batch(batch, use_shared_memory)))
+            epoch += 1
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        results.put((epoch, None, traceback.format_exc()))
+
+
+class ShardedLoader(object):
+    """Loads the batches of a Sequence in worker processes and returns them
+    in order. See the module docstring.
+
+    sequence: model.TrainingSequence, or any keras.utils.Sequence with a
+        set_epoch(epoch) method whose batches are (inputs, outputs) lists
+        of numpy arrays and depend only on the epoch and the index.
+    workers: Number of worker processes. 0 loads the batches in the
+        calling process.
+    prefetch: Batches each worker can load ahead of the training loop.
+    use_shared_memory: Pass the batches through shared memory, if the
+        Python version supports it. Otherwise they're pickled.
+    """
+
+    def __init__(self, sequence, workers=4, prefetch=4, use_shared_memory=True):
+        self.sequence = sequence
+        self.workers = workers
+        self.prefetch = prefetch
+        self.use_shared_memory = use_shared_memory and shared_memory is not None
+        self.processes = []
+        # Per step of the training loop: (ready batches, seconds waited)
+        self.history = []
+        # (epoch, index) of the next batch the generator returns
+        self.position = (0, 0)
+
+    def start(self, epoch=0, index=0):
+        """Starts the worker processes at batch index of an epoch."""
+        self.close()
+        self._stop = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self._slots = []
+        self._pending = {}
+        for w in range(self.workers):
+            slots = multiprocessing.Semaphore(self.prefetch)
+            p = multiprocessing.Process(
+                target=_worker_loop,
+                args=(self.sequence, w, self.workers, epoch, index, slots,
+                      self._results, self._stop, self.use_shared_memory),
+                daemon=True)
+            p.start()
+            self._slots.append(slots)
+            self.processes.append(p)
+
+    def close(self):
+        """Stops the worker processes and frees the batches that weren't
+        consumed.
+        """
+        if not self.processes:
+            return
+        self._stop.set()
+        # A worker can't exit before the batches it put in the queue are
+        # read, so keep reading while they stop
+        deadline = time.time() + 5
+        while any(p.is_alive() for p in self.processes) and time.time() < deadline:
+            self._drain(raise_errors=False)
+            time.sleep(0.05)
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.processes = []
+        # Free the shared memory of the batches that weren't used
+        self._drain(raise_errors=False)
+        for message in self._pending.values():
+            if message[0] == "shm":
+                unpack_batch(message)
+        self._pending = {}
+
+    def _drain(self, block_for=None, raise_errors=True):
+        """Moves the loaded batches from the result queue to the pending
+        dict. Waits for the batch with key block_for if it isn't there.
+        Raises RuntimeError if a worker failed, unless raise_errors is False,
+        or if the worker that loads block_for exited.
+        """
+        while True:
+            try:
+                wait = block_for is not None and block_for not in self._pending
+                epoch, index, message = self._results.get(block=wait, timeout=1)
+            except queue.Empty:
+                if block_for is None or block_for in self._pending:
+                    return
+                # Batch i is loaded by worker i % workers only. If it
+                # died (e.g. killed for lack of memory), it never comes.
+                owner = self.processes[block_for[1] % self.workers]
+                if not owner.is_alive():
+                    raise RuntimeError(
+                        "Data loader worker {} exited with code {} before loading "
+                        "batch {} of epoch {}.".format(
+                            block_for[1] % self.workers, owner.exitcode,
+                            block_for[1], block_for[0]))
+                continue
+            if index is None:
+                if raise_errors:
+                    raise RuntimeError("Data loader worker failed:\n" + message)
+                continue
+            self._pending[(epoch, index)] = message
+
+    def queue_depth(self, epoch, index):
+        """Number of consecutive batches, from the given one, that are
+        loaded and waiting.
+        """
+        depth = 0
+        while (epoch, index) in self._pending:
+            depth += 1
+            epoch, index = self._next_position(epoch, index)
+        return depth
+
+    def _next_position(self, epoch, index):
+        """(epoch, index) of the batch after the given one."""
+        index += 1
+        if index == len(self.sequence):
+            return epoch + 1, 0
+        return epoch, index
+
+    def generator(self, epoch=0, index=0):
+        """Returns a generator of the batches, for fit_generator(). Runs
+        indefinitely, epoch after epoch, starting at batch index of the
+        given epoch. Epochs here are passes over the dataset, which don't
+        have to match the Keras epochs (STEPS_PER_EPOCH).
+
+        The position attribute is the (epoch, index) of the next batch, so
+        a generator started there continues where this one stopped.
+        """
+        start_index = index
+        self.position = (epoch, index)
+        if self.workers == 0:
+            while True:
+                self.sequence.set_epoch(epoch)
+                for index in range(start_index, len(self.sequence)):
+                    start = time.time()
+                    batch = self.sequence[index]
+                    self.history.append((0, time.time() - start))
+                    self.position = self._next_position(epoch, index)
+                    yield batch
+                epoch += 1
+                start_index = 0
+
+        self.start(epoch, index)
+        try:
+            while True:
+                for index in range(start_index, len(self.sequence)):
+                    key = (epoch, index)
+                    self._drain()
+                    depth = self.queue_depth(epoch, index)
+                    start = time.time()
+                    self._drain(block_for=key)
+                    self.history.append((depth, time.time() - start))
+                    batch = unpack_batch(self._pending.pop(key))
+                    # The worker can load another batch
+                    self._slots[index % self.workers].release()
+                    self.position = self._next_position(epoch, index)
+                    yield batch
+                epoch += 1
+                start_index = 0
+        finally:
+            self.close()
+
+
+class QueueDepthCallback(keras.callbacks.Callback):
+    """Adds the data loader statistics of each epoch to the Keras logs, so
+    that they show in the progress bar, TensorBoard and History:
+
+    loader_queue_depth: Mean number of batches ready when the training
+        loop asked for one. Close to 0 means the GPU waits for data.
+    loader_wait: Total seconds the training loop waited for data.
+
+    Put it before the callbacks that should see these values.
+    """
+
+    def __init__(self, loader):
+        super(QueueDepthCallback, self).__init__()
+        self.loader = loader
+        self.start = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = len(self.loader.history)
+
+    def on_epoch_end(self, epoch, logs=None):
+        history = self.loader.history[self.start:]
+        if logs is None or not history:
+            return
+        depths, waits = zip(*history)
+        logs["loader_queue_depth"] = float(np.mean(depths))
+        logs["loader_wait"] = float(np.sum(waits))
+        if self.loader.workers and np.mean(depths) < 1:
+            logging.warning("Data loader: the training loop waited {:.1f}s for "
+                            "data this epoch. Consider more workers.".format(
+                                np.sum(waits)))
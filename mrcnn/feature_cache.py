@@ -0,0 +1,157 @@
+"""
+Mask R-CNN
+On-disk cache of backbone feature maps, for training the heads only.
+
+Licensed under the MIT License (see LICENSE for details)
+
+When training with layers="heads" the ResNet backbone is frozen, so its
+outputs (C2-C5) for an image without augmentation are the same every
+epoch. MaskRCNN.train() can compute them once, store them here with the
+ground truth of each image, and train the FPN, RPN and heads from the
+stored features. No image is loaded or run through the backbone after the
+first pass.
+
+The feature maps are stored as float16, half the size of float32, in one
+memory-mapped .npy file per level. They are still large: about 60 MB per
+1024x1024 image with ResNet, so check the free disk space. Reading that
+per image is only faster than loading the image and running the backbone
+on fast disks, or when the cache fits in the page cache. Measure both on
+the training machine with benchmarks/feature_cache.py.
+
+A cache is specific to a dataset, the preprocessing config and the backbone
+weights. All three are hashed into its directory name. See
+MaskRCNN.load_feature_cache().
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+
+# Bump when the storage format changes
+CACHE_VERSION = 1
+
+
+class FeatureCache(object):
+    """Backbone feature maps and ground truth of the images of a dataset.
+
+    For each image it stores the C2-C5 feature maps, the image meta, and the
+    GT class IDs, boxes and masks (mini-masks if the config uses them) as
+    load_image_gt() returns them without augmentation.
+    """
+
+    def __init__(self, path):
+        """Opens an existing cache directory."""
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.info = json.load(f)
+        self.index = dict(np.load(os.path.join(path, "index.npz")))
+        self.rows = {int(image_id): row
+                     for row, image_id in enumerate(self.index["image_ids"])}
+        self.features = None
+        self.masks = None
+
+    def _open(self):
+        """Memory-maps the data files on first use. Opening lazily keeps
+        file handles out of the object until a worker process needs them.
+        """
+        if self.features is None:
+            self.features = [np.load(os.path.join(self.path, "c{}.npy".format(i + 2)),
+                                     mmap_mode="r")
+                             for i in range(len(self.info["level_shapes"]))]
+            self.masks = np.load(os.path.join(self.path, "masks.npy"), mmap_mode="r")
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # Don't pickle memory maps. Each process opens its own.
+        state = self.__dict__.copy()
+        state["features"] = state["masks"] = None
+        return state
+
+    @property
+    def level_shapes(self):
+        """[(height, width, channels)] of the stored feature maps, C2 to C5."""
+        return [tuple(s) for s in self.info["level_shapes"]]
+
+    def load_features(self, image_ids):
+        """Returns the feature maps of a batch of images: a list with one
+        float16 array [batch, height, width, channels] per level, C2 to C5.
+        """
+        self._open()
+        rows = [self.rows[int(i)] for i in image_ids]
+        return [np.stack([level[r] for r in rows]) for level in self.features]
+
+    def load_gt(self, image_id):
+        """Returns (image_meta, class_ids, bbox, masks) of an image. masks is
+        [height, width, instances], as load_image_gt() returns it.
+        """
+        self._open()
+        row = self.rows[int(image_id)]
+        i1, i2 = self.index["instance_offsets"][row:row + 2]
+        masks = np.array(self.masks[i1:i2]).transpose([1, 2, 0])
+        return (self.index["image_metas"][row].copy(),
+                self.index["class_ids"][i1:i2].copy(),
+                self.index["bboxes"][i1:i2].copy(),
+                masks)
+
+    @staticmethod
+    def build(path, image_ids, level_shapes, mask_shape, batches):
+        """Writes a cache to path. Writes to a temporary directory first and
+        renames it, so readers never see a partial cache.
+
+        image_ids: IDs of all the images, in the order of batches.
+        level_shapes: [(height, width, channels)] of C2 to C5.
+        mask_shape: (height, width) of the stored GT masks.
+        batches: Iterable of (features, gts). features is a list of arrays
+            [batch, height, width, channels], one per level. gts is a list
+            of (image_meta, class_ids, bbox, masks) per image of the batch.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        count = len(image_ids)
+        levels = [np.lib.format.open_memmap(
+            os.path.join(tmp_path, "c{}.npy".format(i + 2)), mode="w+",
+            dtype=np.float16, shape=(count,) + tuple(shape))
+            for i, shape in enumerate(level_shapes)]
+
+        image_metas, class_ids, bboxes, masks = [], [], [], []
+        instance_offsets = [0]
+        row = 0
+        for features, gts in batches:
+            for level, f in zip(levels, features):
+                level[row:row + len(f)] = f
+            row += len(gts)
+            for image_meta, ids, bbox, mask in gts:
+                image_metas.append(image_meta)
+                class_ids.append(ids)
+                bboxes.append(bbox)
+                masks.append(mask.astype(bool).transpose([2, 0, 1]))
+                instance_offsets.append(instance_offsets[-1] + len(ids))
+        assert row == count, "Expected {} images, got {}".format(count, row)
+        for level in levels:
+            level.flush()
+        del levels
+
+        np.save(os.path.join(tmp_path, "masks.npy"),
+                np.concatenate(masks) if masks else
+                np.zeros((0,) + tuple(mask_shape), dtype=bool))
+        np.savez(os.path.join(tmp_path, "index.npz"),
+                 image_ids=np.array(image_ids, dtype=np.int64),
+                 image_metas=np.array(image_metas, dtype=np.float32),
+                 class_ids=np.concatenate(class_ids).astype(np.int32),
+                 bboxes=np.concatenate(bboxes).astype(np.int32).reshape([-1, 4]),
+                 instance_offsets=np.array(instance_offsets, dtype=np.int64))
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump({"version": CACHE_VERSION, "image_count": count,
+                       "level_shapes": [list(s) for s in level_shapes]}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process built it first
+            shutil.rmtree(tmp_path, ignore_errors=True)
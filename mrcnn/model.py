@@ -9,9 +9,12 @@ Written by Waleed Abdulla
 
 import os
 import random
+import time
 import datetime
 import re
 import math
+import json
+import hashlib
 import logging
 from collections import OrderedDict
 import multiprocessing
@@ -23,7 +26,20 @@ import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
 
+# Optional. Only needed for imgaug augmentations (https://github.com/aleju/imgaug)
+try:
+    import imgaug
+except ImportError:
+    imgaug = None
+
 from mrcnn import utils
+from mrcnn import profiling
+from mrcnn import data_loader
+from mrcnn.augmentation import BatchAugmenter
+from mrcnn.sample_cache import SampleCache, fingerprint as dataset_fingerprint
+from mrcnn.feature_cache import FeatureCache
+from mrcnn import training_state
+from mrcnn import weight_archive
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -85,6 +101,25 @@ def compute_backbone_shapes(config, image_shape):
             for stride in config.BACKBONE_STRIDES])
 
 
+def precompute_anchors(config, image_shapes):
+    """Generates the anchors of the given image shapes and saves them in
+    the persistent anchor store (config.ANCHOR_CACHE_DIR), so that training
+    and inference processes started later only need to memory-map them.
+
+    image_shapes: List of [height, width, channels] molded image shapes.
+        For example, [config.IMAGE_SHAPE].
+    """
+    assert config.ANCHOR_CACHE_DIR, "Set ANCHOR_CACHE_DIR in the config."
+    for image_shape in image_shapes:
+        backbone_shapes = compute_backbone_shapes(config, image_shape)
+        utils.load_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   backbone_shapes,
+                                   config.BACKBONE_STRIDES,
+                                   config.RPN_ANCHOR_STRIDE,
+                                   cache_dir=config.ANCHOR_CACHE_DIR)
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -212,43 +247,51 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., (y1, x1, y2, x2)] boxes to update
+    deltas: [..., (dy, dx, log(dh), log(dw))] refinements to apply
+
+    Works on any number of leading dimensions, so a whole batch of
+    boxes, [batch, N, 4], can be refined with one set of ops.
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, (y1, x1, y2, x2)]
-    window: [4] in the form y1, x1, y2, x2
+    boxes: [..., (y1, x1, y2, x2)]
+    window: [4] in the form y1, x1, y2, x2. Or, if boxes is batched
+        as [batch, N, 4], a window per image in the shape [batch, 4].
     """
     # Split
-    wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    window = tf.cast(window, boxes.dtype)
+    if len(window.shape) == 2 and len(boxes.shape) == 3:
+        # One window per image. Add a boxes dimension to broadcast.
+        window = tf.expand_dims(window, 1)
+    wy1, wx1, wy2, wx2 = tf.split(window, 4, axis=-1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
-    clipped.set_shape((clipped.shape[0], 4))
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
+    clipped.set_shape(boxes.shape)
     return clipped
 
 
@@ -258,6 +301,10 @@ class ProposalLayer(KE.Layer):
     non-max suppression to remove overlaps. It also applies bounding
     box refinement deltas to anchors.
 
+    All the steps run on the whole batch at once (batched gathers and,
+    when available, tf.image.combined_non_max_suppression), so the size
+    of the graph doesn't grow with IMAGES_PER_GPU.
+
     Inputs:
         rpn_probs: [batch, num_anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, num_anchors, (dy, dx, log(dh), log(dw))]
@@ -287,45 +334,51 @@ class ProposalLayer(KE.Layer):
         pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        scores = batch_gather_graph(scores, ix)
+        deltas = batch_gather_graph(deltas, ix)
+        pre_nms_anchors = tf.identity(batch_gather_graph(anchors, ix),
+                                      name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = apply_box_deltas_graph(pre_nms_anchors, deltas)
+        boxes = tf.identity(boxes, name="refined_anchors")
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = clip_boxes_graph(boxes, window)
+        boxes = tf.identity(boxes, name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
         # Non-max suppression
-        def nms(boxes, scores):
-            indices = tf.image.non_max_suppression(
-                boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
-            proposals = tf.gather(boxes, indices)
-            # Pad if needed
-            padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
-            proposals = tf.pad(proposals, [(0, padding), (0, 0)])
-            return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        if hasattr(tf.image, "combined_non_max_suppression"):
+            # TF 1.13+: one NMS op for the whole batch. Treat the proposals as
+            # a single class. Results are sorted by score and zero padded.
+            proposals = tf.image.combined_non_max_suppression(
+                tf.expand_dims(boxes, 2), tf.expand_dims(scores, 2),
+                max_output_size_per_class=self.proposal_count,
+                max_total_size=self.proposal_count,
+                iou_threshold=self.nms_threshold,
+                name="rpn_non_max_suppression")[0]
+        else:
+            # Older TF versions. Use a loop (tf.map_fn) rather than unrolling
+            # the graph for each image in the batch.
+            def nms(inputs):
+                boxes, scores = inputs
+                indices = tf.image.non_max_suppression(
+                    boxes, scores, self.proposal_count,
+                    self.nms_threshold, name="rpn_non_max_suppression")
+                proposals = tf.gather(boxes, indices)
+                # Pad if needed
+                padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
+                proposals = tf.pad(proposals, [(0, padding), (0, 0)])
+                proposals.set_shape([self.proposal_count, 4])
+                return proposals
+            proposals = tf.map_fn(nms, [boxes, scores], dtype=tf.float32)
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -346,6 +399,9 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [pool_height, pool_width] of the output pooled regions. Usually [7, 7]
+    - sampling_ratio: Number of bilinear samples per bin along each axis.
+        1 interpolates a single value at each bin center. 2 averages
+        4 samples per bin, as in the Mask R-CNN paper.
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
@@ -361,9 +417,10 @@ class PyramidROIAlign(KE.Layer):
     constructor.
     """
 
-    def __init__(self, pool_shape, **kwargs):
+    def __init__(self, pool_shape, sampling_ratio=1, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
+        self.sampling_ratio = sampling_ratio
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -392,54 +449,50 @@ class PyramidROIAlign(KE.Layer):
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
-        # Loop through levels and apply ROI pooling to each. P2 to P5.
+        # Merge the batch and box dimensions and split the boxes by level
+        # with one partition op. Keep track of the position of each box so
+        # the pooled results can be put back in order with one stitch op,
+        # rather than sorting them.
+        batch_size = tf.shape(boxes)[0]
+        num_boxes = tf.shape(boxes)[1]
+        # Stop gradient propogation to ROI proposals
+        flat_boxes = tf.stop_gradient(tf.reshape(boxes, [-1, 4]))
+        box_indices = tf.reshape(
+            tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, num_boxes]), [-1])
+        box_positions = tf.range(batch_size * num_boxes)
+        partitions = tf.reshape(roi_level, [-1]) - 2
+        level_boxes = tf.dynamic_partition(flat_boxes, partitions, 4)
+        level_box_indices = tf.dynamic_partition(box_indices, partitions, 4)
+        level_positions = tf.dynamic_partition(box_positions, partitions, 4)
+
+        # Crop and Resize
+        # From Mask R-CNN paper: "We sample four regular locations, so
+        # that we can evaluate either max or average pooling. In fact,
+        # interpolating only a single value at each bin center (without
+        # pooling) is nearly as effective."
+        #
+        # With sampling_ratio == 1 we use the simplified approach of a single
+        # value per bin, which is how it's done in tf.crop_and_resize().
+        # Otherwise, crop at sampling_ratio times the pool size and average
+        # the samples that fall in each bin.
+        s = self.sampling_ratio
+        crop_shape = (self.pool_shape[0] * s, self.pool_shape[1] * s)
         pooled = []
-        box_to_level = []
-        for i, level in enumerate(range(2, 6)):
-            ix = tf.where(tf.equal(roi_level, level))
-            level_boxes = tf.gather_nd(boxes, ix)
-
-            # Box indices for crop_and_resize.
-            box_indices = tf.cast(ix[:, 0], tf.int32)
-
-            # Keep track of which box is mapped to which level
-            box_to_level.append(ix)
-
-            # Stop gradient propogation to ROI proposals
-            level_boxes = tf.stop_gradient(level_boxes)
-            box_indices = tf.stop_gradient(box_indices)
-
-            # Crop and Resize
-            # From Mask R-CNN paper: "We sample four regular locations, so
-            # that we can evaluate either max or average pooling. In fact,
-            # interpolating only a single value at each bin center (without
-            # pooling) is nearly as effective."
-            #
-            # Here we use the simplified approach of a single value per bin,
-            # which is how it's done in tf.crop_and_resize()
-            # Result: [batch * num_boxes, pool_height, pool_width, channels]
-            pooled.append(tf.image.crop_and_resize(
-                feature_maps[i], level_boxes, box_indices, self.pool_shape,
-                method="bilinear"))
-
-        # Pack pooled features into one tensor
-        pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        for i in range(4):
+            # Result: [level_boxes, pool_height, pool_width, channels]
+            level_pooled = tf.image.crop_and_resize(
+                feature_maps[i], level_boxes[i],
+                tf.stop_gradient(level_box_indices[i]), crop_shape,
+                method="bilinear")
+            if s > 1:
+                level_pooled = tf.nn.avg_pool(
+                    level_pooled, ksize=[1, s, s, 1], strides=[1, s, s, 1],
+                    padding="VALID")
+            pooled.append(level_pooled)
+
+        # Put pooled features back in the order of the original boxes
+        # Result: [batch * num_boxes, pool_height, pool_width, channels]
+        pooled = tf.dynamic_stitch(level_positions, pooled)
 
         # Re-add the batch dimension
         shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
@@ -457,17 +510,14 @@ class PyramidROIAlign(KE.Layer):
 def overlaps_graph(boxes1, boxes2):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+
+    Returns: [boxes1, boxes2] IoU matrix.
     """
-    # 1. Tile boxes2 and repeat boxes1. This allows us to compare
-    # every boxes1 against every boxes2 without loops.
-    # TF doesn't have an equivalent to np.repeat() so simulate it
-    # using tf.tile() and tf.reshape.
-    b1 = tf.reshape(tf.tile(tf.expand_dims(boxes1, 1),
-                            [1, 1, tf.shape(boxes2)[0]]), [-1, 4])
-    b2 = tf.tile(boxes2, [tf.shape(boxes1)[0], 1])
+    # 1. Compare every boxes1 against every boxes2 by broadcasting
+    # [N, 1] against [1, M]. Only the [N, M] results are materialized.
+    b1_y1, b1_x1, b1_y2, b1_x2 = tf.split(boxes1, 4, axis=1)
+    b2_y1, b2_x1, b2_y2, b2_x2 = tf.split(tf.transpose(boxes2), 4, axis=0)
     # 2. Compute intersections
-    b1_y1, b1_x1, b1_y2, b1_x2 = tf.split(b1, 4, axis=1)
-    b2_y1, b2_x1, b2_y2, b2_x2 = tf.split(b2, 4, axis=1)
     y1 = tf.maximum(b1_y1, b2_y1)
     x1 = tf.maximum(b1_x1, b2_x1)
     y2 = tf.minimum(b1_y2, b2_y2)
@@ -477,9 +527,8 @@ def overlaps_graph(boxes1, boxes2):
     b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
     b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
     union = b1_area + b2_area - intersection
-    # 4. Compute IoU and reshape to [boxes1, boxes2]
-    iou = intersection / union
-    overlaps = tf.reshape(iou, [tf.shape(boxes1)[0], tf.shape(boxes2)[0]])
+    # 4. Compute IoU [boxes1, boxes2]
+    overlaps = intersection / union
     return overlaps
 
 
@@ -495,7 +544,8 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     gt_masks: [height, width, MAX_GT_INSTANCES] of boolean type.
 
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
-    and masks.
+    and masks. With USE_OHEM, there are OHEM_CANDIDATE_ROIS of them instead
+    of TRAIN_ROIS_PER_IMAGE.
     rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized coordinates
     class_ids: [TRAIN_ROIS_PER_IMAGE]. Integer class IDs. Zero padded.
     deltas: [TRAIN_ROIS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
@@ -546,16 +596,25 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     # 2. Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
     negative_indices = tf.where(tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))[:, 0]
 
-    # Subsample ROIs. Aim for 33% positive
-    # Positive ROIs
-    positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
-                         config.ROI_POSITIVE_RATIO)
-    positive_indices = tf.random_shuffle(positive_indices)[:positive_count]
-    positive_count = tf.shape(positive_indices)[0]
-    # Negative ROIs. Add enough to maintain positive:negative ratio.
-    r = 1.0 / config.ROI_POSITIVE_RATIO
-    negative_count = tf.cast(r * tf.cast(positive_count, tf.float32), tf.int32) - positive_count
-    negative_indices = tf.random_shuffle(negative_indices)[:negative_count]
+    if config.USE_OHEM:
+        # Keep up to OHEM_CANDIDATE_ROIS ROIs, without a positive ratio.
+        # OHEMLayer selects the hardest of them after the classifier head.
+        roi_count = config.OHEM_CANDIDATE_ROIS
+        positive_indices = tf.random_shuffle(positive_indices)[:roi_count]
+        positive_count = tf.shape(positive_indices)[0]
+        negative_indices = tf.random_shuffle(negative_indices)[:roi_count - positive_count]
+    else:
+        # Subsample ROIs. Aim for 33% positive
+        # Positive ROIs
+        roi_count = config.TRAIN_ROIS_PER_IMAGE
+        positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
+                             config.ROI_POSITIVE_RATIO)
+        positive_indices = tf.random_shuffle(positive_indices)[:positive_count]
+        positive_count = tf.shape(positive_indices)[0]
+        # Negative ROIs. Add enough to maintain positive:negative ratio.
+        r = 1.0 / config.ROI_POSITIVE_RATIO
+        negative_count = tf.cast(r * tf.cast(positive_count, tf.float32), tf.int32) - positive_count
+        negative_indices = tf.random_shuffle(negative_indices)[:negative_count]
     # Gather selected ROIs
     positive_rois = tf.gather(proposals, positive_indices)
     negative_rois = tf.gather(proposals, negative_indices)
@@ -609,7 +668,7 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     # are not used for negative ROIs with zeros.
     rois = tf.concat([positive_rois, negative_rois], axis=0)
     N = tf.shape(negative_rois)[0]
-    P = tf.maximum(config.TRAIN_ROIS_PER_IMAGE - tf.shape(rois)[0], 0)
+    P = tf.maximum(roi_count - tf.shape(rois)[0], 0)
     rois = tf.pad(rois, [(0, P), (0, 0)])
     roi_gt_boxes = tf.pad(roi_gt_boxes, [(0, N + P), (0, 0)])
     roi_gt_class_ids = tf.pad(roi_gt_class_ids, [(0, N + P)])
@@ -665,11 +724,13 @@ class DetectionTargetLayer(KE.Layer):
         return outputs
 
     def compute_output_shape(self, input_shape):
+        roi_count = self.config.OHEM_CANDIDATE_ROIS if self.config.USE_OHEM \
+            else self.config.TRAIN_ROIS_PER_IMAGE
         return [
-            (None, self.config.TRAIN_ROIS_PER_IMAGE, 4),  # rois
-            (None, self.config.TRAIN_ROIS_PER_IMAGE),  # class_ids
-            (None, self.config.TRAIN_ROIS_PER_IMAGE, 4),  # deltas
-            (None, self.config.TRAIN_ROIS_PER_IMAGE, self.config.MASK_SHAPE[0],
+            (None, roi_count, 4),  # rois
+            (None, roi_count),  # class_ids
+            (None, roi_count, 4),  # deltas
+            (None, roi_count, self.config.MASK_SHAPE[0],
              self.config.MASK_SHAPE[1])  # masks
         ]
 
@@ -677,34 +738,120 @@ class DetectionTargetLayer(KE.Layer):
         return [None, None, None, None]
 
 
+def ohem_graph(rois, target_class_ids, target_bbox, target_mask,
+               class_logits, class_probs, bbox, config):
+    """Selects the hard examples of one image for online hard example
+    mining (OHEM).
+
+    Ranks the candidate ROIs by their classifier and box refinement loss,
+    removes ROIs that overlap a harder one by more than OHEM_NMS_THRESHOLD,
+    and keeps the TRAIN_ROIS_PER_IMAGE hardest.
+
+    Inputs: [num_candidates, ...] outputs of detection_targets_graph() and
+    of the classifier head.
+
+    Returns the same tensors with the selected ROIs only, hardest first and
+    zero padded to TRAIN_ROIS_PER_IMAGE.
+    """
+    # Loss of each ROI. It only ranks the ROIs, so it has no gradient.
+    class_ids = tf.cast(target_class_ids, tf.int32)
+    class_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=class_ids, logits=tf.stop_gradient(class_logits))
+    indices = tf.stack([tf.range(tf.shape(class_ids)[0]), class_ids], axis=1)
+    pred_bbox = tf.gather_nd(tf.stop_gradient(bbox), indices)
+    bbox_loss = tf.reduce_sum(smooth_l1_loss(target_bbox, pred_bbox), axis=1)
+    # Only positive ROIs have box targets
+    loss = class_loss + bbox_loss * tf.cast(class_ids > 0, tf.float32)
+
+    # Skip the zero padding. NMS returns the ROIs hardest first.
+    valid = tf.where(tf.reduce_sum(tf.abs(rois), axis=1) > 0)[:, 0]
+    keep = tf.image.non_max_suppression(
+        tf.gather(rois, valid), tf.gather(loss, valid),
+        config.TRAIN_ROIS_PER_IMAGE, iou_threshold=config.OHEM_NMS_THRESHOLD)
+    keep = tf.gather(valid, keep)
+
+    # Gradients flow back through the selected ROIs only
+    P = config.TRAIN_ROIS_PER_IMAGE - tf.shape(keep)[0]
+    outputs = []
+    for t in [rois, target_class_ids, target_bbox, target_mask,
+              class_logits, class_probs, bbox]:
+        t = tf.gather(t, keep)
+        outputs.append(tf.pad(t, [(0, P)] + [(0, 0)] * (len(t.shape) - 1)))
+    return outputs
+
+
+class OHEMLayer(KE.Layer):
+    """Online hard example mining. Keeps the TRAIN_ROIS_PER_IMAGE candidate
+    ROIs with the highest loss, so that the losses, and the mask head, only
+    see those. See ohem_graph() and config.USE_OHEM.
+
+    Inputs:
+    rois: [batch, OHEM_CANDIDATE_ROIS, (y1, x1, y2, x2)] in normalized
+          coordinates
+    target_class_ids: [batch, OHEM_CANDIDATE_ROIS]. Integer class IDs.
+    target_bbox: [batch, OHEM_CANDIDATE_ROIS, (dy, dx, log(dh), log(dw)]
+    target_mask: [batch, OHEM_CANDIDATE_ROIS, height, width]
+    mrcnn_class_logits: [batch, OHEM_CANDIDATE_ROIS, NUM_CLASSES]
+    mrcnn_class: [batch, OHEM_CANDIDATE_ROIS, NUM_CLASSES]
+    mrcnn_bbox: [batch, OHEM_CANDIDATE_ROIS, NUM_CLASSES, (dy, dx, log(dh), log(dw))]
+
+    Returns: The same tensors, with TRAIN_ROIS_PER_IMAGE ROIs.
+    """
+
+    def __init__(self, config, **kwargs):
+        super(OHEMLayer, self).__init__(**kwargs)
+        self.config = config
+
+    def call(self, inputs):
+        names = ["ohem_rois", "ohem_class_ids", "ohem_bbox", "ohem_mask",
+                 "ohem_class_logits", "ohem_class", "ohem_pred_bbox"]
+        return utils.batch_slice(
+            list(inputs), lambda *x: ohem_graph(*x, config=self.config),
+            self.config.IMAGES_PER_GPU, names=names)
+
+    def compute_output_shape(self, input_shape):
+        return [(s[0], self.config.TRAIN_ROIS_PER_IMAGE) + tuple(s[2:])
+                for s in input_shape]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None] * len(inputs)
+
+
 ############################################################
 #  Detection Layer
 ############################################################
 
 def refine_detections_graph(rois, probs, deltas, window, feature_maps, config):
     """Refine classified proposals and filter overlaps and return final
-    detections.
+    detections. Runs on the whole batch at once.
 
     Inputs:
-        rois: [N, (y1, x1, y2, x2)] in normalized coordinates
-        probs: [N, num_classes]. Class probabilities.
-        deltas: [N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
+        rois: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+        probs: [batch, N, num_classes]. Class probabilities.
+        deltas: [batch, N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
                 bounding box deltas.
-        window: (y1, x1, y2, x2) in normalized coordinates. The part of the image
-            that contains the image excluding the padding.
-
-    Returns detections shaped: [num_detections, (y1, x1, y2, x2, class_id, score)] where
-        coordinates are normalized.
+        window: [batch, (y1, x1, y2, x2)] in normalized coordinates. The part of
+            each image that contains the image excluding the padding.
+        feature_maps: [batch, N, fc_layers_size] Shared classifier features
+            of each ROI. Appended to the detections.
+
+    Returns detections shaped:
+        [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score, features)]
+        where coordinates are normalized. Zero padded.
     """
     # Class IDs per ROI
-    class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
+    class_ids = tf.argmax(probs, axis=2, output_type=tf.int32)
     # Class probability of the top class of each ROI
-    indices = tf.stack([tf.range(probs.shape[0]), class_ids], axis=1)
+    batch_size = tf.shape(probs)[0]
+    num_rois = tf.shape(probs)[1]
+    batch_ix = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, num_rois])
+    roi_ix = tf.tile(tf.expand_dims(tf.range(num_rois), 0), [batch_size, 1])
+    indices = tf.stack([batch_ix, roi_ix, class_ids], axis=2)
     class_scores = tf.gather_nd(probs, indices)
     # Class-specific bounding box deltas
     deltas_specific = tf.gather_nd(deltas, indices)
     # Apply bounding box deltas
-    # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
+    # Shape: [batch, boxes, (y1, x1, y2, x2)] in normalized coordinates
     refined_rois = apply_box_deltas_graph(
         rois, deltas_specific * config.BBOX_STD_DEV)
     # Clip boxes to image window
@@ -713,33 +860,33 @@ def refine_detections_graph(rois, probs, deltas, window, feature_maps, config):
     # TODO: Filter out boxes with zero area
 
     # Filter out background boxes
-    keep = tf.where(class_ids > 0)[:, 0]
+    keep = class_ids > 0
     # Filter out low confidence boxes
     if config.DETECTION_MIN_CONFIDENCE:
-        conf_keep = tf.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[:, 0]
-        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                        tf.expand_dims(conf_keep, 0))
-        keep = tf.sparse_tensor_to_dense(keep)[0]
+        keep = tf.logical_and(
+            keep, class_scores >= config.DETECTION_MIN_CONFIDENCE)
 
     # Apply per-class NMS
-    # 1. Prepare variables
-    pre_nms_class_ids = tf.gather(class_ids, keep)
-    pre_nms_scores = tf.gather(class_scores, keep)
-    pre_nms_rois = tf.gather(refined_rois,   keep)
-    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
-
-    def nms_keep_map(class_id):
-        """Apply Non-Maximum Suppression on ROIs of the given class."""
-        # Indices of ROIs of the given class
-        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
-        # Apply NMS
+    # Shift the boxes of each class to a separate region so that boxes of
+    # different classes never overlap. Then one NMS call per image handles
+    # all classes. Boxes are clipped to the 0..1 range, so an offset of 2
+    # per class is enough.
+    class_offsets = tf.expand_dims(tf.cast(class_ids, tf.float32) * 2.0, 2)
+    nms_rois = refined_rois + class_offsets
+
+    def nms_keep_map(inputs):
+        """Apply Non-Maximum Suppression on the ROIs of one image."""
+        boxes, scores, keep = inputs
+        # Indices of ROIs that passed the filters above
+        ixs = tf.where(keep)[:, 0]
+        # Apply NMS. Results are sorted by score.
         class_keep = tf.image.non_max_suppression(
-                tf.gather(pre_nms_rois, ixs),
-                tf.gather(pre_nms_scores, ixs),
+                tf.gather(boxes, ixs),
+                tf.gather(scores, ixs),
                 max_output_size=config.DETECTION_MAX_INSTANCES,
                 iou_threshold=config.DETECTION_NMS_THRESHOLD)
         # Map indices
-        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
+        class_keep = tf.cast(tf.gather(ixs, class_keep), tf.int32)
         # Pad with -1 so returned tensors have the same shape
         gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
         class_keep = tf.pad(class_keep, [(0, gap)],
@@ -748,36 +895,21 @@ def refine_detections_graph(rois, probs, deltas, window, feature_maps, config):
         class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
         return class_keep
 
-    # 2. Map over class IDs
-    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
-                         dtype=tf.int64)
-    # 3. Merge results into one list, and remove -1 padding
-    nms_keep = tf.reshape(nms_keep, [-1])
-    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
-    # 4. Compute intersection between keep and nms_keep
-    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                    tf.expand_dims(nms_keep, 0))
-    keep = tf.sparse_tensor_to_dense(keep)[0]
-    # Keep top detections
-    roi_count = config.DETECTION_MAX_INSTANCES
-    class_scores_keep = tf.gather(class_scores, keep)
-    num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
-    top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
-    keep = tf.gather(keep, top_ids)
-
-    # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
-    # Coordinates are normalized.
-    detections = tf.concat([
-        tf.gather(refined_rois, keep),
-        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
-        tf.gather(class_scores, keep)[..., tf.newaxis],
-        tf.gather(feature_maps, keep)
-        ], axis=1)
+    # [batch, DETECTION_MAX_INSTANCES] indices of the kept ROIs, -1 padded
+    nms_keep = tf.map_fn(nms_keep_map, [nms_rois, class_scores, keep],
+                         dtype=tf.int32)
+    valid = tf.cast(nms_keep > -1, tf.float32)[..., tf.newaxis]
+    nms_keep = tf.maximum(nms_keep, 0)
 
-    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
-    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
-    return detections
+    # Arrange output as [batch, N, (y1, x1, y2, x2, class_id, score, features)]
+    # Coordinates are normalized. Padding rows are zeroed out.
+    detections = tf.concat([
+        batch_gather_graph(refined_rois, nms_keep),
+        tf.to_float(batch_gather_graph(class_ids, nms_keep))[..., tf.newaxis],
+        batch_gather_graph(class_scores, nms_keep)[..., tf.newaxis],
+        batch_gather_graph(feature_maps, nms_keep)
+        ], axis=2)
+    return detections * valid
 
 
 class DetectionLayer(KE.Layer):
@@ -785,8 +917,8 @@ class DetectionLayer(KE.Layer):
     returns the final detection boxes.
 
     Returns:
-    [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] where
-    coordinates are normalized.
+    [batch, num_detections, (y1, x1, y2, x2, class_id, class_score, features)]
+    where coordinates are normalized.
     """
 
     def __init__(self, config=None, **kwargs):
@@ -808,18 +940,16 @@ class DetectionLayer(KE.Layer):
         image_shape = m['image_shape'][0]
         window = norm_boxes_graph(m['window'], image_shape[:2])
 
-        # Run detection refinement graph on each item in the batch
-        detections_batch = utils.batch_slice(
-            [rois, mrcnn_class, mrcnn_bbox, window, feature_maps],
-            lambda x, y, w, z, f: refine_detections_graph(x, y, w, z, f, self.config),
-            self.config.IMAGES_PER_GPU)
+        # Run detection refinement graph on the whole batch
+        detections_batch = refine_detections_graph(
+            rois, mrcnn_class, mrcnn_bbox, window, feature_maps, self.config)
 
-        # Reshape output
-        # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
-        # normalized coordinates
+        # Reshape output to set the static shape
+        # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score, features)]
+        # in normalized coordinates
         return tf.reshape(
             detections_batch,
-            [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6 + self.config.FPN_CLASSIF_FC_LAYERS_SIZE])
+            [-1, self.config.DETECTION_MAX_INSTANCES, 6 + self.config.FPN_CLASSIF_FC_LAYERS_SIZE])
 
     def compute_output_shape(self, input_shape):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6 + self.config.FPN_CLASSIF_FC_LAYERS_SIZE)
@@ -895,13 +1025,111 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
     return KM.Model([input_feature_map], outputs, name="rpn_model")
 
 
+def generate_anchors_graph(scales, ratios, shape, feature_stride, anchor_stride):
+    """TF version of utils.generate_anchors(). Generates the anchors of one
+    feature map in the same order: by position (rows, then columns) and then
+    by ratio.
+
+    scales: 1D array of anchor sizes in pixels. Example: [32, 64, 128]
+    ratios: 1D array of anchor ratios of width/height. Example: [0.5, 1, 2]
+    shape: [height, width] int32 tensor. Spatial shape of the feature map.
+    feature_stride: Stride of the feature map relative to the image in pixels.
+    anchor_stride: Stride of anchors on the feature map.
+
+    Returns: [anchors, (y1, x1, y2, x2)] in pixel coordinates.
+    """
+    # Heights and widths don't depend on the feature map size, so they're
+    # computed once in numpy. [anchors per location, (height, width)]
+    scales, ratios = np.meshgrid(np.array(scales), np.array(ratios))
+    scales = scales.flatten()
+    ratios = ratios.flatten()
+    sizes = np.stack([scales / np.sqrt(ratios), scales * np.sqrt(ratios)], axis=1)
+    sizes = tf.constant(sizes, dtype=tf.float32)
+
+    # Centers of the anchors. [positions, (y, x)]
+    shifts_y = tf.cast(tf.range(0, shape[0], anchor_stride) * feature_stride, tf.float32)
+    shifts_x = tf.cast(tf.range(0, shape[1], anchor_stride) * feature_stride, tf.float32)
+    shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+    centers = tf.stack([tf.reshape(shifts_y, [-1]), tf.reshape(shifts_x, [-1])], axis=1)
+
+    # All combinations of centers and sizes. [positions, anchors per location, 4]
+    centers = tf.expand_dims(centers, 1)
+    boxes = tf.concat([centers - 0.5 * sizes, centers + 0.5 * sizes], axis=2)
+    return tf.reshape(boxes, [-1, 4])
+
+
+class AnchorsLayer(KE.Layer):
+    """Generates the anchor pyramid inside the graph, so it doesn't have to
+    be computed on the host and fed with every batch.
+
+    If the image size is known when the graph is built (either passed as
+    image_shape or as the static shape of the input image), the anchors are
+    generated once in numpy and embedded as a constant. Otherwise they're
+    derived from the shapes of the feature maps on each run, which lets the
+    model accept any image size.
+
+    Inputs:
+        image: [batch, height, width, channels] the molded input images
+        feature_maps: List of RPN feature maps, one per level, in the order of
+                      config.BACKBONE_STRIDES. [batch, height, width, channels]
+
+    Returns:
+        [batch, num_anchors, (y1, x1, y2, x2)] anchors in normalized coordinates
+    """
+
+    def __init__(self, config, image_shape=None, **kwargs):
+        super(AnchorsLayer, self).__init__(**kwargs)
+        self.config = config
+        self.image_shape = image_shape
+
+    def call(self, inputs):
+        image = inputs[0]
+        feature_maps = inputs[1:]
+        batch_size = tf.shape(image)[0]
+
+        image_shape = self.image_shape
+        if image_shape is None and None not in K.int_shape(image)[1:3]:
+            image_shape = K.int_shape(image)[1:3]
+        if image_shape is not None:
+            # Static size. Anchors are a constant (memoized in utils).
+            backbone_shapes = compute_backbone_shapes(self.config, image_shape)
+            anchors = utils.load_pyramid_anchors(
+                self.config.RPN_ANCHOR_SCALES,
+                self.config.RPN_ANCHOR_RATIOS,
+                backbone_shapes,
+                self.config.BACKBONE_STRIDES,
+                self.config.RPN_ANCHOR_STRIDE,
+                cache_dir=self.config.ANCHOR_CACHE_DIR)
+            anchors = utils.norm_boxes(anchors, image_shape[:2]).astype(np.float32)
+            anchors = tf.constant(anchors)
+        else:
+            # Dynamic size. Derive the anchors from the feature map shapes.
+            anchors = []
+            for i, feature_map in enumerate(feature_maps):
+                anchors.append(generate_anchors_graph(
+                    self.config.RPN_ANCHOR_SCALES[i],
+                    self.config.RPN_ANCHOR_RATIOS,
+                    tf.shape(feature_map)[1:3],
+                    self.config.BACKBONE_STRIDES[i],
+                    self.config.RPN_ANCHOR_STRIDE))
+            anchors = tf.concat(anchors, axis=0)
+            anchors = norm_boxes_graph(anchors, tf.shape(image)[1:3])
+
+        # Duplicate across the batch dimension
+        anchors = tf.tile(tf.expand_dims(anchors, 0), [batch_size, 1, 1])
+        return tf.stop_gradient(anchors)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0][0], None, 4)
+
+
 ############################################################
 #  Feature Pyramid Network Heads
 ############################################################
 
 def fpn_classifier_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True,
-                         fc_layers_size=1024):
+                         fc_layers_size=1024, sampling_ratio=1):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -914,6 +1142,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
     fc_layers_size: Size of the 2 FC layers
+    sampling_ratio: Bilinear samples per bin and axis in ROIAlign.
 
     Returns:
         logits: [batch, num_rois, NUM_CLASSES] classifier logits (before softmax)
@@ -923,7 +1152,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     """
     # ROI Pooling
     # Shape: [batch, num_rois, POOL_SIZE, POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
+    x = PyramidROIAlign([pool_size, pool_size], sampling_ratio=sampling_ratio,
                         name="roi_align_classifier")([rois, image_meta] + feature_maps)
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
@@ -956,7 +1185,8 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
 
 
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
-                         pool_size, num_classes, train_bn=True):
+                         pool_size, num_classes, train_bn=True,
+                         sampling_ratio=1):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
@@ -967,12 +1197,13 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
+    sampling_ratio: Bilinear samples per bin and axis in ROIAlign.
 
     Returns: Masks [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, NUM_CLASSES]
     """
     # ROI Pooling
     # Shape: [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
+    x = PyramidROIAlign([pool_size, pool_size], sampling_ratio=sampling_ratio,
                         name="roi_align_mask")([rois, image_meta] + feature_maps)
 
     # Conv layers
@@ -1185,20 +1416,43 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 #  Data Generator
 ############################################################
 
+# imgaug augmenters that are safe to apply to masks
+# Some, such as Affine, have settings that make them unsafe, so always
+# test your augmentation on masks
+MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
+                   "Fliplr", "Flipud", "CropAndPad",
+                   "Affine", "PiecewiseAffine"]
+
+
+def _imgaug_mask_hook(images, augmenter, parents, default):
+    """Determines which imgaug augmenters to apply to masks."""
+    return augmenter.__class__.__name__ in MASK_AUGMENTERS
+
+
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
-                  use_mini_mask=False):
+                  use_mini_mask=False, compact_masks=False, sample_cache=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: (deprecated. Use augmentation instead). If true, apply random
         image augmentation. Currently, only horizontal flipping is offered.
     augmentation: Optional. An imgaug (https://github.com/aleju/imgaug) augmentation.
         For example, passing imgaug.augmenters.Fliplr(0.5) flips images
-        right/left 50% of the time.
+        right/left 50% of the time. Or an augmentation.BatchAugmenter,
+        which transforms the boxes and compact masks directly.
     use_mini_mask: If False, returns full-size masks that are the same height
         and width as the original image. These can be big, for example
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    compact_masks: If True, masks are loaded with Dataset.load_compact_mask()
+        and kept as utils.CompactMasks (bitmaps of the instance boxes only)
+        through resizing and flipping. Unless use_mini_mask is True, the
+        returned mask is a CompactMasks; call to_dense() to get the array.
+        imgaug augmentations still need dense masks, so they're converted
+        back and forth around it.
+    sample_cache: Optional sample_cache.SampleCache of the dataset. If given,
+        the resized image and masks are read from it instead of being loaded
+        and resized again. Implies compact_masks.
 
     Returns:
     image: [height, width, 3]
@@ -1209,17 +1463,40 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    original_shape = image.shape
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    # Active classes
+    # Different datasets have different classes, so track the
+    # classes supported in the dataset of this image.
+    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
+    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
+    active_class_ids[source_class_ids] = 1
+
+    if sample_cache is not None:
+        # Load the resized image and masks from the cache
+        compact_masks = True
+        sample = sample_cache.load(image_id)
+        image, mask, class_ids = sample["image"], sample["masks"], sample["class_ids"]
+        original_shape = sample["original_shape"]
+        window, scale = sample["window"], sample["scale"]
+        if not augment and not augmentation and \
+                (not use_mini_mask or sample["mini_masks"] is not None):
+            # Nothing changes after this point. Use the cached results.
+            image_meta = compose_image_meta(image_id, original_shape, image.shape,
+                                            window, scale, active_class_ids)
+            mask = sample["mini_masks"] if use_mini_mask else mask
+            return image, image_meta, class_ids, sample["bbox"], mask
+    else:
+        # Load image and mask
+        image = dataset.load_image(image_id)
+        if compact_masks:
+            mask, class_ids = dataset.load_compact_mask(image_id)
+        else:
+            mask, class_ids = dataset.load_mask(image_id)
+        original_shape = image.shape
+        image, window, scale, padding, crop = utils.resize_training_image(image, config)
+        if compact_masks:
+            mask = mask.resize(scale, padding, crop)
+        else:
+            mask = utils.resize_mask(mask, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -1227,23 +1504,24 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         logging.warning("'augment' is deprecated. Use 'augmentation' instead.")
         if random.randint(0, 1):
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            mask = mask.fliplr() if compact_masks else np.fliplr(mask)
 
-    # Augmentation
-    # This requires the imgaug lib (https://github.com/aleju/imgaug)
-    if augmentation:
-        import imgaug
+    # Boxes of the masks. Only known here if they come from the cache.
+    bbox = None
 
-        # Augmenters that are safe to apply to masks
-        # Some, such as Affine, have settings that make them unsafe, so always
-        # test your augmentation on masks
-        MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
-                           "Fliplr", "Flipud", "CropAndPad",
-                           "Affine", "PiecewiseAffine"]
+    # Batched augmentation, applied to a batch of one
+    if isinstance(augmentation, BatchAugmenter):
+        if not compact_masks:
+            mask = utils.CompactMasks.from_dense(mask)
+        [image], [mask], [bbox] = augmentation.augment([image], [mask])
+        if not compact_masks:
+            mask = mask.to_dense()
 
-        def hook(images, augmenter, parents, default):
-            """Determines which augmenters to apply to masks."""
-            return augmenter.__class__.__name__ in MASK_AUGMENTERS
+    # imgaug augmentation
+    # This requires the imgaug lib (https://github.com/aleju/imgaug)
+    elif augmentation:
+        if compact_masks:
+            mask = mask.to_dense()
 
         # Store shapes before augmentation to compare
         image_shape = image.shape
@@ -1253,33 +1531,38 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         image = det.augment_image(image)
         # Change mask to np.uint8 because imgaug doesn't support np.bool
         mask = det.augment_image(mask.astype(np.uint8),
-                                 hooks=imgaug.HooksImages(activator=hook))
+                                 hooks=imgaug.HooksImages(activator=_imgaug_mask_hook))
         # Verify that shapes didn't change
         assert image.shape == image_shape, "Augmentation shouldn't change image size"
         assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
         # Change mask back to bool
         mask = mask.astype(np.bool)
+        if compact_masks:
+            mask = utils.CompactMasks.from_dense(mask)
 
     # Note that some boxes might be all zeros if the corresponding mask got cropped out.
     # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
+    if compact_masks:
+        _idx = mask.areas() > 0
+        mask = mask.select(_idx)
+    else:
+        _idx = np.sum(mask, axis=(0, 1)) > 0
+        mask = mask[:, :, _idx]
     class_ids = class_ids[_idx]
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
-
-    # Active classes
-    # Different datasets have different classes, so track the
-    # classes supported in the dataset of this image.
-    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
-    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
-    active_class_ids[source_class_ids] = 1
+    if bbox is not None:
+        bbox = bbox[_idx]
+    else:
+        bbox = mask.extract_bboxes() if compact_masks else utils.extract_bboxes(mask)
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        if compact_masks:
+            mask = mask.minimize(bbox, config.MINI_MASK_SHAPE)
+        else:
+            mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
@@ -1326,18 +1609,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1444,44 +1717,62 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional utils.BoxIndex of the anchors. Built here if not
+        given, but it's the same for all images, so pass it in when
+        processing many images.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    if anchor_index is None:
+        anchor_index = utils.BoxIndex(anchors)
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), dtype=np.float32)
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
     crowd_ix = np.where(gt_class_ids < 0)[0]
+    no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
     if crowd_ix.shape[0] > 0:
         # Filter out crowds from ground truth class IDs and boxes
         non_crowd_ix = np.where(gt_class_ids > 0)[0]
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
-    else:
-        # All anchors don't intersect a crowd
-        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
-
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+        # Compute overlaps with crowd boxes [anchors, crowds]. The anchors
+        # with an entry overlap a crowd with an IoU >= 0.001.
+        crowd_overlaps = utils.compute_overlaps_sparse(
+            anchors, crowd_boxes, 0.001, index=anchor_index)
+        no_crowd_bool = np.diff(crowd_overlaps.indptr) == 0
+
+    # Compute overlaps [num_anchors, num_gt_boxes] in CSR form. An anchor
+    # that can't reach an IoU of 0.3 with any GT box is negative, unless
+    # it's the best anchor of a GT box, so only the pairs >= 0.3 are kept.
+    overlaps = utils.compute_overlaps_sparse(anchors, gt_boxes, 0.3, index=anchor_index)
+    # Best IoU of each anchor and its GT box. Exact for the anchors with an
+    # entry, 0 for the others.
+    anchor_iou_max, anchor_iou_argmax = utils.sparse_row_max(overlaps)
+    gt_iou_max = np.zeros([gt_boxes.shape[0]])
+    np.maximum.at(gt_iou_max, overlaps.indices, overlaps.data)
+    # The best anchors of the GT boxes below 0.3 aren't in the matrix. Get
+    # all the anchors that overlap them.
+    weak = np.where(gt_iou_max < 0.3)[0]
+    weak_overlaps = utils.compute_overlaps_sparse(
+        anchors, gt_boxes[weak], index=anchor_index)
+    np.maximum.at(gt_iou_max, weak[weak_overlaps.indices], weak_overlaps.data)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1493,13 +1784,22 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:,0]
-    rpn_match[gt_iou_argmax] = 1
+    rpn_match[utils.sparse_argmax_rows(overlaps, gt_iou_max)] = 1
+    weak_best = utils.sparse_argmax_rows(weak_overlaps, gt_iou_max[weak])
+    if weak_best.shape[0] > 0:
+        rpn_match[weak_best] = 1
+        # Their other GT boxes can be below 0.3 too. Get their full rows
+        # for the deltas.
+        weak_rows = utils.compute_overlaps(anchors[weak_best], gt_boxes)
+        anchor_iou_max[weak_best] = np.max(weak_rows, axis=1)
+        anchor_iou_argmax[weak_best] = np.argmax(weak_rows, axis=1)
+    if np.any(gt_iou_max == 0):
+        # A GT box that no anchor overlaps. As with the full matrix, all
+        # the anchors tie for it.
+        rpn_match[:] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
@@ -1521,36 +1821,15 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes (closest GT box, it might have
+    # IoU < 0.7).
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
+    if ids.shape[0] > 0:
+        deltas = utils.box_refinement(anchors[ids],
+                                      gt_boxes[anchor_iou_argmax[ids]])
         # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+        rpn_bbox[:ids.shape[0]] = deltas / np.array(config.RPN_BBOX_STD_DEV,
+                                                    dtype=np.float32)
 
     return rpn_match, rpn_bbox
 
@@ -1629,9 +1908,51 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+def subsample_instances(gt_class_ids, gt_boxes, gt_masks, max_instances):
+    """Picks a random subset of max_instances instances if an image has more
+    than that. Returns gt_class_ids, gt_boxes and gt_masks unchanged
+    otherwise.
+
+    gt_masks: [height, width, instances] or utils.CompactMasks
+    """
+    if gt_boxes.shape[0] <= max_instances:
+        return gt_class_ids, gt_boxes, gt_masks
+    ids = np.random.choice(
+        np.arange(gt_boxes.shape[0]), max_instances, replace=False)
+    if isinstance(gt_masks, utils.CompactMasks):
+        gt_masks = gt_masks.select(ids)
+    else:
+        gt_masks = gt_masks[:, :, ids]
+    return gt_class_ids[ids], gt_boxes[ids], gt_masks
+
+
+def stack_gt_masks(masks):
+    """Stacks the GT masks of the images of a batch into one bool array.
+
+    masks: List of [height, width, instances] arrays or utils.CompactMasks,
+        one per image, all with the same height and width.
+
+    Returns: [batch, height, width, instances] with as many instance slots
+        as the image with the most instances needs (at least 1). The unused
+        slots are zeros.
+    """
+    mask_shape = tuple(masks[0].shape[:2])
+    counts = [len(m) if isinstance(m, utils.CompactMasks) else m.shape[-1]
+              for m in masks]
+    stacked = np.zeros((len(masks),) + mask_shape + (max(max(counts), 1),),
+                       dtype=bool)
+    for i, m in enumerate(masks):
+        if isinstance(m, utils.CompactMasks):
+            m.to_dense(out=stacked[i])
+        else:
+            stacked[i, :, :, :m.shape[-1]] = m
+    return stacked
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, compact_masks=True,
+                   sample_cache=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1642,7 +1963,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
         image augmentation. Currently, only horizontal flipping is offered.
     augmentation: Optional. An imgaug (https://github.com/aleju/imgaug) augmentation.
         For example, passing imgaug.augmenters.Fliplr(0.5) flips images
-        right/left 50% of the time.
+        right/left 50% of the time. Or an augmentation.BatchAugmenter,
+        which transforms the boxes and compact masks directly.
     random_rois: If > 0 then generate proposals to be used to train the
                  network classifier and mask heads. Useful if training
                  the Mask RCNN part without the RPN.
@@ -1653,6 +1975,10 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    compact_masks: If True, GT masks are kept as utils.CompactMasks until
+        the batch is assembled. See load_image_gt().
+    sample_cache: Optional sample_cache.SampleCache of the dataset to read
+        preprocessed images and masks from. See load_image_gt().
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -1664,9 +1990,10 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     - rpn_bbox: [batch, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     - gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs
     - gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)]
-    - gt_masks: [batch, height, width, MAX_GT_INSTANCES]. The height and width
+    - gt_masks: [batch, height, width, instances]. The height and width
                 are those of the image unless use_mini_mask is True, in which
-                case they are defined in MINI_MASK_SHAPE.
+                case they are defined in MINI_MASK_SHAPE. instances is the
+                largest instance count of the batch (at most MAX_GT_INSTANCES).
 
     outputs list: Usually empty in regular training. But if detection_targets
         is True then the outputs list contains target class_ids, bbox deltas,
@@ -1681,11 +2008,14 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
     backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = utils.load_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                         config.RPN_ANCHOR_RATIOS,
+                                         backbone_shapes,
+                                         config.BACKBONE_STRIDES,
+                                         config.RPN_ANCHOR_STRIDE,
+                                         cache_dir=config.ANCHOR_CACHE_DIR)
+    # Spatial index of the anchors, shared by all the images
+    anchor_index = utils.BoxIndex(anchors)
 
     # Keras requires a generator to run indefinitely.
     while True:
@@ -1703,12 +2033,16 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
                 load_image_gt(dataset, config, image_id, augment=augment,
                               augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
+                              use_mini_mask=config.USE_MINI_MASK,
+                              compact_masks=compact_masks,
+                              sample_cache=sample_cache)
             else:
                 image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
                     load_image_gt(dataset, config, image_id, augment=augment,
                                 augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
+                                use_mini_mask=config.USE_MINI_MASK,
+                                compact_masks=compact_masks,
+                                sample_cache=sample_cache)
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
@@ -1718,7 +2052,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # RPN Targets
             rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+                                                    gt_class_ids, gt_boxes, config,
+                                                    anchor_index=anchor_index)
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1727,7 +2062,9 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 if detection_targets:
                     rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
                         build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
+                            rpn_rois, gt_class_ids, gt_boxes,
+                            gt_masks.to_dense() if isinstance(gt_masks, utils.CompactMasks)
+                            else gt_masks, config)
 
             # Init batch arrays
             if b == 0:
@@ -1743,9 +2080,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                     (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
                 batch_gt_boxes = np.zeros(
                     (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
+                # Masks are densified when the batch is full
+                batch_gt_masks = []
                 if random_rois:
                     batch_rpn_rois = np.zeros(
                         (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
@@ -1760,12 +2096,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                             (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
 
             # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
+            gt_class_ids, gt_boxes, gt_masks = subsample_instances(
+                gt_class_ids, gt_boxes, gt_masks, config.MAX_GT_INSTANCES)
 
             # Add to batch
             batch_image_meta[b] = image_meta
@@ -1774,7 +2106,7 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
             batch_images[b] = mold_image(image.astype(np.float32), config)
             batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
             batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
+            batch_gt_masks.append(gt_masks)
             if random_rois:
                 batch_rpn_rois[b] = rpn_rois
                 if detection_targets:
@@ -1787,7 +2119,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
             # Batch full?
             if b >= batch_size:
                 inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
+                          batch_gt_class_ids, batch_gt_boxes,
+                          stack_gt_masks(batch_gt_masks)]
                 outputs = []
 
                 if random_rois:
@@ -1815,6 +2148,482 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+def original_image_shape(dataset, image_id):
+    """Returns the (height, width) of an image of a dataset, from its
+    "height" and "width" info if it has them, or by loading the image.
+    """
+    info = dataset.image_info[image_id]
+    if "height" in info and "width" in info:
+        return info["height"], info["width"]
+    return dataset.load_image(image_id).shape[:2]
+
+
+class TrainingSequence(keras.utils.Sequence):
+    """Training batches addressed by index, as a keras.utils.Sequence.
+
+    Unlike data_generator(), which each worker process iterates with its
+    own shuffle, a batch is a pure function of (seed, epoch, index): the
+    image order of an epoch is a permutation seeded with (seed, epoch), and
+    the random state (NumPy, random, the imgaug augmentation and the
+    BatchAugmenter parameters) is reseeded for every image from its
+    position in that order. So the index space can be split between any
+    number of processes without duplicating or missing samples, and a run
+    is reproducible. See data_loader.ShardedLoader.
+
+    With config.TRAIN_BUCKETS, the images are grouped by the bucket their
+    aspect ratio selects and each batch is made of images of one bucket.
+    The batches of all buckets are shuffled together.
+
+    The batches are the inputs of the training model, the same as those of
+    data_generator() without random_rois and detection_targets.
+
+    dataset, config, augmentation, no_augmentation_sources, sample_cache:
+        See data_generator().
+    shuffle: If True, each epoch uses a different image order.
+    seed: Base seed of the image orders and of the per-image random state.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augmentation=None,
+                 no_augmentation_sources=None, batch_size=1,
+                 sample_cache=None, seed=0):
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.no_augmentation_sources = no_augmentation_sources or []
+        self.batch_size = batch_size
+        self.sample_cache = sample_cache
+        self.seed = seed
+        self.error_count = 0
+
+        # Image IDs of each bucket and the molded shape of its images
+        image_ids = np.copy(dataset.image_ids)
+        if config.TRAIN_BUCKETS:
+            buckets = [tuple(b) for b in config.TRAIN_BUCKETS]
+            selected = np.array([
+                buckets.index(utils.select_bucket(original_image_shape(dataset, i), buckets))
+                for i in image_ids], dtype=np.int32)
+            self.buckets = [image_ids[selected == b] for b in range(len(buckets))]
+            self.bucket_shapes = buckets
+        else:
+            self.buckets = [image_ids]
+            self.bucket_shapes = [tuple(int(d) for d in config.IMAGE_SHAPE[:2])]
+
+        # Anchors of each molded shape
+        # {(height, width): [anchor_count, (y1, x1, y2, x2)]}
+        self.anchors = {}
+        for shape in self.bucket_shapes:
+            backbone_shapes = compute_backbone_shapes(config, shape)
+            self.anchors[shape] = utils.load_pyramid_anchors(
+                config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                backbone_shapes, config.BACKBONE_STRIDES,
+                config.RPN_ANCHOR_STRIDE, cache_dir=config.ANCHOR_CACHE_DIR)
+        # Spatial indexes of the anchors. Built on first use, in the
+        # process that loads the batches.
+        self.anchor_indexes = {}
+        self.set_epoch(0)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def set_epoch(self, epoch):
+        """Selects the image order of the given epoch."""
+        self.epoch = epoch
+        if self.shuffle:
+            self.orders = [np.random.RandomState([self.seed, epoch, b]).permutation(ids)
+                           for b, ids in enumerate(self.buckets)]
+        else:
+            self.orders = self.buckets
+        # (bucket, position of the first image in the bucket order)
+        self.batches = [(b, start) for b, order in enumerate(self.orders)
+                        for start in range(0, len(order), self.batch_size)]
+        if self.shuffle and len(self.orders) > 1:
+            permutation = np.random.RandomState([self.seed, epoch]).permutation(
+                len(self.batches))
+            self.batches = [self.batches[i] for i in permutation]
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+
+    def item_seed(self, bucket, position):
+        """Seed of the random state of the image at a position of a bucket
+        order of the current epoch.
+        """
+        return int(np.random.RandomState(
+            [self.seed, self.epoch, bucket, position]).randint(2 ** 31 - 1))
+
+    def load_sample(self, image_id):
+        """Loads the image and GT of one image, with the per-image
+        augmentation applied. A BatchAugmenter is left to augment_batch(),
+        so in that case the masks are full size CompactMasks.
+
+        Returns (image, image_meta, gt_class_ids, gt_boxes, gt_masks,
+        augment), where augment tells if the image is to be augmented, or
+        None if the image has no instances.
+        """
+        augmentation = self.augmentation
+        if self.dataset.image_info[image_id]['source'] in self.no_augmentation_sources:
+            augmentation = None
+        batched = isinstance(augmentation, BatchAugmenter)
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            load_image_gt(self.dataset, self.config, image_id,
+                          augmentation=None if batched else augmentation,
+                          use_mini_mask=self.config.USE_MINI_MASK and not batched,
+                          compact_masks=True,
+                          sample_cache=self.sample_cache)
+        # Skip images that have no instances
+        if not np.any(gt_class_ids > 0):
+            return None
+        return image, image_meta, gt_class_ids, gt_boxes, gt_masks, batched
+
+    def augment_batch(self, samples, seeds):
+        """Applies the BatchAugmenter to the samples of a batch that need
+        it, then makes their mini-masks. Keeps the original of a sample that
+        has no instances left after augmentation.
+        """
+        ids = [i for i, s in enumerate(samples) if s[5]]
+        if not ids:
+            return samples
+        images, masks, boxes = self.augmentation.augment(
+            [samples[i][0] for i in ids], [samples[i][4] for i in ids],
+            seeds=[seeds[i] for i in ids])
+        samples = list(samples)
+        for i, image, mask, bbox in zip(ids, images, masks, boxes):
+            _, image_meta, class_ids, original_bbox, original_mask, _ = samples[i]
+            keep = (mask.areas() > 0) & (bbox[:, 2] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 1])
+            if not np.any(class_ids[keep] > 0):
+                image, mask, bbox, keep = samples[i][0], original_mask, original_bbox, \
+                    np.ones(len(class_ids), dtype=bool)
+            mask, bbox, class_ids = mask.select(keep), bbox[keep], class_ids[keep]
+            if self.config.USE_MINI_MASK:
+                mask = mask.minimize(bbox, self.config.MINI_MASK_SHAPE)
+            samples[i] = (image, image_meta, class_ids, bbox, mask, False)
+        return samples
+
+    def build_targets(self, sample):
+        """Adds the RPN targets to a loaded sample and subsamples its
+        instances to MAX_GT_INSTANCES.
+        """
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks, _ = sample
+        # Molded image shape, from the meta data. See compose_image_meta().
+        image_shape = tuple(int(d) for d in image_meta[4:7])
+        shape = image_shape[:2]
+        if shape not in self.anchor_indexes:
+            self.anchor_indexes[shape] = utils.BoxIndex(self.anchors[shape])
+        rpn_match, rpn_bbox = build_rpn_targets(image_shape, self.anchors[shape],
+                                                gt_class_ids, gt_boxes, self.config,
+                                                anchor_index=self.anchor_indexes[shape])
+        gt_class_ids, gt_boxes, gt_masks = subsample_instances(
+            gt_class_ids, gt_boxes, gt_masks, self.config.MAX_GT_INSTANCES)
+        return image, image_meta, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox
+
+    def __getitem__(self, index):
+        """Returns batch number index of the current epoch as (inputs, []).
+
+        Images without instances are replaced by the next images of the
+        epoch order of the bucket, wrapping around at the end, so the last
+        batch is full too.
+        """
+        samples = []
+        seeds = []
+        bucket, position = self.batches[index]
+        order = self.orders[bucket]
+        skipped = 0
+        while len(samples) < self.batch_size:
+            if skipped > len(order):
+                raise ValueError("No image of the bucket {} has instances.".format(
+                    self.bucket_shapes[bucket]))
+            image_id = order[position % len(order)]
+            # Same random state whichever process loads this image
+            item_seed = self.item_seed(bucket, position)
+            np.random.seed(item_seed)
+            random.seed(item_seed)
+            if self.augmentation is not None and \
+                    not isinstance(self.augmentation, BatchAugmenter):
+                # seed_() in imgaug 0.4+, reseed() before
+                reseed = getattr(self.augmentation, "seed_", None) or \
+                    self.augmentation.reseed
+                reseed(item_seed)
+            position += 1
+            try:
+                sample = self.load_sample(image_id)
+            except (GeneratorExit, KeyboardInterrupt):
+                raise
+            except:
+                # Log it and skip the image
+                logging.exception("Error processing image {}".format(
+                    self.dataset.image_info[image_id]))
+                self.error_count += 1
+                if self.error_count > 5:
+                    raise
+                sample = None
+            if sample is None:
+                skipped += 1
+                continue
+            samples.append(sample)
+            seeds.append(item_seed)
+
+        samples = self.augment_batch(samples, seeds)
+        # Same random state for the RPN anchor sampling too
+        np.random.seed(seeds[0])
+        samples = [self.build_targets(s) for s in samples]
+        return self.assemble(samples), []
+
+    def batch_images(self, images, image_metas):
+        """Returns the image inputs of a batch: a list with the molded
+        images [batch, height, width, channels].
+        """
+        return [np.stack([mold_image(image.astype(np.float32), self.config)
+                          for image in images])]
+
+    def assemble(self, samples):
+        """Stacks the samples of a batch into the list of model inputs."""
+        images, image_metas, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox = \
+            zip(*samples)
+        batch_gt_class_ids = np.zeros(
+            (self.batch_size, self.config.MAX_GT_INSTANCES), dtype=np.int32)
+        batch_gt_boxes = np.zeros(
+            (self.batch_size, self.config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+        for b in range(self.batch_size):
+            batch_gt_class_ids[b, :gt_class_ids[b].shape[0]] = gt_class_ids[b]
+            batch_gt_boxes[b, :gt_boxes[b].shape[0]] = gt_boxes[b]
+        return self.batch_images(images, image_metas) + [
+            np.stack(image_metas),
+            np.stack(rpn_match)[:, :, np.newaxis],
+            np.stack(rpn_bbox),
+            batch_gt_class_ids,
+            batch_gt_boxes,
+            stack_gt_masks(gt_masks),
+        ]
+
+
+class FeatureSequence(TrainingSequence):
+    """Training batches of the cached features model: the same as
+    TrainingSequence, but the images are replaced by their backbone
+    feature maps, C2 to C5, and the GT comes from the same
+    feature_cache.FeatureCache. Nothing is augmented.
+
+    See MaskRCNN.train() and config.FEATURE_CACHE_DIR.
+    """
+
+    def __init__(self, dataset, config, feature_cache, shuffle=True,
+                 batch_size=1, seed=0):
+        self.feature_cache = feature_cache
+        super(FeatureSequence, self).__init__(dataset, config, shuffle=shuffle,
+                                              batch_size=batch_size, seed=seed)
+
+    def load_sample(self, image_id):
+        image_meta, class_ids, bbox, masks = self.feature_cache.load_gt(image_id)
+        # Skip images that have no instances
+        if not np.any(class_ids > 0):
+            return None
+        return None, image_meta, class_ids, bbox, masks, False
+
+    def batch_images(self, images, image_metas):
+        image_ids = [int(meta[0]) for meta in image_metas]
+        return self.feature_cache.load_features(image_ids)
+
+
+def copy_layer_weights(source, target):
+    """Copies the weights of the layers of a Keras model to the layers of
+    the same name in another. Layers that are only in one of them, or have
+    no weights, are skipped. Handles ParallelModel wrappers.
+    """
+    def layers(model):
+        model = model.inner_model if hasattr(model, "inner_model") else model
+        return {l.name: l for l in model.layers if l.weights}
+    target_layers = layers(target)
+    for name, layer in layers(source).items():
+        if name in target_layers:
+            target_layers[name].set_weights(layer.get_weights())
+
+
+############################################################
+#  Optimizer
+############################################################
+
+class AccumulatedSGD(keras.optimizers.SGD):
+    """SGD with gradient accumulation and dynamic loss scaling.
+
+    Gradient accumulation: each call adds the gradients of a batch to an
+    accumulator. Every accumulation_steps calls, the weights are updated
+    with the mean of the accumulated gradients, as SGD with momentum would
+    with the gradients of one large batch, and the accumulators are reset.
+    Weights and momentum don't change in between.
+
+    Averaging is also what keeps the losses scaled right. The five loss
+    layers are means over their batch, so the mean of their gradients is the
+    gradient of the mean loss over the large batch. The L2 regularization
+    has the same gradient in every batch of a cycle, since the weights don't
+    change, so the mean counts it once per step, not accumulation_steps
+    times.
+
+    Dynamic loss scaling, for float16 training: the loss is multiplied by
+    loss_scale before computing the gradients, so that small gradients
+    don't underflow in float16, and the gradients are divided by it after.
+    If any gradient isn't finite, the batch is dropped (it adds nothing to
+    the accumulators and isn't counted in the mean, or skips the update)
+    and the scale is halved. After LOSS_SCALE_GROWTH_INTERVAL batches
+    without overflow it's doubled.
+
+    clipnorm clips the averaged gradients by their global norm. Learning
+    rate decay counts weight updates, not batches.
+
+    accumulation_steps: Number of batches per weight update.
+    dynamic_loss_scale: If True, use dynamic loss scaling.
+    Other arguments: See keras.optimizers.SGD.
+    """
+
+    LOSS_SCALE_INITIAL = 2. ** 15
+    LOSS_SCALE_GROWTH_INTERVAL = 2000
+
+    def __init__(self, accumulation_steps=1, dynamic_loss_scale=False, **kwargs):
+        super(AccumulatedSGD, self).__init__(**kwargs)
+        self.accumulation_steps = accumulation_steps
+        self.dynamic_loss_scale = dynamic_loss_scale
+        with K.name_scope(self.__class__.__name__):
+            self.loss_scale = K.variable(
+                self.LOSS_SCALE_INITIAL if dynamic_loss_scale else 1.,
+                name='loss_scale')
+            self.good_steps = K.variable(0, dtype='int64', name='good_steps')
+
+    def get_updates(self, loss, params):
+        steps = self.accumulation_steps
+        # Read the batch counter once. The variables are all written after
+        # everything is computed from their values before this batch, and
+        # the counter is incremented last, so a run sees one state.
+        iterations = tf.identity(self.iterations)
+        # (variable, new value) pairs
+        new_values = []
+        # Condition of the weight update. None means always.
+        apply_step = None
+
+        if self.dynamic_loss_scale:
+            grads = K.gradients(loss * self.loss_scale, params)
+            grads = [g / self.loss_scale for g in grads]
+            finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in grads])
+            grads = [K.switch(finite, g, K.zeros_like(g)) for g in grads]
+            if steps == 1:
+                apply_step = finite
+            # Halve the scale on overflow, double it after enough good batches
+            good_steps = K.switch(finite, self.good_steps + 1,
+                                  K.zeros_like(self.good_steps))
+            grow = K.greater_equal(good_steps, self.LOSS_SCALE_GROWTH_INTERVAL)
+            new_values.append((self.loss_scale, K.switch(
+                finite,
+                K.switch(grow, self.loss_scale * 2., self.loss_scale),
+                K.maximum(self.loss_scale / 2., 1.))))
+            new_values.append((self.good_steps, K.switch(
+                grow, K.zeros_like(good_steps), good_steps)))
+        else:
+            grads = K.gradients(loss, params)
+            finite = None
+
+        moments = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        if steps > 1:
+            accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+            # Number of batches accumulated in the cycle. Dropped batches
+            # don't count.
+            accumulated = K.variable(0., name='accumulated')
+            counters = [accumulated]
+            count = accumulated + (K.cast(finite, K.floatx()) if finite is not None else 1.)
+            # Update the weights on the last batch of each cycle, if any
+            # batch of the cycle was kept
+            last = K.equal((iterations + 1) % steps, 0)
+            apply_step = tf.logical_and(last, K.greater(count, 0.))
+            # Sums of the gradients of the cycle, including this batch
+            totals = [a + g for a, g in zip(accumulators, grads)]
+            step_grads = [t / K.maximum(count, 1.) for t in totals]
+            # Reset the accumulators at the end of a cycle, keep the sums
+            # otherwise
+            new_values.extend((a, K.switch(last, K.zeros_like(t), t))
+                              for a, t in zip(accumulators, totals))
+            new_values.append((accumulated, K.switch(last, K.zeros_like(count), count)))
+        else:
+            accumulators = []
+            counters = []
+            step_grads = grads
+        self.weights = [self.iterations, self.loss_scale, self.good_steps] + \
+            moments + accumulators + counters
+
+        if getattr(self, "clipnorm", 0) > 0:
+            step_grads, _ = tf.clip_by_global_norm(step_grads, self.clipnorm)
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            updates_done = K.cast(iterations // steps, K.dtype(self.decay))
+            lr = lr * (1. / (1. + self.decay * updates_done))
+
+        for p, g, m in zip(params, step_grads, moments):
+            v = self.momentum * m - lr * g
+            if self.nesterov:
+                new_p = p + self.momentum * v - lr * g
+            else:
+                new_p = p + v
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+            if apply_step is not None:
+                v = K.switch(apply_step, v, m)
+                new_p = K.switch(apply_step, new_p, p)
+            new_values.append((m, v))
+            new_values.append((p, new_p))
+
+        with tf.control_dependencies([iterations] + [v for _, v in new_values]):
+            self.updates = [K.update(x, v) for x, v in new_values]
+        with tf.control_dependencies(self.updates):
+            self.updates.append(K.update_add(self.iterations, 1))
+        return self.updates
+
+    def get_config(self):
+        config = {'accumulation_steps': self.accumulation_steps,
+                  'dynamic_loss_scale': self.dynamic_loss_scale}
+        base_config = super(AccumulatedSGD, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Ops that the mixed precision graph rewrite must keep in float32: the
+# softmax, exp and log of the losses and of apply_box_deltas_graph(),
+# the loss reductions, and NMS.
+FLOAT32_OPS = ["Exp", "Log", "Softmax", "SparseSoftmaxCrossEntropyWithLogits",
+               "SoftmaxCrossEntropyWithLogits", "Mean", "Sum",
+               "NonMaxSuppressionV2", "NonMaxSuppressionV3"]
+
+
+def configure_mixed_precision(precision):
+    """Makes a new Keras session that runs the graph in mixed precision.
+
+    Uses TensorFlow's automatic mixed precision graph rewrite, which casts
+    the inputs of the ops that are safe and fast in lower precision
+    (convolutions, matmuls, ...) and keeps the variables, and so the master
+    weights, in float32. The ops in FLOAT32_OPS are added to its float32
+    list. Call it before building the model, because the weights live in
+    the session.
+
+    precision: "float16" (GPUs) or "bfloat16" (CPUs with oneDNN, needs a
+        TensorFlow version with the auto_mixed_precision_mkl rewrite).
+    """
+    from tensorflow.core.protobuf import rewriter_config_pb2
+
+    # The variable was renamed from BLACKLIST to DENYLIST in TF 2.4
+    for name in ["TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_BLACKLIST_ADD",
+                 "TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_DENYLIST_ADD"]:
+        ops = [o for o in os.environ.get(name, "").split(",") if o]
+        os.environ[name] = ",".join(ops + [o for o in FLOAT32_OPS if o not in ops])
+
+    session_config = tf.ConfigProto()
+    rewrite_options = session_config.graph_options.rewrite_options
+    if precision == "float16":
+        rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    elif precision == "bfloat16":
+        if not hasattr(rewrite_options, "auto_mixed_precision_mkl"):
+            raise ValueError("bfloat16 needs a TensorFlow version with the "
+                             "auto_mixed_precision_mkl graph rewrite.")
+        rewrite_options.auto_mixed_precision_mkl = rewriter_config_pb2.RewriterConfig.ON
+    else:
+        raise ValueError("Unknown precision: {}".format(precision))
+    K.set_session(tf.Session(config=session_config))
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1835,16 +2644,28 @@ class MaskRCNN():
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
+        # Set to a profiling.Profiler to time the stages of detect()
+        self.profiler = None
+        # Training state loaded by load_training_state(), applied by train()
+        self.resume_state = None
         self.set_log_dir()
+        if config.MIXED_PRECISION:
+            configure_mixed_precision(config.MIXED_PRECISION)
         self.keras_model = self.build(mode=mode, config=config)
 
-    def build(self, mode, config):
+    def build(self, mode, config, feature_shapes=None):
         """Build Mask R-CNN architecture.
             input_shape: The shape of the input image.
             mode: Either "training" or "inference". The inputs and
                 outputs of the model differ accordingly.
+            feature_shapes: Optional. [(height, width, channels)] of C2 to C5.
+                Builds a training model without the backbone, whose inputs
+                are the backbone feature maps instead of the images. See
+                FeatureSequence and config.FEATURE_CACHE_DIR.
         """
         assert mode in ['training', 'inference']
+        assert feature_shapes is None or (mode == "training" and not config.TRAIN_BUCKETS), \
+            "Feature inputs are only supported in training, without TRAIN_BUCKETS."
 
         # Image size must be dividable by 2 multiple times
         h, w = config.IMAGE_SHAPE[:2]
@@ -1852,12 +2673,23 @@ class MaskRCNN():
             raise Exception("Image size must be dividable by 2 at least 6 times "
                             "to avoid fractions when downscaling and upscaling."
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
+        for h, w in config.TRAIN_BUCKETS or []:
+            if h % 64 or w % 64:
+                raise Exception("TRAIN_BUCKETS shapes must be multiples of 64. "
+                                "Got {}x{}.".format(h, w))
 
         # Inputs
         input_image = KL.Input(
             shape=[None, None, config.IMAGE_SHAPE[2]], name="input_image")
         input_image_meta = KL.Input(shape=[config.IMAGE_META_SIZE],
                                     name="input_image_meta")
+        if feature_shapes:
+            input_features = [KL.Input(shape=list(shape), name="input_c{}".format(i + 2))
+                              for i, shape in enumerate(feature_shapes)]
+            # All the images are IMAGE_SHAPE
+            image_size = K.constant(config.IMAGE_SHAPE[:2], dtype=tf.int32)
+        else:
+            image_size = None
         if mode == "training":
             # RPN GT
             input_rpn_match = KL.Input(
@@ -1875,7 +2707,8 @@ class MaskRCNN():
                 shape=[None, 4], name="input_gt_boxes", dtype=tf.float32)
             # Normalize coordinates
             gt_boxes = KL.Lambda(lambda x: norm_boxes_graph(
-                x, K.shape(input_image)[1:3]))(input_gt_boxes)
+                x, K.shape(input_image)[1:3] if image_size is None else image_size)
+                )(input_gt_boxes)
             # 3. GT Masks (zero padded)
             # [batch, height, width, MAX_GT_INSTANCES]
             if config.USE_MINI_MASK:
@@ -1883,19 +2716,23 @@ class MaskRCNN():
                     shape=[config.MINI_MASK_SHAPE[0],
                            config.MINI_MASK_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
+            elif config.TRAIN_BUCKETS:
+                # Full size masks are as large as the image of each bucket
+                input_gt_masks = KL.Input(
+                    shape=[None, None, None],
+                    name="input_gt_masks", dtype=bool)
             else:
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
-            # Anchors in normalized coordinates
-            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
         # Don't create the thead (stage 5), so we pick the 4th item in the list.
-        if callable(config.BACKBONE):
+        if feature_shapes:
+            C2, C3, C4, C5 = input_features
+        elif callable(config.BACKBONE):
             _, C2, C3, C4, C5 = config.BACKBONE(input_image, stage5=True,
                                                 train_bn=config.TRAIN_BN)
         else:
@@ -1926,16 +2763,15 @@ class MaskRCNN():
         rpn_feature_maps = [P2, P3, P4, P5, P6]
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
-        # Anchors
-        if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
-        else:
-            anchors = input_anchors
+        # Anchors in normalized coordinates. Training images are always
+        # IMAGE_SHAPE, so the anchors are a constant. In inference, and in
+        # training with TRAIN_BUCKETS, they're generated from the feature map
+        # shapes of each batch.
+        static_shape = mode == "training" and not config.TRAIN_BUCKETS
+        anchors = AnchorsLayer(
+            config,
+            image_shape=config.IMAGE_SHAPE if static_shape else None,
+            name="anchors")([C2 if feature_shapes else input_image] + rpn_feature_maps)
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -1979,7 +2815,8 @@ class MaskRCNN():
                                       name="input_roi", dtype=np.int32)
                 # Normalize coordinates
                 target_rois = KL.Lambda(lambda x: norm_boxes_graph(
-                    x, K.shape(input_image)[1:3]))(input_rois)
+                    x, K.shape(input_image)[1:3] if image_size is None else image_size)
+                    )(input_rois)
             else:
                 target_rois = rpn_rois
 
@@ -1997,13 +2834,23 @@ class MaskRCNN():
                 fpn_classifier_graph(rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
+
+            if config.USE_OHEM:
+                # Keep the hardest ROIs only
+                rois, target_class_ids, target_bbox, target_mask, \
+                    mrcnn_class_logits, mrcnn_class, mrcnn_bbox = \
+                    OHEMLayer(config, name="ohem")([
+                        rois, target_class_ids, target_bbox, target_mask,
+                        mrcnn_class_logits, mrcnn_class, mrcnn_bbox])
 
             mrcnn_mask = build_fpn_mask_graph(rois, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
 
             # TODO: clean up (use tf.identify if necessary)
             output_rois = KL.Lambda(lambda x: x * 1, name="output_rois")(rois)
@@ -2021,8 +2868,9 @@ class MaskRCNN():
                 [target_mask, target_class_ids, mrcnn_mask])
 
             # Model
-            inputs = [input_image, input_image_meta,
-                      input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
+            inputs = (input_features if feature_shapes else [input_image]) + [
+                input_image_meta, input_rpn_match, input_rpn_bbox,
+                input_gt_class_ids, input_gt_boxes, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
             outputs = [rpn_class_logits, rpn_class, rpn_bbox,
@@ -2037,7 +2885,8 @@ class MaskRCNN():
                 fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
 
             # Detections
             # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in
@@ -2051,9 +2900,10 @@ class MaskRCNN():
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            model = KM.Model([input_image, input_image_meta],
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
@@ -2094,12 +2944,35 @@ class MaskRCNN():
         checkpoint = os.path.join(dir_name, checkpoints[-1])
         return checkpoint
 
-    def load_weights(self, filepath, by_name=False, exclude=None):
+    def load_weights(self, filepath, by_name=False, exclude=None, workers=0):
         """Modified version of the corresponding Keras function with
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        workers: Number of threads reading a weight archive (see
+            mrcnn/weight_archive.py) before its weights are assigned.
+            Ignored for .h5 files.
         """
+        if exclude:
+            by_name = True
+
+        # In multi-GPU training, we wrap the model. Get layers
+        # of the inner model because they have the weights.
+        keras_model = self.keras_model
+        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
+            else keras_model.layers
+
+        # Exclude some layers
+        if exclude:
+            layers = filter(lambda l: l.name not in exclude, layers)
+
+        if weight_archive.is_archive(filepath):
+            # Memory-mapped and assigned in one run
+            weight_archive.WeightArchive(filepath).load(
+                layers, by_name=by_name, workers=workers)
+            self.set_log_dir(filepath)
+            return
+
         import h5py
         # Conditional import to support versions of Keras before 2.2
         # TODO: remove in about 6 months (end of 2018)
@@ -2109,25 +2982,12 @@ class MaskRCNN():
             # Keras before 2.2 used the 'topology' namespace.
             from keras.engine import topology as saving
 
-        if exclude:
-            by_name = True
-
         if h5py is None:
             raise ImportError('`load_weights` requires h5py.')
         f = h5py.File(filepath, mode='r')
         if 'layer_names' not in f.attrs and 'model_weights' in f:
             f = f['model_weights']
 
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
         if by_name:
             saving.load_weights_from_hdf5_group_by_name(f, layers)
         else:
@@ -2157,9 +3017,17 @@ class MaskRCNN():
         metrics. Then calls the Keras compile() function.
         """
         # Optimizer object
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
+        if self.config.GRADIENT_ACCUMULATION_STEPS > 1 or self.config.MIXED_PRECISION:
+            # bfloat16 has the exponent range of float32 and needs no loss scaling
+            optimizer = AccumulatedSGD(
+                accumulation_steps=self.config.GRADIENT_ACCUMULATION_STEPS,
+                dynamic_loss_scale=self.config.MIXED_PRECISION == "float16",
+                lr=learning_rate, momentum=momentum,
+                clipnorm=self.config.GRADIENT_CLIP_NORM)
+        else:
+            optimizer = keras.optimizers.SGD(
+                lr=learning_rate, momentum=momentum,
+                clipnorm=self.config.GRADIENT_CLIP_NORM)
         # Add Losses
         # First, clear previously set losses to avoid duplication
         self.keras_model._losses = []
@@ -2275,6 +3143,112 @@ class MaskRCNN():
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{epoch:04d}")
 
+    def load_training_state(self, path=None):
+        """Resumes from a training state file saved by train(). See
+        mrcnn/training_state.py.
+
+        Sets the weights, the log directory and the epoch now. The optimizer
+        state, the step within the epoch, the data loader position and the
+        random states are applied by the next train() call that trains
+        beyond this epoch, if it trains the same layers.
+
+        path: Path of the state file. By default, the one of the last log
+            directory of this config in model_dir.
+
+        Returns the path of the loaded file.
+        """
+        if path is None:
+            path = training_state.find_last(self.model_dir, self.config.NAME)
+            if path is None:
+                import errno
+                raise FileNotFoundError(
+                    errno.ENOENT,
+                    "Could not find a training state under {}".format(self.model_dir))
+        saved = training_state.load(path)
+
+        # In multi-GPU training, we wrap the model. Get layers
+        # of the inner model because they have the weights.
+        keras_model = self.keras_model.inner_model \
+            if hasattr(self.keras_model, "inner_model") else self.keras_model
+        for layer in keras_model.layers:
+            if layer.name in saved["weights"]:
+                layer.set_weights(saved["weights"][layer.name])
+
+        # Continue in the same log directory
+        self.log_dir = os.path.dirname(os.path.abspath(path))
+        self.checkpoint_path = os.path.join(self.log_dir, "mask_rcnn_{}_*epoch*.h5".format(
+            self.config.NAME.lower()))
+        self.checkpoint_path = self.checkpoint_path.replace(
+            "*epoch*", "{epoch:04d}")
+        self.epoch = saved["state"]["epoch"]
+        self.resume_state = saved
+        log("Resuming from epoch {}, step {}".format(self.epoch, saved["state"]["step"]))
+        return path
+
+    def load_feature_cache(self, dataset, cache_dir, sample_cache=None, verbose=1):
+        """Opens the feature_cache.FeatureCache of a dataset in cache_dir,
+        building it first if it doesn't exist: runs the backbone of this
+        model once on every image, without augmentation, and stores its
+        C2-C5 outputs and the GT of the image.
+
+        The cache directory name is a hash of the dataset, the preprocessing
+        config and the backbone weights, so loading other weights, or
+        training the backbone, makes a new cache.
+
+        sample_cache: Optional sample_cache.SampleCache to read the images
+            from while building.
+        """
+        config = self.config
+        assert not callable(config.BACKBONE), \
+            "The feature cache supports the ResNet backbones only."
+        assert not config.TRAIN_BUCKETS and config.IMAGE_RESIZE_MODE != "crop", \
+            "The feature cache needs images of one shape, without random crops."
+
+        # Backbone model, sharing the layers of the full model
+        keras_model = self.keras_model.inner_model \
+            if hasattr(self.keras_model, "inner_model") else self.keras_model
+        c4 = "res4w_out" if config.BACKBONE == "resnet101" else "res4f_out"
+        outputs = [keras_model.get_layer(name).output
+                   for name in ["res2c_out", "res3d_out", c4, "res5c_out"]]
+        backbone = KM.Model(keras_model.get_layer("input_image").input, outputs,
+                            name="backbone")
+
+        key = hashlib.sha1(dataset_fingerprint(dataset, config).encode("utf8"))
+        key.update(config.BACKBONE.encode("utf8"))
+        for w in backbone.get_weights():
+            key.update(w.tobytes())
+        path = os.path.join(cache_dir, "features_" + key.hexdigest()[:16])
+        if not os.path.exists(os.path.join(path, "index.json")):
+            level_shapes = [
+                (int(h), int(w), c) for (h, w), c in zip(
+                    compute_backbone_shapes(config, config.IMAGE_SHAPE)[:4],
+                    [256, 512, 1024, 2048])]
+            mask_shape = config.MINI_MASK_SHAPE if config.USE_MINI_MASK \
+                else config.IMAGE_SHAPE[:2]
+            image_ids = list(dataset.image_ids)
+
+            def batches():
+                for start in range(0, len(image_ids), config.BATCH_SIZE):
+                    gts, images = [], []
+                    for image_id in image_ids[start:start + config.BATCH_SIZE]:
+                        image, image_meta, class_ids, bbox, mask = load_image_gt(
+                            dataset, config, image_id,
+                            use_mini_mask=config.USE_MINI_MASK,
+                            sample_cache=sample_cache)
+                        if not isinstance(mask, np.ndarray):
+                            mask = mask.to_dense()
+                        images.append(mold_image(image.astype(np.float32), config))
+                        gts.append((image_meta, class_ids, bbox, mask))
+                    features = backbone.predict(np.stack(images))
+                    yield [f.astype(np.float16) for f in features], gts
+                    if verbose:
+                        log("Feature cache: {}/{} images".format(
+                            min(start + config.BATCH_SIZE, len(image_ids)),
+                            len(image_ids)))
+
+            FeatureCache.build(path, image_ids, level_shapes, mask_shape, batches())
+        return FeatureCache(path)
+
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
         """Train the model.
@@ -2287,7 +3261,9 @@ class MaskRCNN():
         layers: Allows selecting wich layers to train. It can be:
             - A regular expression to match layer names to train
             - One of these predefined values:
-              heads: The RPN, classifier and mask heads of the network
+              heads: The RPN, classifier and mask heads of the network.
+                  With config.FEATURE_CACHE_DIR set, they're trained from
+                  cached backbone features, without augmentation.
               all: All the layers
               3+: Train Resnet stage 3 and up
               4+: Train Resnet stage 4 and up
@@ -2303,6 +3279,9 @@ class MaskRCNN():
                     imgaug.augmenters.Fliplr(0.5),
                     imgaug.augmenters.GaussianBlur(sigma=(0.0, 5.0))
                 ])
+
+            An augmentation.BatchAugmenter is faster: it augments whole
+            batches in the data loader workers.
         custom_callbacks: Optional. Add custom callbacks to be called
         with the keras fit_generator method. Must be list of type keras.callbacks.
         no_augmentation_sources: Optional. List of sources to exclude for
@@ -2322,28 +3301,105 @@ class MaskRCNN():
             # All layers
             "all": ".*",
         }
+        # The backbone is frozen when training the heads. With a feature
+        # cache it runs once per image and the heads train from its outputs.
+        use_features = layers == "heads" and bool(self.config.FEATURE_CACHE_DIR)
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        # Preprocessed sample caches. Built on first use.
+        train_cache = val_cache = None
+        if self.config.SAMPLE_CACHE_DIR:
+            train_cache = SampleCache.open_or_build(
+                train_dataset, self.config, self.config.SAMPLE_CACHE_DIR)
+            val_cache = SampleCache.open_or_build(
+                val_dataset, self.config, self.config.SAMPLE_CACHE_DIR)
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+
+        # Data loaders. Each batch is loaded once, by one worker process.
+        if use_features:
+            if augmentation:
+                logging.warning("Training the heads from cached features. "
+                                "The augmentation is ignored.")
+            train_features = self.load_feature_cache(
+                train_dataset, self.config.FEATURE_CACHE_DIR, sample_cache=train_cache)
+            val_features = self.load_feature_cache(
+                val_dataset, self.config.FEATURE_CACHE_DIR, sample_cache=val_cache)
+            train_sequence = FeatureSequence(train_dataset, self.config, train_features,
+                                             shuffle=True, batch_size=self.config.BATCH_SIZE)
+            val_sequence = FeatureSequence(val_dataset, self.config, val_features,
+                                           shuffle=True, batch_size=self.config.BATCH_SIZE)
+        else:
+            train_sequence = TrainingSequence(train_dataset, self.config, shuffle=True,
+                                              augmentation=augmentation,
+                                              batch_size=self.config.BATCH_SIZE,
+                                              no_augmentation_sources=no_augmentation_sources,
+                                              sample_cache=train_cache)
+            val_sequence = TrainingSequence(val_dataset, self.config, shuffle=True,
+                                            batch_size=self.config.BATCH_SIZE,
+                                            sample_cache=val_cache)
+        train_loader = data_loader.ShardedLoader(train_sequence, workers=workers)
+        # Validation runs VALIDATION_STEPS batches per epoch. Fewer workers do.
+        val_loader = data_loader.ShardedLoader(
+            val_sequence, workers=min(workers, max(1, workers // 4)))
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
 
+        # With cached features, train a model without the backbone, which
+        # shares no layers with the full model. Its weights are copied back
+        # for the checkpoints and when training ends.
+        full_model = self.keras_model
+        if use_features:
+            self.keras_model = self.build("training", self.config,
+                                          feature_shapes=train_features.level_shapes)
+            copy_layer_weights(full_model, self.keras_model)
+
+            def save_checkpoint(epoch, logs):
+                copy_layer_weights(self.keras_model, full_model)
+                full_model.save_weights(self.checkpoint_path.format(epoch=epoch + 1))
+            checkpoint = keras.callbacks.LambdaCallback(on_epoch_end=save_checkpoint)
+        else:
+            checkpoint = keras.callbacks.ModelCheckpoint(self.checkpoint_path,
+                                                         verbose=0, save_weights_only=True)
+
+        # State loaded by load_training_state(), if training goes on from it
+        resume = self.resume_state if self.resume_state and self.epoch < epochs else None
+        step = resume["state"]["step"] if resume else 0
+        loader_position = resume["state"]["loader_position"] if resume else (self.epoch, 0)
+        if step >= self.config.STEPS_PER_EPOCH:
+            # Stopped after the last step of the epoch, before its end
+            self.epoch += 1
+            step = 0
+
         # Callbacks
         callbacks = [
+            # First, so that the others see the loader statistics
+            data_loader.QueueDepthCallback(train_loader),
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoint,
         ]
+        if self.config.TRAINING_STATE_STEPS is not None:
+            def save_state(epoch, step):
+                if self.keras_model is not full_model:
+                    copy_layer_weights(self.keras_model, full_model)
+                training_state.save(
+                    os.path.join(self.log_dir, training_state.STATE_FILENAME),
+                    full_model, self.keras_model.optimizer,
+                    {"epoch": epoch, "step": step, "layers": layers,
+                     "loader_position": list(train_loader.position),
+                     "seed": train_sequence.seed})
+            callbacks.append(training_state.TrainingStateCheckpoint(
+                save_state, steps=self.config.TRAINING_STATE_STEPS, step_offset=step))
 
         # Add custom callbacks to the list
         if custom_callbacks:
@@ -2355,26 +3411,56 @@ class MaskRCNN():
         self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
+        if resume:
+            self.resume_state = None
+            training_state.restore_random_state(resume["state"])
+            # The optimizer weights are created with the training function
+            self.keras_model._make_train_function()
+            optimizer = self.keras_model.optimizer
+            shapes = [K.int_shape(w) for w in optimizer.weights]
+            if resume["state"]["layers"] == layers and \
+                    shapes == [w.shape for w in resume["optimizer"]]:
+                optimizer.set_weights(resume["optimizer"])
+            else:
+                logging.warning("The training state is of other layers or another "
+                                "optimizer. The optimizer state is not restored.")
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
+        # The loaders run their own worker processes, so Keras reads them
+        # in the training thread
+        train_generator = train_loader.generator(*loader_position)
+        val_generator = val_loader.generator(epoch=self.epoch)
+        try:
+            start_epoch = self.epoch
+            if step:
+                # Finish the interrupted epoch first
+                start_epoch += 1
+                self.keras_model.fit_generator(
+                    train_generator,
+                    initial_epoch=self.epoch,
+                    epochs=self.epoch + 1,
+                    steps_per_epoch=self.config.STEPS_PER_EPOCH - step,
+                    callbacks=callbacks,
+                    validation_data=val_generator,
+                    validation_steps=self.config.VALIDATION_STEPS,
+                    workers=0,
+                )
+            if start_epoch < epochs:
+                self.keras_model.fit_generator(
+                    train_generator,
+                    initial_epoch=start_epoch,
+                    epochs=epochs,
+                    steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                    callbacks=callbacks,
+                    validation_data=val_generator,
+                    validation_steps=self.config.VALIDATION_STEPS,
+                    workers=0,
+                )
+        finally:
+            train_loader.close()
+            val_loader.close()
+            if self.keras_model is not full_model:
+                copy_layer_weights(self.keras_model, full_model)
+                self.keras_model = full_model
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2435,50 +3521,53 @@ class MaskRCNN():
         scores: [N] Float probability scores of the class_id
         masks: [height, width, num_instances] Instance masks
         """
-        # How many detections do we have?
-        # Detections array is padded with zeros. Find the first class_id == 0.
-        zero_ix = np.where(detections[:, 4] == 0)[0]
-        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
-
-        # Extract boxes, class_ids, scores, and class-specific masks
-        boxes = detections[:N, :4]
-        class_ids = detections[:N, 4].astype(np.int32)
-        scores = detections[:N, 5]
-        features = detections[:N, 6:]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
-
-        # Translate normalized coordinates in the resized image to pixel
-        # coordinates in the original image before resizing
-        window = utils.norm_boxes(window, image_shape[:2])
-        wy1, wx1, wy2, wx2 = window
-        shift = np.array([wy1, wx1, wy1, wx1])
-        wh = wy2 - wy1  # window height
-        ww = wx2 - wx1  # window width
-        scale = np.array([wh, ww, wh, ww])
-        # Convert boxes to normalized coordinates on the window
-        boxes = np.divide(boxes - shift, scale)
-        # Convert boxes to pixel coordinates on the original image
-        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
-
-        # Filter out detections with zero area. Happens in early training when
-        # network weights are still random
-        exclude_ix = np.where(
-            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
-        if exclude_ix.shape[0] > 0:
-            boxes = np.delete(boxes, exclude_ix, axis=0)
-            class_ids = np.delete(class_ids, exclude_ix, axis=0)
-            scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
+        with profiling.stage(self.profiler, "unmold"):
+            # How many detections do we have?
+            # Detections array is padded with zeros. Find the first class_id == 0.
+            zero_ix = np.where(detections[:, 4] == 0)[0]
+            N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+
+            # Extract boxes, class_ids, scores, and class-specific masks
+            boxes = detections[:N, :4]
+            class_ids = detections[:N, 4].astype(np.int32)
+            scores = detections[:N, 5]
+            features = detections[:N, 6:]
+            masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+
+            # Translate normalized coordinates in the resized image to pixel
+            # coordinates in the original image before resizing
+            window = utils.norm_boxes(window, image_shape[:2])
+            wy1, wx1, wy2, wx2 = window
+            shift = np.array([wy1, wx1, wy1, wx1])
+            wh = wy2 - wy1  # window height
+            ww = wx2 - wx1  # window width
+            scale = np.array([wh, ww, wh, ww])
+            # Convert boxes to normalized coordinates on the window
+            boxes = np.divide(boxes - shift, scale)
+            # Convert boxes to pixel coordinates on the original image
+            boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+
+            # Filter out detections with zero area. Happens in early training when
+            # network weights are still random
+            exclude_ix = np.where(
+                (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
+            if exclude_ix.shape[0] > 0:
+                boxes = np.delete(boxes, exclude_ix, axis=0)
+                class_ids = np.delete(class_ids, exclude_ix, axis=0)
+                scores = np.delete(scores, exclude_ix, axis=0)
+                masks = np.delete(masks, exclude_ix, axis=0)
+                features = np.delete(features, exclude_ix, axis=0)
+                N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        with profiling.stage(self.profiler, "paste_masks"):
+            full_masks = []
+            for i in range(N):
+                # Convert neural network mask to full size mask
+                full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
+                full_masks.append(full_mask)
+            full_masks = np.stack(full_masks, axis=-1)\
+                if full_masks else np.empty(original_image_shape[:2] + (0,))
 
         return boxes, class_ids, scores, full_masks, features
 
@@ -2503,7 +3592,8 @@ class MaskRCNN():
                 log("image", image)
 
         # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
+        with profiling.stage(self.profiler, "mold"):
+            molded_images, image_metas, windows = self.mold_inputs(images)
 
         # Validate image sizes
         # All images in a batch MUST be of the same size
@@ -2512,19 +3602,12 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
+        # Run object detection. Anchors are generated inside the graph.
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.predict([molded_images, image_metas])
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -2541,6 +3624,20 @@ class MaskRCNN():
             })
         return results
 
+    def predict(self, inputs):
+        """Runs the Keras model on a batch of molded inputs. Timed as the
+        "predict" stage, with TF op tracing, if a profiler is set.
+
+        inputs: [molded_images, image_metas]
+
+        Returns the list of model outputs.
+        """
+        with profiling.stage(self.profiler, "predict"):
+            if self.profiler is not None and self.profiler.trace_ops:
+                return profiling.traced_predict(self.keras_model, inputs,
+                                                self.profiler)
+            return self.keras_model.predict(inputs, verbose=0)
+
     def detect_molded(self, molded_images, image_metas, verbose=0):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
@@ -2570,19 +3667,12 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
+        # Run object detection. Anchors are generated inside the graph.
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.predict([molded_images, image_metas])
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2599,6 +3689,160 @@ class MaskRCNN():
             })
         return results
 
+    def detect_bucketed(self, images, verbose=0):
+        """Runs the detection pipeline on any number of images of any sizes.
+
+        Unlike detect(), the images don't have to mold to the same shape.
+        They're grouped in buckets by molded shape and each bucket is run in
+        batches of BATCH_SIZE (the last batch is filled by repeating its last
+        image). Use it with IMAGE_RESIZE_MODE "aspect" or "pad64" to avoid
+        padding every image to a square. The anchors of each shape are
+        generated in the graph, so all buckets share the same model.
+
+        images: List of images, potentially of different sizes.
+
+        Returns a list of dicts, one per image and in the same order, as
+        returned by detect(). Per-bucket timings are kept in
+        self.bucket_stats: {molded shape: {"images", "batches", "seconds",
+        "images_per_second"}}, accumulated over calls.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        batch_size = self.config.BATCH_SIZE
+        if not hasattr(self, "bucket_stats"):
+            self.bucket_stats = {}
+
+        # Mold images one by one and group them by molded shape
+        buckets = OrderedDict()
+        molded = []
+        for i, image in enumerate(images):
+            with profiling.stage(self.profiler, "mold"):
+                molded_images, image_metas, windows = self.mold_inputs([image])
+            molded.append((molded_images[0], image_metas[0], windows[0]))
+            buckets.setdefault(molded_images[0].shape, []).append(i)
+
+        results = [None] * len(images)
+        for shape, ids in buckets.items():
+            if verbose:
+                log("Bucket {}: {} images".format(shape, len(ids)))
+            stats = self.bucket_stats.setdefault(
+                shape, {"images": 0, "batches": 0, "seconds": 0.})
+            for b in range(0, len(ids), batch_size):
+                batch_ids = ids[b:b + batch_size]
+                # Fill the last batch with copies of its last image
+                padded_ids = batch_ids + [batch_ids[-1]] * (batch_size - len(batch_ids))
+                molded_images = np.stack([molded[i][0] for i in padded_ids])
+                image_metas = np.stack([molded[i][1] for i in padded_ids])
+
+                start = time.time()
+                detections, _, _, mrcnn_mask, _, _, _ =\
+                    self.predict([molded_images, image_metas])
+                stats["seconds"] += time.time() - start
+                stats["images"] += len(batch_ids)
+                stats["batches"] += 1
+
+                for j, i in enumerate(batch_ids):
+                    final_rois, final_class_ids, final_scores, final_masks, features =\
+                        self.unmold_detections(detections[j], mrcnn_mask[j],
+                                               images[i].shape, shape,
+                                               molded[i][2])
+                    results[i] = {
+                        "rois": final_rois,
+                        "class_ids": final_class_ids,
+                        "scores": final_scores,
+                        "masks": final_masks,
+                        "features": features,
+                    }
+            stats["images_per_second"] = stats["images"] / max(stats["seconds"], 1e-9)
+            if verbose:
+                log("Bucket {}: {:.2f} images/s".format(shape, stats["images_per_second"]))
+        return results
+
+    def detect_tiled(self, image, tile_size=1024, overlap=128, mask=None,
+                     nms_threshold=0.5, verbose=0):
+        """Runs the detection pipeline on overlapping tiles of a large image,
+        so small objects aren't lost by downscaling the whole image.
+
+        The tiles are run in batches of BATCH_SIZE and their detections are
+        moved to image coordinates and merged across tile seams with
+        per-class non-max suppression.
+
+        image: A single image [height, width, channels].
+        tile_size: Side of the tiles in pixels. Best set to IMAGE_MAX_DIM so
+            the tiles aren't resized.
+        overlap: Minimum overlap between neighbouring tiles in pixels. It
+            should be larger than the objects you want to detect in full.
+        mask: Optional [height, width] bool array. True marks the pixels to
+            ignore. Tiles that are fully masked are skipped.
+        nms_threshold: IoU threshold to merge duplicates across tiles.
+
+        Returns a dict as returned by detect() for the whole image.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        batch_size = self.config.BATCH_SIZE
+        tiles = utils.compute_tiles(image.shape[0], image.shape[1],
+                                    tile_size, overlap)
+        if mask is not None:
+            tiles = np.array([t for t in tiles
+                              if not mask[t[0]:t[2], t[1]:t[3]].all()],
+                             dtype=np.int32).reshape([-1, 4])
+        if verbose:
+            log("Processing {} tiles".format(len(tiles)))
+
+        rois, class_ids, scores, tile_masks, features = [], [], [], [], []
+        for b in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[b:b + batch_size]
+            # Fill the last batch with copies of its last tile
+            padded_tiles = list(batch_tiles) + \
+                [batch_tiles[-1]] * (batch_size - len(batch_tiles))
+            crops = [image[y1:y2, x1:x2] for y1, x1, y2, x2 in padded_tiles]
+            with profiling.stage(self.profiler, "mold"):
+                molded_images, image_metas, windows = self.mold_inputs(crops)
+            detections, _, _, mrcnn_mask, _, _, _ =\
+                self.predict([molded_images, image_metas])
+            for i, (y1, x1, y2, x2) in enumerate(batch_tiles):
+                t_rois, t_class_ids, t_scores, t_masks, t_features =\
+                    self.unmold_detections(detections[i], mrcnn_mask[i],
+                                           crops[i].shape, molded_images[i].shape,
+                                           windows[i])
+                rois.append(t_rois + np.array([y1, x1, y1, x1]))
+                class_ids.append(t_class_ids)
+                scores.append(t_scores)
+                # Keep the masks in tile coordinates until after the merge
+                tile_masks.extend((t_masks[..., j], (y1, x1))
+                                  for j in range(t_masks.shape[-1]))
+                features.append(t_features)
+
+        if not len(tiles):
+            # Everything is masked
+            rois = np.zeros([0, 4], dtype=np.int32)
+            class_ids = np.zeros([0], dtype=np.int32)
+            scores = np.zeros([0], dtype=np.float32)
+            features = np.zeros([0, self.config.FPN_CLASSIF_FC_LAYERS_SIZE],
+                                dtype=np.float32)
+        else:
+            rois = np.concatenate(rois)
+            class_ids = np.concatenate(class_ids)
+            scores = np.concatenate(scores)
+            features = np.concatenate(features)
+
+        # Merge duplicates across tile seams, class by class
+        keep = utils.non_max_suppression_class_aware(rois, scores, class_ids,
+                                                     nms_threshold)
+
+        # Paste the kept masks in the full image
+        full_masks = np.zeros(image.shape[:2] + (len(keep),), dtype=np.bool)
+        for j, i in enumerate(keep):
+            m, (y1, x1) = tile_masks[i]
+            full_masks[y1:y1 + m.shape[0], x1:x1 + m.shape[1], j] = m
+
+        return {
+            "rois": rois[keep],
+            "class_ids": class_ids[keep],
+            "scores": scores[keep],
+            "masks": full_masks,
+            "features": features[keep],
+        }
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
@@ -2606,13 +3850,15 @@ class MaskRCNN():
         if not hasattr(self, "_anchor_cache"):
             self._anchor_cache = {}
         if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
+            # Load Anchors. Shared with other processes if the config
+            # has an ANCHOR_CACHE_DIR.
+            a = utils.load_pyramid_anchors(
                 self.config.RPN_ANCHOR_SCALES,
                 self.config.RPN_ANCHOR_RATIOS,
                 backbone_shapes,
                 self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
+                self.config.RPN_ANCHOR_STRIDE,
+                cache_dir=self.config.ANCHOR_CACHE_DIR)
             # Keep a copy of the latest anchors in pixel coordinates because
             # it's used in inspect_model notebooks.
             # TODO: Remove this after the notebook are refactored to not use it
@@ -2670,6 +3916,37 @@ class MaskRCNN():
                 layers.append(l)
         return layers
 
+    def export_frozen_graph(self, path):
+        """Saves the inference graph, with its weights as constants, as a
+        frozen GraphDef, and its input and output names and the config in
+        path + ".json". FrozenMaskRCNN loads it without building the Keras
+        model or loading weights.
+
+        path: Path of the GraphDef file, e.g. "mask_rcnn_coco.pb".
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        keras_model = self.keras_model
+        session = K.get_session()
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(),
+            [t.op.name for t in keras_model.outputs])
+        learning_phase = None
+        if keras_model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            learning_phase = K.learning_phase().name
+        values, arrays = frozen_config_values(self.config)
+        metadata = {
+            "version": FrozenMaskRCNN.VERSION,
+            "inputs": [t.name for t in keras_model.inputs],
+            "outputs": [t.name for t in keras_model.outputs],
+            "learning_phase": learning_phase,
+            "config": values,
+            "config_arrays": arrays,
+        }
+        with open(path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        with open(path + ".json", "w") as f:
+            json.dump(metadata, f, indent=1)
+
     def run_graph(self, images, outputs, image_metas=None):
         """Runs a sub-set of the computation graph that computes the given
         outputs.
@@ -2701,13 +3978,7 @@ class MaskRCNN():
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = [molded_images, image_metas]
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
@@ -2722,6 +3993,116 @@ class MaskRCNN():
         return outputs_np
 
 
+############################################################
+#  Frozen Inference Graph
+############################################################
+
+def frozen_config_values(config):
+    """Returns the config values as a JSON serializable dict, and the list
+    of the keys whose values are NumPy arrays. Callables are skipped.
+    """
+    values = {}
+    arrays = []
+    for key in dir(config):
+        value = getattr(config, key)
+        if not key.isupper() or callable(value):
+            continue
+        if isinstance(value, np.ndarray):
+            arrays.append(key)
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        values[key] = value
+    return values, arrays
+
+
+class FrozenMaskRCNN(MaskRCNN):
+    """Inference model loaded from a frozen GraphDef saved by
+    MaskRCNN.export_frozen_graph().
+
+    Building the Keras model runs the layer code of ResNet, the FPN and the
+    heads in Python, and loading the weights reads the .h5 file layer by
+    layer. Here the graph, weights included, is imported in one step, into
+    its own tf.Graph and session. The detect methods work as in MaskRCNN.
+    There's no keras_model, so training, run_graph() and the methods that
+    walk the layers aren't available.
+
+    path: Path of the GraphDef file.
+    config: Optional. The inference config. By default, the one saved with
+        the graph. Values baked into the graph (e.g. IMAGES_PER_GPU,
+        NUM_CLASSES, the detection thresholds) can't change. A warning
+        lists the keys that differ from the exported config.
+    """
+
+    # Bump when the metadata format changes
+    VERSION = 1
+
+    def __init__(self, path, config=None):
+        with open(path + ".json") as f:
+            metadata = json.load(f)
+        assert metadata["version"] == self.VERSION, \
+            "Unsupported frozen graph version {}".format(metadata["version"])
+
+        if config is None:
+            from mrcnn.config import Config
+            config = Config()
+            for key, value in metadata["config"].items():
+                if key in metadata["config_arrays"]:
+                    value = np.array(value)
+                setattr(config, key, value)
+        else:
+            values, _ = frozen_config_values(config)
+            changed = sorted(k for k, v in metadata["config"].items()
+                             if json.loads(json.dumps(values.get(k))) != v)
+            if changed:
+                logging.warning("Config values differ from the frozen graph's, which "
+                                "uses its own: {}".format(", ".join(changed)))
+
+        self.mode = "inference"
+        self.config = config
+        self.model_dir = os.path.dirname(os.path.abspath(path))
+        self.profiler = None
+        self.resume_state = None
+        self.keras_model = None
+        self.epoch = 0
+
+        graph_def = tf.GraphDef()
+        with open(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph)
+        self.inputs = [self.graph.get_tensor_by_name(n) for n in metadata["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(n) for n in metadata["outputs"]]
+        # Inference mode if the graph depends on the learning phase
+        self.feed = {}
+        if metadata["learning_phase"]:
+            names = [op.name for op in self.graph.get_operations()]
+            if metadata["learning_phase"].split(":")[0] in names:
+                self.feed[self.graph.get_tensor_by_name(metadata["learning_phase"])] = False
+
+    def predict(self, inputs):
+        """Runs the frozen graph on a batch of molded inputs. See
+        MaskRCNN.predict().
+        """
+        with profiling.stage(self.profiler, "predict"):
+            feed_dict = dict(zip(self.inputs, inputs))
+            feed_dict.update(self.feed)
+            if self.profiler is not None and self.profiler.trace_ops:
+                options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                run_metadata = tf.RunMetadata()
+                outputs = self.session.run(self.outputs, feed_dict, options=options,
+                                           run_metadata=run_metadata)
+                self.profiler.add_run_metadata(run_metadata)
+                return outputs
+            return self.session.run(self.outputs, feed_dict)
+
+    def close(self):
+        """Frees the session."""
+        self.session.close()
+
+
 ############################################################
 #  Data Formatting
 ############################################################
@@ -2838,6 +4219,23 @@ def batch_pack_graph(x, counts, num_rows):
     return tf.concat(outputs, axis=0)
 
 
+def batch_gather_graph(params, indices):
+    """Gathers rows from each item in a batch using a different set of
+    indices per item. Same as running tf.gather() on every batch item,
+    but done with one gather_nd op rather than a loop over the batch.
+
+    params: [batch, N, ...]
+    indices: [batch, K] Integer indices into the second dimension of params.
+
+    Returns: [batch, K, ...]
+    """
+    indices = tf.cast(indices, tf.int32)
+    batch_size = tf.shape(indices)[0]
+    count = tf.shape(indices)[1]
+    batch_ix = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, count])
+    return tf.gather_nd(params, tf.stack([batch_ix, indices], axis=2))
+
+
 def norm_boxes_graph(boxes, shape):
     """Converts boxes from pixel coordinates to normalized coordinates.
     boxes: [..., (y1, x1, y2, x2)] in pixel coordinates
@@ -0,0 +1,193 @@
+"""
+Mask R-CNN
+Latency instrumentation of the inference path.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Usage:
+
+    from mrcnn import profiling
+
+    model.profiler = profiling.Profiler(trace_ops=True)
+    model.detect([image])
+    print(model.profiler.summary())
+    model.profiler.save_json("profile.json")
+    # Open in chrome://tracing or https://ui.perfetto.dev
+    model.profiler.save_chrome_trace("trace.json")
+"""
+
+import re
+import json
+import time
+import contextlib
+from collections import OrderedDict
+import numpy as np
+
+
+############################################################
+#  Graph Stages
+############################################################
+
+# Maps TF op names to the part of the network they belong to. Ops are named
+# after the Keras layer that created them, so the layer names used in
+# MaskRCNN.build() are enough. The first matching pattern wins.
+OP_STAGES = [
+    ("detection", re.compile(r"^mrcnn_detection(_\d+)?/")),
+    ("proposals", re.compile(r"^ROI(_\d+)?/")),
+    ("roi_align", re.compile(r"^roi_align_")),
+    ("heads", re.compile(r"^(mrcnn_|pool_squeeze)")),
+    ("rpn", re.compile(r"^rpn_")),
+    ("anchors", re.compile(r"^anchors(_\d+)?/")),
+    ("fpn", re.compile(r"^fpn_")),
+    ("backbone", re.compile(r"^(conv1|bn_conv1|res\d|bn\d|activation|"
+                            r"zero_padding2d|max_pooling2d|add_)")),
+]
+
+
+def op_stage(op_name):
+    """Returns the stage of the network (backbone, fpn, anchors, rpn,
+    proposals, roi_align, heads, detection) that a TF op belongs to, or
+    "other" if it can't be attributed.
+    """
+    for stage, pattern in OP_STAGES:
+        if pattern.match(op_name):
+            return stage
+    return "other"
+
+
+############################################################
+#  Profiler
+############################################################
+
+class Profiler(object):
+    """Records the wall time of the stages of each detection call.
+
+    Host stages (mold, predict, unmold, paste_masks) are timed by
+    MaskRCNN when its profiler attribute is set. If trace_ops is True,
+    predict runs with full TF tracing and the time of each op is recorded
+    and attributed to a network stage with op_stage(). Tracing adds
+    overhead, so compare traced runs with traced runs only.
+    """
+
+    def __init__(self, trace_ops=False):
+        self.trace_ops = trace_ops
+        self.reset()
+
+    def reset(self):
+        """Drops all recorded events."""
+        # Host stages: (name, start in seconds, duration in seconds)
+        self.events = []
+        # TF ops: (op name, device, stage, start in seconds, duration in seconds)
+        self.op_events = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that times the code in its block as a stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.events.append((name, start, time.time() - start))
+
+    def add_run_metadata(self, run_metadata):
+        """Records the op timings of a tf.RunMetadata collected with
+        tf.RunOptions.FULL_TRACE.
+        """
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                # Drop the ":kernel" style suffixes of some devices
+                name = node.node_name.split(":")[0]
+                self.op_events.append((
+                    name, dev_stats.device, op_stage(name),
+                    node.all_start_micros / 1e6,
+                    node.all_end_rel_micros / 1e6))
+
+    def summary(self):
+        """Returns per-stage statistics in milliseconds.
+
+        Returns: OrderedDict {stage: {"count", "total_ms", "mean_ms",
+            "p50_ms", "p95_ms"}}. Host stages first, in the order they
+            first ran, then TF op stages prefixed with "ops/". Op stages
+            sum the time of all ops, which can exceed the wall time when
+            ops run in parallel.
+        """
+        durations = OrderedDict()
+        for name, _, duration in self.events:
+            durations.setdefault(name, []).append(duration)
+        for _, _, stage, _, duration in self.op_events:
+            durations.setdefault("ops/" + stage, []).append(duration)
+
+        stats = OrderedDict()
+        for name, d in durations.items():
+            d = np.array(d) * 1000
+            stats[name] = {
+                "count": len(d),
+                "total_ms": float(d.sum()),
+                "mean_ms": float(d.mean()),
+                "p50_ms": float(np.percentile(d, 50)),
+                "p95_ms": float(np.percentile(d, 95)),
+            }
+        return stats
+
+    def save_json(self, path):
+        """Saves the summary and the raw host stage events to a JSON file."""
+        data = {
+            "summary": self.summary(),
+            "events": [{"name": n, "start": s, "duration": d}
+                       for n, s, d in self.events],
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+    def save_chrome_trace(self, path):
+        """Saves all events in the Chrome trace event format.
+
+        Host stages are on process 0. TF ops are on process 1, one thread
+        per device, with the network stage as the event category.
+        """
+        events = [{"name": n, "cat": "host", "ph": "X", "pid": 0, "tid": 0,
+                   "ts": s * 1e6, "dur": d * 1e6}
+                  for n, s, d in self.events]
+        devices = OrderedDict()
+        for name, device, stage, start, duration in self.op_events:
+            tid = devices.setdefault(device, len(devices))
+            events.append({"name": name, "cat": stage, "ph": "X", "pid": 1,
+                           "tid": tid, "ts": start * 1e6, "dur": duration * 1e6})
+        # Name the device threads
+        for device, tid in devices.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                           "tid": tid, "args": {"name": device}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+def stage(profiler, name):
+    """Times a stage with the given profiler. Does nothing if profiler is None."""
+    if profiler is None:
+        return _null_stage()
+    return profiler.stage(name)
+
+
+@contextlib.contextmanager
+def _null_stage():
+    yield
+
+
+def traced_predict(keras_model, inputs, profiler):
+    """Runs keras_model on a batch of inputs with full TF tracing and adds
+    the op timings to the profiler. Same results as keras_model.predict().
+
+    inputs: List of numpy arrays, one per model input.
+    """
+    import tensorflow as tf
+    import keras.backend as K
+
+    feed_dict = dict(zip(keras_model.inputs, inputs))
+    if keras_model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+        feed_dict[K.learning_phase()] = 0
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    outputs = K.get_session().run(keras_model.outputs, feed_dict,
+                                  options=options, run_metadata=run_metadata)
+    profiler.add_run_metadata(run_metadata)
+    return outputs
@@ -0,0 +1,320 @@
+"""
+Mask R-CNN
+On-disk cache of preprocessed training samples.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Loading a training sample decodes the image, rasterizes its masks and
+resizes both, every epoch. The cache stores the result of these steps
+(everything before augmentation) once, in shards of memory-mappable .npy
+files, and load_image_gt() reads from it instead.
+
+A cache is specific to a dataset and to the config values that change the
+preprocessing. Both are hashed into a fingerprint, which names the cache
+directory, so a stale cache is never used.
+
+Usage:
+
+    cache = SampleCache.open_or_build(dataset_train, config, "/data/cache")
+    generator = data_generator(dataset_train, config, sample_cache=cache)
+
+Or set SAMPLE_CACHE_DIR in the config and MaskRCNN.train() does it.
+"""
+
+import io
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+from mrcnn import utils
+
+
+# Config values that affect the cached samples
+FINGERPRINT_CONFIG_KEYS = [
+    "IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_MIN_SCALE",
+    "IMAGE_CHANNEL_COUNT", "USE_MINI_MASK", "MINI_MASK_SHAPE", "TRAIN_BUCKETS",
+]
+
+# Bump when the storage format changes
+CACHE_VERSION = 1
+
+
+def fingerprint(dataset, config):
+    """Returns a hash of the dataset images and classes and of the config
+    values that affect preprocessing.
+    """
+    images = [(info["id"], info["source"], str(info.get("path")))
+              for info in dataset.image_info]
+    classes = [(c["source"], c["id"], c["name"]) for c in dataset.class_info]
+    settings = [(k, repr(getattr(config, k))) for k in FINGERPRINT_CONFIG_KEYS]
+    key = repr((CACHE_VERSION, images, classes, settings))
+    return hashlib.sha1(key.encode("utf8")).hexdigest()[:16]
+
+
+class SampleCache(object):
+    """Preprocessed samples of a dataset, stored in memory-mapped shards.
+
+    For each image it stores the resized uint8 image, the resize window and
+    scale, the class IDs, the instance masks as box-local bitmaps
+    (utils.CompactMasks), their bounding boxes and, if the config uses
+    mini-masks, the mini-masks. Instances whose mask is empty after resizing
+    are dropped, as load_image_gt() would.
+
+    Mini-masks are only valid without augmentation, because they're made
+    after it. With augmentation the full resolution bitmaps are used.
+    """
+
+    def __init__(self, path):
+        """Opens an existing cache directory."""
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.info = json.load(f)
+        self.shards = []
+        # image_id -> (shard, row in shard)
+        self.rows = {}
+        for s in range(self.info["shard_count"]):
+            index = dict(np.load(os.path.join(path, "index_{:05d}.npz".format(s))))
+            for row, image_id in enumerate(index["image_ids"]):
+                self.rows[int(image_id)] = (s, row)
+            self.shards.append({"index": index, "arrays": None})
+
+    def _arrays(self, shard):
+        """Memory-maps the data files of a shard on first use. Opening lazily
+        keeps file handles out of the object until a worker process needs
+        them.
+        """
+        if self.shards[shard]["arrays"] is None:
+            arrays = {}
+            for name in ["images", "bitmaps", "mini_masks"]:
+                filename = os.path.join(self.path, "{}_{:05d}.npy".format(name, shard))
+                if os.path.exists(filename):
+                    arrays[name] = np.load(filename, mmap_mode="r")
+            self.shards[shard]["arrays"] = arrays
+        return self.shards[shard]["arrays"]
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # Don't pickle memory maps. Each process opens its own.
+        state = self.__dict__.copy()
+        state["shards"] = [{"index": s["index"], "arrays": None} for s in self.shards]
+        return state
+
+    def load(self, image_id):
+        """Returns the cached sample of an image as a dict with keys:
+        image, original_shape, window, scale, class_ids, masks
+        (CompactMasks), bbox and mini_masks (None if not cached).
+        """
+        shard, row = self.rows[int(image_id)]
+        index = self.shards[shard]["index"]
+        arrays = self._arrays(shard)
+
+        start, end = index["image_offsets"][row:row + 2]
+        image_shape = tuple(index["image_shapes"][row])
+        image = np.array(arrays["images"][start:end]).reshape(image_shape)
+
+        i1, i2 = index["instance_offsets"][row:row + 2]
+        boxes = index["bitmap_boxes"][i1:i2]
+        offsets = index["bitmap_offsets"]
+        bitmaps = []
+        for i, (y1, x1, y2, x2) in zip(range(i1, i2), boxes):
+            bitmaps.append(np.array(arrays["bitmaps"][offsets[i]:offsets[i + 1]],
+                                    dtype=bool).reshape([y2 - y1, x2 - x1]))
+        mini_masks = None
+        if "mini_masks" in arrays:
+            mini_masks = np.array(arrays["mini_masks"][i1:i2]).transpose([1, 2, 0])
+        return {
+            "image": image,
+            "original_shape": tuple(index["original_shapes"][row]),
+            "window": tuple(index["windows"][row]),
+            "scale": float(index["scales"][row]),
+            "class_ids": index["class_ids"][i1:i2].copy(),
+            "masks": utils.CompactMasks(image_shape, boxes, bitmaps),
+            "bbox": index["bboxes"][i1:i2].copy(),
+            "mini_masks": mini_masks,
+        }
+
+    @classmethod
+    def open_or_build(cls, dataset, config, cache_dir, shard_size=256, verbose=1):
+        """Opens the cache of the dataset and config in cache_dir, building
+        it first if it doesn't exist.
+
+        shard_size: Number of images per shard.
+        """
+        assert config.IMAGE_RESIZE_MODE != "crop" or config.TRAIN_BUCKETS, \
+            "Random crops can't be cached. Use another IMAGE_RESIZE_MODE."
+        path = os.path.join(cache_dir, "samples_" + fingerprint(dataset, config))
+        if not os.path.exists(os.path.join(path, "index.json")):
+            cls.build(dataset, config, path, shard_size, verbose)
+        return cls(path)
+
+    @staticmethod
+    def build(dataset, config, path, shard_size=256, verbose=1):
+        """Preprocesses all the images of the dataset and writes the cache
+        to path. Writes to a temporary directory first and renames it, so
+        readers never see a partial cache.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        image_ids = list(dataset.image_ids)
+        shard_count = 0
+        for start in range(0, len(image_ids), shard_size):
+            _write_shard(dataset, config, image_ids[start:start + shard_size],
+                         tmp_path, shard_count)
+            shard_count += 1
+            if verbose:
+                logging.info("Sample cache: {}/{} images".format(
+                    min(start + shard_size, len(image_ids)), len(image_ids)))
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump({"version": CACHE_VERSION, "shard_count": shard_count,
+                       "image_count": len(image_ids)}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process built it first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class _ShardArray(object):
+    """A shard .npy file that samples are appended to as they're produced,
+    so a shard is never held in memory. The file is preallocated with
+    np.lib.format.open_memmap() for expected_appends appends of the size of
+    the first one, grown if that's not enough, and trimmed by close().
+    """
+
+    def __init__(self, filename, dtype, item_shape=(), expected_appends=1):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.item_shape = tuple(item_shape)
+        self.expected_appends = expected_appends
+        self.size = 0
+        self.array = None
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype).reshape((-1,) + self.item_shape)
+        end = self.size + values.shape[0]
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(
+                self.filename, mode="w+", dtype=self.dtype,
+                shape=(max(values.shape[0] * self.expected_appends, 1),) + self.item_shape)
+        elif end > self.array.shape[0]:
+            self._resize(max(end, 2 * self.array.shape[0]))
+        self.array[self.size:end] = values
+        self.size = end
+
+    def close(self):
+        """Trims the file to the appended rows and closes it."""
+        if self.array is None:
+            np.save(self.filename, np.zeros((0,) + self.item_shape, dtype=self.dtype))
+            return
+        self._resize(self.size)
+        self.array = None
+
+    def _resize(self, rows):
+        """Changes the number of rows of the file, keeping the appended ones."""
+        self.array.flush()
+        offset = self.array.offset
+        self.array = None
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (rows,) + self.item_shape})
+        header = header.getvalue()
+        row_bytes = self.dtype.itemsize * int(np.prod(self.item_shape))
+        if len(header) == offset:
+            # Same header size: update the shape and resize the file in place
+            with open(self.filename, "r+b") as f:
+                f.write(header)
+                f.truncate(offset + rows * row_bytes)
+        else:
+            # The data moves. Copy it to a new file in chunks.
+            old = np.load(self.filename, mmap_mode="r")
+            tmp_filename = self.filename + ".tmp"
+            new = np.lib.format.open_memmap(tmp_filename, mode="w+", dtype=self.dtype,
+                                            shape=(rows,) + self.item_shape)
+            step = max(2 ** 26 // max(row_bytes, 1), 1)
+            end = min(self.size, rows)
+            for start in range(0, end, step):
+                new[start:min(start + step, end)] = old[start:min(start + step, end)]
+            new.flush()
+            del old, new
+            os.replace(tmp_filename, self.filename)
+        if rows:
+            self.array = np.load(self.filename, mmap_mode="r+")
+
+
+def _write_shard(dataset, config, image_ids, path, shard):
+    """Preprocesses a list of images and writes them as one shard. The
+    images, bitmaps and mini-masks are written to the shard files as each
+    sample is produced.
+    """
+    def shard_array(name, dtype, item_shape=()):
+        return _ShardArray(os.path.join(path, "{}_{:05d}.npy".format(name, shard)),
+                           dtype, item_shape, expected_appends=len(image_ids))
+
+    images = shard_array("images", np.uint8)
+    bitmaps = shard_array("bitmaps", bool)
+    mini_masks = shard_array("mini_masks", bool, config.MINI_MASK_SHAPE) \
+        if config.USE_MINI_MASK else None
+    index = {k: [] for k in ["image_ids", "image_shapes", "original_shapes",
+                             "windows", "scales", "class_ids", "bitmap_boxes",
+                             "bboxes"]}
+    image_offsets = [0]
+    instance_offsets = [0]
+    bitmap_offsets = [0]
+    for image_id in image_ids:
+        # Same steps as load_image_gt() before augmentation
+        image = dataset.load_image(image_id)
+        masks, class_ids = dataset.load_compact_mask(image_id)
+        original_shape = image.shape
+        image, window, scale, padding, crop = utils.resize_training_image(image, config)
+        masks = masks.resize(scale, padding, crop)
+        keep = masks.areas() > 0
+        masks = masks.select(keep)
+        class_ids = np.asarray(class_ids)[keep]
+        bbox = masks.extract_bboxes()
+
+        images.append(image.ravel())
+        image_offsets.append(image_offsets[-1] + image.size)
+        index["image_ids"].append(image_id)
+        index["image_shapes"].append(image.shape)
+        index["original_shapes"].append(original_shape)
+        index["windows"].append(window)
+        index["scales"].append(scale)
+        index["class_ids"].extend(class_ids)
+        index["bitmap_boxes"].extend(masks.boxes)
+        index["bboxes"].extend(bbox)
+        if len(masks):
+            bitmaps.append(np.concatenate([m.ravel() for m in masks.bitmaps]))
+        for m in masks.bitmaps:
+            bitmap_offsets.append(bitmap_offsets[-1] + m.size)
+        instance_offsets.append(instance_offsets[-1] + len(masks))
+        if mini_masks is not None:
+            mini_masks.append(masks.minimize(bbox, config.MINI_MASK_SHAPE)
+                              .transpose([2, 0, 1]))
+
+    images.close()
+    bitmaps.close()
+    if mini_masks is not None:
+        mini_masks.close()
+
+    np.savez(os.path.join(path, "index_{:05d}.npz".format(shard)),
+             image_ids=np.array(index["image_ids"], dtype=np.int64),
+             image_offsets=np.array(image_offsets, dtype=np.int64),
+             image_shapes=np.array(index["image_shapes"], dtype=np.int64).reshape([-1, 3]),
+             original_shapes=np.array(index["original_shapes"], dtype=np.int64).reshape([-1, 3]),
+             windows=np.array(index["windows"], dtype=np.int64).reshape([-1, 4]),
+             scales=np.array(index["scales"], dtype=np.float64),
+             class_ids=np.array(index["class_ids"], dtype=np.int32),
+             bitmap_boxes=np.array(index["bitmap_boxes"], dtype=np.int32).reshape([-1, 4]),
+             bboxes=np.array(index["bboxes"], dtype=np.int32).reshape([-1, 4]),
+             instance_offsets=np.array(instance_offsets, dtype=np.int64),
+             bitmap_offsets=np.array(bitmap_offsets, dtype=np.int64))
@@ -0,0 +1,180 @@
+"""
+Mask R-CNN
+Full training state checkpoints, for resuming training.
+
+Licensed under the MIT License (see LICENSE for details)
+
+The weight checkpoints that train() saves at the end of each epoch are
+enough to fine-tune from, but not to resume: the optimizer starts with no
+momentum, the data loader restarts at the beginning of a pass over the
+dataset, and a partial epoch is lost. A training state file has all of it:
+
+- The weights of every layer, by layer name.
+- The optimizer weights: iteration counter, momentum and, with
+  model.AccumulatedSGD, the gradient accumulators and the loss scale.
+- The epoch, the step within the epoch and the layers being trained.
+- The position of the data loader (data epoch and batch index). Batches
+  are a function of (seed, epoch, index), see model.TrainingSequence, so
+  this and the seed are enough to continue with the same batches.
+- The NumPy and Python random states.
+
+A resumed run loads the same batches, with the same augmentations and RPN
+targets, and continues with the same weights and optimizer state. It isn't
+an exact replay of the uninterrupted run, though. The ROI sampling of the
+detection targets (tf.random_shuffle() in detection_targets_graph()) runs
+in the TensorFlow graph. Its ops have no seed, and their random state
+isn't saved. It starts over with the new session, so the resumed run
+samples other ROIs. GPU kernels can also be nondeterministic.
+
+The file is replaced atomically, so a job stopped while saving leaves the
+previous state intact.
+
+Usage:
+
+    model = modellib.MaskRCNN(mode="training", config=config, model_dir=MODEL_DIR)
+    try:
+        model.load_training_state()
+    except FileNotFoundError:
+        model.load_weights(COCO_MODEL_PATH, by_name=True, exclude=[...])
+    model.train(dataset_train, dataset_val, learning_rate, epochs, "heads")
+
+See config.TRAINING_STATE_STEPS.
+"""
+
+import os
+import json
+import random
+import numpy as np
+import keras
+
+
+# Bump when the storage format changes
+STATE_VERSION = 1
+
+# Name of the state file in the log directory
+STATE_FILENAME = "training_state.npz"
+
+
+def save(path, keras_model, optimizer, state):
+    """Writes a training state file.
+
+    keras_model: The model whose weights to save. ParallelModel wrappers
+        are handled.
+    optimizer: The optimizer of the compiled training model, or None.
+    state: Dict of JSON serializable values: epoch, step, layers,
+        loader_position, seed. The NumPy and Python random states are
+        added here. The in-graph TensorFlow random state isn't saved.
+    """
+    model = keras_model.inner_model if hasattr(keras_model, "inner_model") \
+        else keras_model
+    arrays = {}
+    layers = []
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue
+        layers.append(layer.name)
+        for i, w in enumerate(weights):
+            arrays["weights/{}/{}".format(layer.name, i)] = w
+    optimizer_weights = optimizer.get_weights() if optimizer is not None else []
+    for i, w in enumerate(optimizer_weights):
+        arrays["optimizer/{}".format(i)] = w
+
+    numpy_state = np.random.get_state()
+    arrays["numpy_random_keys"] = numpy_state[1]
+    version, internal, gauss_next = random.getstate()
+    state = dict(state, version=STATE_VERSION, layer_names=layers,
+                 optimizer_count=len(optimizer_weights),
+                 numpy_random=[numpy_state[0], int(numpy_state[2]),
+                               int(numpy_state[3]), float(numpy_state[4])],
+                 python_random=[version, list(internal), gauss_next])
+    arrays["state"] = np.array(json.dumps(state))
+
+    # Write next to the target and rename, which is atomic on POSIX
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """Reads a training state file.
+
+    Returns a dict with:
+    weights: {layer name: [weight arrays]}
+    optimizer: List of the optimizer weights.
+    state: The state dict given to save(), with the random states.
+    """
+    with np.load(path) as data:
+        state = json.loads(str(data["state"]))
+        assert state["version"] == STATE_VERSION, \
+            "Unsupported training state version {}".format(state["version"])
+        weights = {}
+        for name in state["layer_names"]:
+            count = 0
+            while "weights/{}/{}".format(name, count) in data:
+                count += 1
+            weights[name] = [data["weights/{}/{}".format(name, i)]
+                             for i in range(count)]
+        optimizer = [data["optimizer/{}".format(i)]
+                     for i in range(state["optimizer_count"])]
+        state["numpy_random_keys"] = data["numpy_random_keys"]
+    return {"weights": weights, "optimizer": optimizer, "state": state}
+
+
+def restore_random_state(state):
+    """Sets the NumPy and Python random states saved in a state dict."""
+    name, pos, has_gauss, cached_gaussian = state["numpy_random"]
+    np.random.set_state((name, state["numpy_random_keys"], pos, has_gauss,
+                         cached_gaussian))
+    version, internal, gauss_next = state["python_random"]
+    random.setstate((version, tuple(internal), gauss_next))
+
+
+def find_last(model_dir, name):
+    """Returns the path of the training state file of the last log
+    directory of the given config name in model_dir that has one, or None.
+    """
+    if not os.path.isdir(model_dir):
+        return None
+    dir_names = sorted(d for d in next(os.walk(model_dir))[1]
+                       if d.startswith(name.lower()))
+    for dir_name in reversed(dir_names):
+        path = os.path.join(model_dir, dir_name, STATE_FILENAME)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class TrainingStateCheckpoint(keras.callbacks.Callback):
+    """Saves the training state at the end of each epoch and every steps
+    training steps.
+
+    save_fn: Function (epoch, step) that saves the state. step is the
+        number of steps done in epoch, so the state at the end of an epoch
+        is (epoch + 1, 0).
+    steps: Save every this many steps. 0 saves at the end of epochs only.
+    step_offset: Steps of the first epoch done before this callback
+        started, when resuming in the middle of an epoch.
+    """
+
+    def __init__(self, save_fn, steps=0, step_offset=0):
+        super(TrainingStateCheckpoint, self).__init__()
+        self.save_fn = save_fn
+        self.steps = steps
+        self.step_offset = step_offset
+        self.epoch = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        step = self.step_offset + batch + 1
+        if self.steps and step % self.steps == 0:
+            self.save_fn(self.epoch, step)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.step_offset = 0
+        self.save_fn(epoch + 1, 0)
@@ -14,13 +14,13 @@ import math
 import random
 import numpy as np
 import tensorflow as tf
-import scipy
+import scipy.sparse
 import skimage.color
 import skimage.io
 import skimage.transform
 import urllib.request
 import shutil
-import warnings
+import hashlib
 from distutils.version import LooseVersion
 
 # URL from which to download the latest COCO trained weights
@@ -78,25 +78,104 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def compute_overlaps(boxes1, boxes2, chunk_size=2 ** 16):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    chunk_size: Maximum number of pairs computed at once. Bounds the size of
+        the temporary arrays when boxes1 is large (e.g. all the anchors).
 
     For better performance, pass the largest set first and the smaller second.
+
+    This computes all the pairs, by broadcasting. It's the faster choice for
+    the small sets of build_detection_targets() and compute_recall(), a few
+    thousand boxes at most. When boxes1 is large and each box of boxes2
+    overlaps few of them, as with the anchors and the GT boxes, use
+    compute_overlaps_sparse(), which only tests the pairs that can overlap.
     """
     # Areas of anchors and GT boxes
     area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
+    # Each cell contains the IoU value. Broadcast over chunks of boxes1,
+    # reusing the temporaries of each chunk.
     overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    step = max(chunk_size // max(boxes2.shape[0], 1), 1)
+    for start in range(0, boxes1.shape[0], step):
+        b1 = boxes1[start:start + step, None]
+        y1 = np.maximum(b1[..., 0], boxes2[:, 0])
+        height = np.minimum(b1[..., 2], boxes2[:, 2])
+        height -= y1
+        np.maximum(height, 0, out=height)
+        x1 = np.maximum(b1[..., 1], boxes2[:, 1])
+        intersection = np.minimum(b1[..., 3], boxes2[:, 3])
+        intersection -= x1
+        np.maximum(intersection, 0, out=intersection)
+        intersection *= height
+        # Union, in the buffer of y1
+        union = np.add(area2, area1[start:start + step, None], out=y1)
+        union -= intersection
+        np.divide(intersection, union, out=overlaps[start:start + step])
     return overlaps
 
 
+def compute_overlaps_sparse(boxes1, boxes2, threshold=0.0, index=None):
+    """Computes the IoU overlaps between two sets of boxes that are at
+    least a threshold, without testing the pairs that can't reach it.
+
+    boxes1: [N, (y1, x1, y2, x2)]. The large set, e.g. the anchors.
+    boxes2: [M, (y1, x1, y2, x2)]. The small set, e.g. the GT boxes.
+    threshold: Scalar, or [M] with a threshold per box of boxes2. Pairs
+        with an IoU >= threshold, and > 0, are kept.
+    index: Optional BoxIndex of boxes1. Build it once and pass it in when
+        boxes1 is reused, as with the anchors.
+
+    Returns: scipy.sparse.csr_matrix [N, M] of the kept IoU values, with
+        sorted indices. Missing entries are the other pairs.
+    """
+    if index is None:
+        index = BoxIndex(boxes1)
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=np.float64),
+                                boxes2.shape[:1])
+    # Dense overlaps of the boxes of boxes1 that can reach the threshold
+    rows = index.query(boxes2, threshold)
+    overlaps = compute_overlaps(boxes1[rows], boxes2)
+    ids, cols = np.nonzero((overlaps >= threshold) & (overlaps > 0))
+    # np.nonzero() is in row-major order, so this is already CSR order
+    indptr = np.zeros([boxes1.shape[0] + 1], dtype=np.int64)
+    np.cumsum(np.bincount(rows[ids], minlength=boxes1.shape[0]), out=indptr[1:])
+    return scipy.sparse.csr_matrix((overlaps[ids, cols], cols, indptr),
+                                   shape=(boxes1.shape[0], boxes2.shape[0]))
+
+
+def sparse_row_max(matrix):
+    """Returns the maximum of each row of a CSR matrix of non-negative
+    values, and its column. Rows without entries give 0 and column 0, as
+    a dense matrix of zeros would.
+    """
+    counts = np.diff(matrix.indptr)
+    rows = np.flatnonzero(counts)
+    row_max = np.zeros([matrix.shape[0]])
+    row_argmax = np.zeros([matrix.shape[0]], dtype=np.int64)
+    if rows.shape[0] > 0:
+        row_max[rows] = np.maximum.reduceat(matrix.data, matrix.indptr[rows])
+        # First entry of each row equal to its maximum. The indices are
+        # sorted, so that's the lowest column, as np.argmax() gives.
+        entry_rows = np.repeat(np.arange(matrix.shape[0]), counts)
+        is_max = np.flatnonzero(matrix.data == row_max[entry_rows])
+        _, first = np.unique(entry_rows[is_max], return_index=True)
+        row_argmax[rows] = matrix.indices[is_max[first]]
+    return row_max, row_argmax
+
+
+def sparse_argmax_rows(matrix, column_max):
+    """Returns the sorted rows of a CSR matrix that have an entry equal to
+    the maximum of its column, column_max.
+    """
+    entry_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return np.unique(entry_rows[matrix.data == column_max[matrix.indices]])
+
+
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
     masks1, masks2: [Height, Width, instances]
@@ -119,41 +198,266 @@ def compute_overlaps_masks(masks1, masks2):
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def non_max_suppression(boxes, scores, threshold, max_output=None, block_size=512):
     """Performs non-maximum suppression and returns indices of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    max_output: Optional. Stop after keeping this many boxes.
+    block_size: Boxes are processed in blocks of this size, in order of
+        score. The IoUs within a block and of the kept boxes of a block with
+        all lower scoring boxes are computed as matrices, so the Python loop
+        only touches one row per box and nothing is reallocated.
+
+    Returns the indices of the kept boxes, highest score first. Same result
+    as the greedy one-box-at-a-time algorithm.
     """
     assert boxes.shape[0] > 0
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
 
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
     # Get indicies of boxes sorted by scores (highest first)
     ixs = scores.argsort()[::-1]
-
+    boxes = boxes[ixs]
+    # Compute box areas
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    def iou_matrix(a, b):
+        """IoU of boxes[a] (rows) with boxes[b] (columns)."""
+        y1 = np.maximum(boxes[a, None, 0], boxes[None, b, 0])
+        y2 = np.minimum(boxes[a, None, 2], boxes[None, b, 2])
+        x1 = np.maximum(boxes[a, None, 1], boxes[None, b, 1])
+        x2 = np.minimum(boxes[a, None, 3], boxes[None, b, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        return intersection / (area[a, None] + area[None, b] - intersection)
+
+    n = boxes.shape[0]
+    suppressed = np.zeros([n], dtype=bool)
     pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    for start in range(0, n, block_size):
+        block = np.arange(start, min(start + block_size, n))
+        # Greedy pass within the block
+        overlap = iou_matrix(block, block) > threshold
+        kept = []
+        for k, i in enumerate(block):
+            if suppressed[i]:
+                continue
+            kept.append(i)
+            suppressed[block[k + 1:]] |= overlap[k, k + 1:]
+            if max_output and len(pick) + len(kept) >= max_output:
+                break
+        pick.extend(kept)
+        if max_output and len(pick) >= max_output:
+            break
+        # Kept boxes of the block suppress the lower scoring ones
+        rest = np.arange(block[-1] + 1, n)
+        if kept and rest.shape[0]:
+            rest = rest[~suppressed[rest]]
+            suppressed[rest] |= np.any(iou_matrix(np.array(kept), rest) > threshold, axis=0)
+    return ixs[np.array(pick, dtype=np.int64)].astype(np.int32)
+
+
+def non_max_suppression_class_aware(boxes, scores, class_ids, threshold,
+                                    max_output=None):
+    """Performs non-maximum suppression independently for each class.
+    boxes: [N, (y1, x1, y2, x2)]
+    scores: [N] box scores.
+    class_ids: [N] integer class IDs.
+    threshold: Float. IoU threshold to use for filtering.
+    max_output: Optional. Maximum number of boxes kept over all classes.
+
+    Returns the indices of the kept boxes, highest score first.
+    """
+    keep = []
+    for class_id in np.unique(class_ids):
+        ixs = np.where(class_ids == class_id)[0]
+        keep.append(ixs[non_max_suppression(boxes[ixs], scores[ixs], threshold,
+                                            max_output=max_output)])
+    if not keep:
+        return np.zeros([0], dtype=np.int32)
+    keep = np.concatenate(keep)
+    keep = keep[np.argsort(-scores[keep], kind="stable")]
+    return keep[:max_output].astype(np.int32)
+
+
+def batched_non_max_suppression(boxes, scores, threshold, max_output,
+                                class_ids=None):
+    """Performs non-maximum suppression on each item of a batch.
+    boxes: [batch, N, (y1, x1, y2, x2)]
+    scores: [batch, N] box scores. Padding boxes can be given a score of
+        -np.inf, they're never kept.
+    threshold: Float. IoU threshold to use for filtering.
+    max_output: Maximum number of boxes kept per item.
+    class_ids: Optional [batch, N]. If given, NMS is class-aware.
+
+    Returns: [batch, max_output] int32 indices of the kept boxes of each item,
+        highest score first, padded with -1.
+    """
+    result = np.full([boxes.shape[0], max_output], -1, dtype=np.int32)
+    for b in range(boxes.shape[0]):
+        valid = np.where(scores[b] > -np.inf)[0]
+        if not valid.shape[0]:
+            continue
+        if class_ids is None:
+            keep = non_max_suppression(boxes[b, valid], scores[b, valid],
+                                       threshold, max_output=max_output)
+        else:
+            keep = non_max_suppression_class_aware(
+                boxes[b, valid], scores[b, valid], class_ids[b, valid],
+                threshold, max_output=max_output)
+        result[b, :keep.shape[0]] = valid[keep]
+    return result
+
+
+def soft_non_max_suppression(boxes, scores, sigma=0.5, threshold=0.3,
+                             method="gaussian", score_threshold=0.001,
+                             max_output=None):
+    """Soft-NMS (Bodla et al., 2017). Instead of removing the boxes that
+    overlap a kept box, decays their scores by their IoU with it.
+    boxes: [N, (y1, x1, y2, x2)]
+    scores: [N] box scores.
+    sigma: Width of the gaussian decay, score * exp(-iou^2 / sigma).
+    threshold: IoU above which the linear decay, score * (1 - iou), applies.
+    method: "gaussian" or "linear".
+    score_threshold: Boxes whose decayed score drops below this are removed.
+    max_output: Optional. Stop after keeping this many boxes.
+
+    Returns:
+    keep: [K] indices of the kept boxes, in the order they were picked.
+    scores: [K] their decayed scores.
+    """
+    assert method in ["gaussian", "linear"]
+    boxes = boxes.astype(np.float32)
+    scores = scores.astype(np.float32).copy()
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    remaining = np.where(scores >= score_threshold)[0]
+    keep = []
+    keep_scores = []
+    while remaining.shape[0] and not (max_output and len(keep) >= max_output):
+        # Pick the highest (decayed) score
+        k = np.argmax(scores[remaining])
+        i = remaining[k]
+        keep.append(i)
+        keep_scores.append(scores[i])
+        remaining = np.delete(remaining, k)
+        # Decay the scores of the rest
+        iou = compute_iou(boxes[i], boxes[remaining], area[i], area[remaining])
+        if method == "gaussian":
+            scores[remaining] *= np.exp(-(iou ** 2) / sigma)
+        else:
+            scores[remaining] *= np.where(iou > threshold, 1 - iou, 1)
+        remaining = remaining[scores[remaining] >= score_threshold]
+    return np.array(keep, dtype=np.int32), np.array(keep_scores, dtype=np.float32)
+
+
+class BoxIndex(object):
+    """Spatial index to find the boxes of a large set (e.g. anchors) that can
+    overlap query boxes above an IoU threshold, without testing all of them.
+
+    The boxes are grouped by shape, and each group is laid out on the grid
+    of its box centers, as anchors are. For a box of the group to reach an
+    IoU t with a query box, their intersection must be at least
+    t / (1 + t) * (sum of areas). The overlap along y can't exceed the
+    smaller height, nor along x the smaller width, which bounds the center
+    distance on each axis. A query is then a rectangle of grid cells per
+    group, found by binary search for all the query boxes at once.
+
+    Build it once and reuse it. For anchors, it's the same for every image.
+    """
+
+    def __init__(self, boxes, precision=2):
+        """
+        boxes: [N, (y1, x1, y2, x2)]
+        precision: Decimals to which heights and widths are rounded to
+            group the boxes. Float32 anchors of the same shape differ in
+            the last bits, the group bounds cover that.
+        """
+        self.count = boxes.shape[0]
+        boxes = boxes.astype(np.float64)
+        heights = boxes[:, 2] - boxes[:, 0]
+        widths = boxes[:, 3] - boxes[:, 1]
+        centers_y = (boxes[:, 0] + boxes[:, 2]) / 2
+        centers_x = (boxes[:, 1] + boxes[:, 3]) / 2
+        shapes = np.stack([np.round(heights, precision),
+                           np.round(widths, precision)], axis=1)
+        _, group_ids = np.unique(shapes, axis=0, return_inverse=True)
+        group_ids = group_ids.reshape([-1])
+
+        # Each group: (min height, max height, min width, max width,
+        #              center ys, center xs, grid [layers, ys, xs] of box ids)
+        self.groups = []
+        for g in range(group_ids.max() + 1 if self.count else 0):
+            ix = np.where(group_ids == g)[0]
+            ys, iy = np.unique(centers_y[ix], return_inverse=True)
+            xs, ixx = np.unique(centers_x[ix], return_inverse=True)
+            cells = iy.reshape([-1]) * xs.shape[0] + ixx.reshape([-1])
+            # Identical boxes share a cell, so they go in separate layers
+            order = np.argsort(cells, kind="stable")
+            sorted_cells = cells[order]
+            first = np.searchsorted(sorted_cells, sorted_cells, side="left")
+            layers = np.empty_like(cells)
+            layers[order] = np.arange(cells.shape[0]) - first
+            grid = np.full([layers.max() + 1, ys.shape[0] * xs.shape[0]], -1,
+                           dtype=np.int64)
+            grid[layers, cells] = ix
+            self.groups.append((heights[ix].min(), heights[ix].max(),
+                                widths[ix].min(), widths[ix].max(), ys, xs,
+                                grid.reshape([-1, ys.shape[0], xs.shape[0]])))
+
+    def query(self, boxes, threshold=0.0):
+        """Returns the sorted indices of the indexed boxes that can have an
+        IoU >= threshold with at least one of the given boxes. It's a
+        superset: compute the IoU of the returned boxes to get the exact
+        matches. With threshold 0, it's the boxes that intersect them.
+
+        boxes: [M, (y1, x1, y2, x2)]
+        threshold: Scalar, or [M] with a threshold per box.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape([-1, 4])
+        threshold = np.broadcast_to(np.asarray(threshold, dtype=np.float64),
+                                    boxes.shape[:1])
+        heights = boxes[:, 2] - boxes[:, 0]
+        widths = boxes[:, 3] - boxes[:, 1]
+        centers_y = (boxes[:, 0] + boxes[:, 2]) / 2
+        centers_x = (boxes[:, 1] + boxes[:, 3]) / 2
+        # Minimum intersection over the sum of the areas
+        ratio = threshold / (1 + threshold)
+
+        found = np.zeros([self.count], dtype=bool)
+        for h_min, h_max, w_min, w_max, ys, xs, grid in self.groups:
+            # Smallest intersection any box of the group needs, and the
+            # largest overlap it can have along each axis
+            min_intersection = ratio * (h_min * w_min + heights * widths)
+            max_overlap_y = np.minimum(h_max, heights)
+            max_overlap_x = np.minimum(w_max, widths)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                need_y = np.where(min_intersection > 0,
+                                  min_intersection / max_overlap_x, 0)
+                need_x = np.where(min_intersection > 0,
+                                  min_intersection / max_overlap_y, 0)
+            # Largest center distances. Slightly loosened for rounding.
+            reach_y = (h_max + heights) / 2 - need_y + 1e-3
+            reach_x = (w_max + widths) / 2 - need_x + 1e-3
+            possible = (need_y <= max_overlap_y + 1e-3) & \
+                       (need_x <= max_overlap_x + 1e-3)
+            row_start = np.searchsorted(ys, centers_y - reach_y, side="left")
+            row_end = np.searchsorted(ys, centers_y + reach_y, side="right")
+            col_start = np.searchsorted(xs, centers_x - reach_x, side="left")
+            col_end = np.searchsorted(xs, centers_x + reach_x, side="right")
+            rows = np.where(possible, np.maximum(row_end - row_start, 0), 0)
+            cols = np.where(possible, np.maximum(col_end - col_start, 0), 0)
+            counts = rows * cols
+            total = counts.sum()
+            if not total:
+                continue
+            # Enumerate the cells of all the rectangles at once
+            owner = np.repeat(np.arange(boxes.shape[0]), counts)
+            offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            cell_y = row_start[owner] + offset // cols[owner]
+            cell_x = col_start[owner] + offset % cols[owner]
+            ids = grid[:, cell_y, cell_x].reshape([-1])
+            found[ids[ids >= 0]] = True
+        return np.flatnonzero(found)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -384,8 +688,23 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_compact_mask(self, image_id):
+        """Load instance masks for the given image as a CompactMasks object.
+
+        The default implementation converts the output of load_mask().
+        Override it if your dataset can build the box-local bitmaps directly
+        (e.g. from polygons) to avoid allocating full size masks.
+
+        Returns:
+            masks: CompactMasks with one bitmap per instance.
+            class_ids: a 1D array of class IDs of the instance masks.
+        """
+        mask, class_ids = self.load_mask(image_id)
+        return CompactMasks.from_dense(mask), class_ids
+
 
-def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square",
+                 shape=None):
     """Resizes an image keeping the aspect ratio unchanged.
 
     min_dim: if provided, resizes the image such that it's smaller
@@ -403,10 +722,18 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
                before padding. max_dim is ignored in this mode.
                The multiple of 64 is needed to ensure smooth scaling of feature
                maps up and down the 6 levels of the FPN pyramid (2**6=64).
+        aspect: Scales like square mode (min_dim, min_scale and max_dim all
+                apply), but keeps the aspect ratio of the image and pads
+                width and height only to multiples of 64, as in pad64.
+                Images of the same shape produce the same molded shape.
         crop: Picks random crops from the image. First, scales the image based
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
               max_dim is not used in this mode.
+        fit: Scales the image to the largest size that fits in shape,
+             keeping the aspect ratio, and pads it with zeros to shape.
+             min_dim, min_scale and max_dim are not used in this mode.
+    shape: (height, width) of the result in "fit" mode.
 
     Returns:
     image: the resized image
@@ -430,14 +757,16 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
         return image, window, scale, padding, crop
 
     # Scale?
-    if min_dim:
+    if mode == "fit":
+        scale = min(shape[0] / h, shape[1] / w)
+    if min_dim and mode != "fit":
         # Scale up but not down
         scale = max(1, min_dim / min(h, w))
-    if min_scale and scale < min_scale:
+    if min_scale and scale < min_scale and mode != "fit":
         scale = min_scale
 
     # Does it exceed max dim?
-    if max_dim and mode == "square":
+    if max_dim and mode in ["square", "aspect"]:
         image_max = max(h, w)
         if round(image_max * scale) > max_dim:
             scale = max_dim / image_max
@@ -448,20 +777,22 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
                        preserve_range=True)
 
     # Need padding or cropping?
-    if mode == "square":
+    if mode in ["square", "fit"]:
         # Get new height and width
         h, w = image.shape[:2]
-        top_pad = (max_dim - h) // 2
-        bottom_pad = max_dim - h - top_pad
-        left_pad = (max_dim - w) // 2
-        right_pad = max_dim - w - left_pad
+        out_h, out_w = (max_dim, max_dim) if mode == "square" else shape[:2]
+        top_pad = (out_h - h) // 2
+        bottom_pad = out_h - h - top_pad
+        left_pad = (out_w - w) // 2
+        right_pad = out_w - w - left_pad
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
         image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
-    elif mode == "pad64":
+    elif mode in ["pad64", "aspect"]:
         h, w = image.shape[:2]
         # Both sides must be divisible by 64
-        assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
+        if mode == "pad64":
+            assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
         # Height
         if h % 64 > 0:
             max_h = h - (h % 64) + 64
@@ -492,6 +823,46 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     return image.astype(image_dtype), window, scale, padding, crop
 
 
+def select_bucket(image_shape, buckets):
+    """Returns the bucket (height, width) with the aspect ratio closest to
+    that of an image. Ties go to the first one.
+
+    image_shape: [height, width, ...] of the original image.
+    buckets: List of (height, width) molded shapes.
+    """
+    ratio = np.log(image_shape[0] / image_shape[1])
+    distances = [abs(np.log(h / w) - ratio) for h, w in buckets]
+    return tuple(buckets[int(np.argmin(distances))])
+
+
+def resize_training_image(image, config):
+    """Resizes an image for training as the config says. With TRAIN_BUCKETS,
+    the image is fitted to its bucket (see select_bucket()). Otherwise it's
+    resized with IMAGE_RESIZE_MODE. Returns the same as resize_image().
+    """
+    if config.TRAIN_BUCKETS:
+        return resize_image(image, mode="fit",
+                            shape=select_bucket(image.shape, config.TRAIN_BUCKETS))
+    return resize_image(image,
+                        min_dim=config.IMAGE_MIN_DIM,
+                        min_scale=config.IMAGE_MIN_SCALE,
+                        max_dim=config.IMAGE_MAX_DIM,
+                        mode=config.IMAGE_RESIZE_MODE)
+
+
+def zoom_index(size, scale):
+    """Returns the source position of each output position of a nearest
+    neighbour zoom by scale of a line of size pixels, as [round(size * scale)]
+    int64. Same mapping as scipy.ndimage.zoom(order=0), which aligns the
+    first and last pixels, except that the last output position always maps
+    to the last pixel. zoom() can sample just past it and return zeros there.
+    """
+    out_size = int(round(size * scale))
+    step = (size - 1) / (out_size - 1) if out_size > 1 else 0.
+    src = np.floor(np.arange(out_size) * step + 0.5).astype(np.int64)
+    return np.minimum(src, size - 1)
+
+
 def resize_mask(mask, scale, padding, crop=None):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
@@ -501,11 +872,9 @@ def resize_mask(mask, scale, padding, crop=None):
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
-    # Suppress warning from scipy 0.13.0, the output shape of zoom() is
-    # calculated with round() instead of int()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    # Nearest neighbour zoom. Same mapping as scipy.ndimage.zoom(order=0),
+    # see zoom_index().
+    mask = mask[zoom_index(mask.shape[0], scale)][:, zoom_index(mask.shape[1], scale)]
     if crop is not None:
         y, x, h, w = crop
         mask = mask[y:y + h, x:x + w]
@@ -576,6 +945,202 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+class CompactMasks(object):
+    """Instance masks stored as bitmaps of their bounding boxes only, instead
+    of a [height, width, instances] array. Most instances cover a small part
+    of the image, so this saves memory and time in the data pipeline. The
+    operations give the same results as their dense equivalents
+    (resize_mask(), np.fliplr(), extract_bboxes(), minimize_mask()).
+
+    shape: (height, width) of the image.
+    boxes: [instances, (y1, x1, y2, x2)] int32. The area of each bitmap in
+        the image. Not necessarily tight, use extract_bboxes() for that.
+    bitmaps: List of bool arrays [y2 - y1, x2 - x1], one per instance.
+    """
+
+    def __init__(self, shape, boxes, bitmaps):
+        self.shape = tuple(shape[:2])
+        self.boxes = np.array(boxes, dtype=np.int32).reshape([-1, 4])
+        self.bitmaps = list(bitmaps)
+        assert len(self.bitmaps) == self.boxes.shape[0]
+
+    @classmethod
+    def from_dense(cls, mask):
+        """Converts a [height, width, instances] mask array."""
+        boxes = extract_bboxes(mask)
+        bitmaps = [mask[y1:y2, x1:x2, i].astype(bool)
+                   for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(mask.shape[:2], boxes, bitmaps)
+
+    def __len__(self):
+        return len(self.bitmaps)
+
+    def to_dense(self, out=None):
+        """Returns the masks as a [height, width, instances] bool array.
+        out: Optional array [height, width, >= instances] to write into.
+            It must be zeros in the area of the masks.
+        """
+        if out is None:
+            out = np.zeros(self.shape + (len(self),), dtype=bool)
+        for i, ((y1, x1, y2, x2), m) in enumerate(zip(self.boxes, self.bitmaps)):
+            out[y1:y2, x1:x2, i] = m
+        return out
+
+    def select(self, ids):
+        """Returns the masks of the given instances. ids can be indices or
+        a boolean array.
+        """
+        ids = np.arange(len(self))[ids]
+        return CompactMasks(self.shape, self.boxes[ids],
+                            [self.bitmaps[i] for i in ids])
+
+    def areas(self):
+        """Returns the number of pixels of each mask."""
+        return np.array([np.sum(m) for m in self.bitmaps], dtype=np.int64)
+
+    def extract_bboxes(self):
+        """Same as extract_bboxes() on the dense masks."""
+        boxes = np.zeros([len(self), 4], dtype=np.int32)
+        for i, ((y1, x1, _, _), m) in enumerate(zip(self.boxes, self.bitmaps)):
+            rows = np.where(np.any(m, axis=1))[0]
+            cols = np.where(np.any(m, axis=0))[0]
+            if rows.shape[0]:
+                boxes[i] = [y1 + rows[0], x1 + cols[0],
+                            y1 + rows[-1] + 1, x1 + cols[-1] + 1]
+        return boxes
+
+    def crop(self, i, box):
+        """Returns the mask of instance i in the given box [y1, x1, y2, x2]
+        of the image, as a bool array. Same as mask[y1:y2, x1:x2, i].
+        """
+        y1, x1, y2, x2 = box
+        by1, bx1, by2, bx2 = self.boxes[i]
+        out = np.zeros([y2 - y1, x2 - x1], dtype=bool)
+        # Intersection of the box with the bitmap
+        iy1, ix1 = max(y1, by1), max(x1, bx1)
+        iy2, ix2 = min(y2, by2), min(x2, bx2)
+        if iy2 > iy1 and ix2 > ix1:
+            out[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = \
+                self.bitmaps[i][iy1 - by1:iy2 - by1, ix1 - bx1:ix2 - bx1]
+        return out
+
+    def fliplr(self):
+        """Same as np.fliplr() on the dense masks."""
+        w = self.shape[1]
+        boxes = self.boxes.copy()
+        boxes[:, 1] = w - self.boxes[:, 3]
+        boxes[:, 3] = w - self.boxes[:, 1]
+        return CompactMasks(self.shape, boxes, [m[:, ::-1] for m in self.bitmaps])
+
+    def resize(self, scale, padding, crop=None):
+        """Same as resize_mask() on the dense masks."""
+        h, w = self.shape
+        boxes = self.boxes.copy()
+        bitmaps = self.bitmaps
+        if scale != 1:
+            # Nearest neighbour zoom is separable, and the source index is
+            # increasing, so each box maps to a range of rows and columns.
+            rows = zoom_index(h, scale)
+            cols = zoom_index(w, scale)
+            h, w = rows.shape[0], cols.shape[0]
+            y1, y2 = map_ranges(boxes[:, 0], boxes[:, 2], rows)
+            x1, x2 = map_ranges(boxes[:, 1], boxes[:, 3], cols)
+            bitmaps = [m[rows[y1[i]:y2[i], None] - by1, cols[None, x1[i]:x2[i]] - bx1]
+                       for i, (m, (by1, bx1, _, _)) in enumerate(zip(self.bitmaps, self.boxes))]
+            boxes = np.stack([y1, x1, y2, x2], axis=1)
+        masks = CompactMasks((h, w), boxes, bitmaps)
+        if crop is not None:
+            y, x, ch, cw = crop
+            window = [y, x, y + ch, x + cw]
+            boxes = np.concatenate([np.maximum(masks.boxes[:, :2], window[:2]),
+                                    np.minimum(masks.boxes[:, 2:], window[2:])], axis=1)
+            boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2])
+            bitmaps = [masks.crop(i, b) for i, b in enumerate(boxes)]
+            return CompactMasks((ch, cw), boxes - [y, x, y, x], bitmaps)
+        (top, bottom), (left, right) = padding[:2]
+        return CompactMasks((h + top + bottom, w + left + right),
+                            masks.boxes + [top, left, top, left], masks.bitmaps)
+
+    def remap(self, rows, cols):
+        """Moves the masks with a separable nearest neighbour mapping, such
+        as the flips, scaling and shifts of augmentation.BatchAugmenter.
+        Same as mask[rows][:, cols] on the dense masks, with the rows and
+        columns that are -1 set to zero.
+
+        rows: [new height] Source row of each row of the result, or -1 if
+            it's outside the source. The valid entries must be monotonic.
+        cols: [new width] Same for the columns.
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        y1, y2 = map_ranges(self.boxes[:, 0], self.boxes[:, 2], rows)
+        x1, x2 = map_ranges(self.boxes[:, 1], self.boxes[:, 3], cols)
+        bitmaps = [m[rows[y1[i]:y2[i], None] - by1, cols[None, x1[i]:x2[i]] - bx1]
+                   for i, (m, (by1, bx1, _, _)) in enumerate(zip(self.bitmaps, self.boxes))]
+        return CompactMasks((rows.shape[0], cols.shape[0]),
+                            np.stack([y1, x1, y2, x2], axis=1), bitmaps)
+
+    def minimize(self, bbox, mini_shape):
+        """Same as minimize_mask() on the dense masks."""
+        mini_mask = np.zeros(mini_shape + (len(self),), dtype=bool)
+        for i in range(len(self)):
+            m = self.crop(i, bbox[i][:4])
+            if m.size == 0:
+                raise Exception("Invalid bounding box with area of zero")
+            # Resize with bilinear interpolation
+            m = resize(m, mini_shape)
+            mini_mask[:, :, i] = np.around(m).astype(np.bool)
+        return mini_mask
+
+
+def map_ranges(starts, ends, index):
+    """Maps ranges of source positions through a monotonic index.
+
+    starts, ends: [N] Ranges [start, end) of source rows or columns.
+    index: [M] Source position of each destination position, or -1 if
+        none. The valid entries must be increasing or decreasing.
+
+    Returns: (starts, ends) [N] The range of destination positions whose
+        source is in each range. Both are 0 if there are none.
+    """
+    if not index.shape[0]:
+        zeros = np.zeros([np.asarray(starts).shape[0]], dtype=np.int32)
+        return zeros, zeros.copy()
+    inside = (index[np.newaxis] >= np.asarray(starts)[:, np.newaxis]) & \
+             (index[np.newaxis] < np.asarray(ends)[:, np.newaxis])
+    found = np.any(inside, axis=1)
+    new_starts = np.where(found, np.argmax(inside, axis=1), 0)
+    new_ends = np.where(found, index.shape[0] - np.argmax(inside[:, ::-1], axis=1), 0)
+    return new_starts.astype(np.int32), new_ends.astype(np.int32)
+
+
+def compute_tiles(height, width, tile_size, overlap):
+    """Splits an image into overlapping tiles that cover all of it.
+
+    height, width: Size of the image in pixels.
+    tile_size: Side of the square tiles. Tiles are clipped to the image if
+        it's smaller than a tile.
+    overlap: Minimum overlap between neighbouring tiles in pixels. The tiles
+        are spread evenly, so the actual overlap can be larger.
+
+    Returns: [N, (y1, x1, y2, x2)] tile windows. (y2, x2) is outside the tile.
+    """
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile_size"
+
+    def starts(length):
+        size = min(tile_size, length)
+        if length <= size:
+            return [0]
+        count = int(np.ceil((length - overlap) / (size - overlap)))
+        return np.round(np.linspace(0, length - size, count)).astype(np.int32)
+
+    tile_h = min(tile_size, height)
+    tile_w = min(tile_size, width)
+    return np.array([[y, x, y + tile_h, x + tile_w]
+                     for y in starts(height) for x in starts(width)],
+                    dtype=np.int32)
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -639,6 +1204,59 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+# In-process index of the anchor arrays loaded by load_pyramid_anchors()
+_pyramid_anchors = {}
+
+
+def load_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
+                         anchor_stride, cache_dir=None):
+    """Same as generate_pyramid_anchors(), but the anchors are generated
+    once and shared.
+
+    The anchors are stored as float32 and keyed by all the values that
+    define them (scales, ratios, feature shapes, strides, anchor stride).
+    If cache_dir is given, they're saved there as a .npy file and
+    memory-mapped, so the data generator workers and inference processes
+    read the same pages rather than each generating its own copy.
+    The file is written atomically, so concurrent processes can safely
+    race to create it.
+
+    cache_dir: Optional. Directory of the persistent anchor store.
+
+    Returns:
+    anchors: [N, (y1, x1, y2, x2)] float32 array in pixel coordinates.
+        Read-only. Don't modify it in place.
+    """
+    key = repr((tuple(scales), tuple(ratios),
+                tuple(tuple(int(d) for d in s) for s in feature_shapes),
+                tuple(feature_strides), anchor_stride))
+    if (key, cache_dir) in _pyramid_anchors:
+        return _pyramid_anchors[(key, cache_dir)]
+
+    if cache_dir:
+        name = "anchors_{}.npy".format(
+            hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+        path = os.path.join(cache_dir, name)
+        if not os.path.exists(path):
+            anchors = generate_pyramid_anchors(
+                scales, ratios, feature_shapes, feature_strides,
+                anchor_stride).astype(np.float32)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file and rename to make it atomic
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp_path, "wb") as f:
+                np.save(f, anchors)
+            os.replace(temp_path, path)
+        anchors = np.load(path, mmap_mode="r")
+    else:
+        anchors = generate_pyramid_anchors(
+            scales, ratios, feature_shapes, feature_strides,
+            anchor_stride).astype(np.float32)
+        anchors.setflags(write=False)
+    _pyramid_anchors[(key, cache_dir)] = anchors
+    return anchors
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -893,6 +1511,10 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
     of skimage. This solves the problem by using different parameters per
     version. And it provides a central place to control resizing defaults.
     """
+    if image.dtype == bool and order > 0:
+        # Older versions convert bool images to float, newer ones refuse
+        # to interpolate them
+        image = image.astype(np.float64)
     if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
         # New in 0.14: anti_aliasing. Default it to False for backward
         # compatibility with skimage 0.13.
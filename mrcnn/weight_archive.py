@@ -0,0 +1,215 @@
+"""
+Mask R-CNN
+Flat, memory-mapped weight archives for fast weight loading.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Loading a Keras .h5 weights file goes through h5py, one dataset read per
+weight, and Keras' per-layer loading code. A weight archive stores the same
+weights as one flat file:
+
+    magic (8 bytes) | header size (uint64) | JSON header | weights
+
+The header lists the layers in the order of the .h5 file, with the dtype,
+shape and offset of each weight. Every weight starts on a 64 byte
+boundary, so the file is memory-mapped and each weight is a NumPy view of
+it, without parsing or copying. load() then assigns all the weights of
+the model in a single session run. It can also read the pages in parallel
+threads first, which helps on network file systems.
+
+Convert the COCO weights once:
+
+    python3 -m mrcnn.weight_archive mask_rcnn_coco.h5 mask_rcnn_coco.mrw
+
+MaskRCNN.load_weights() recognizes archives by their magic bytes, and
+supports by_name and exclude as with .h5 files.
+"""
+
+import os
+import json
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+MAGIC = b"MRCNNWA1"
+
+# Alignment of the weights in the file, in bytes
+ALIGNMENT = 64
+
+
+def is_archive(path):
+    """Returns True if the file at path is a weight archive."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write(path, layers):
+    """Writes a weight archive.
+
+    layers: List of (layer name, [(weight name, array)]), in the order
+        that loading without by_name should follow.
+    """
+    entries = []
+    arrays = []
+    offset = 0
+    for layer_name, weights in layers:
+        layer = {"name": layer_name, "weights": []}
+        for weight_name, array in weights:
+            array = np.ascontiguousarray(array)
+            layer["weights"].append({"name": weight_name, "dtype": array.dtype.str,
+                                     "shape": list(array.shape), "offset": offset})
+            arrays.append((offset, array))
+            offset = _align(offset + array.nbytes)
+        entries.append(layer)
+    header = json.dumps({"layers": entries}).encode("utf8")
+    # Offsets in the header are relative to the aligned start of the data
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for start, array in arrays:
+            f.seek(data_start + start)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def convert_h5(h5_path, path):
+    """Converts a Keras .h5 weights file, as saved by save_weights() or
+    ModelCheckpoint, to a weight archive.
+    """
+    import h5py
+    with h5py.File(h5_path, mode="r") as f:
+        if "layer_names" not in f.attrs and "model_weights" in f:
+            f = f["model_weights"]
+        layers = []
+        for name in f.attrs["layer_names"]:
+            name = name.decode("utf8") if isinstance(name, bytes) else name
+            group = f[name]
+            weights = []
+            for weight_name in group.attrs["weight_names"]:
+                weight_name = weight_name.decode("utf8") \
+                    if isinstance(weight_name, bytes) else weight_name
+                weights.append((weight_name, group[weight_name][()]))
+            layers.append((name, weights))
+    write(path, layers)
+
+
+def save(path, keras_model):
+    """Writes the weights of a Keras model to a weight archive."""
+    layers = []
+    for layer in keras_model.layers:
+        values = layer.get_weights()
+        layers.append((layer.name, [(w.name, v) for w, v in zip(layer.weights, values)]))
+    write(path, layers)
+
+
+class WeightArchive(object):
+    """A memory-mapped weight archive."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            assert f.read(len(MAGIC)) == MAGIC, "Not a weight archive: " + path
+            header_size, = struct.unpack("<Q", f.read(8))
+            self.layers = json.loads(f.read(header_size).decode("utf8"))["layers"]
+        self.data_start = _align(len(MAGIC) + 8 + header_size)
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+
+    @property
+    def layer_names(self):
+        return [l["name"] for l in self.layers]
+
+    def weights(self, layer):
+        """Returns the weights of a layer entry of the header as read-only
+        arrays that are views of the file.
+        """
+        arrays = []
+        for w in layer["weights"]:
+            dtype = np.dtype(w["dtype"])
+            count = int(np.prod(w["shape"]))
+            start = self.data_start + w["offset"]
+            arrays.append(self.buffer[start:start + count * dtype.itemsize]
+                          .view(dtype).reshape(w["shape"]))
+        return arrays
+
+    def load(self, layers, by_name=False, workers=0):
+        """Sets the weights of Keras layers from the archive, with the
+        semantics of Keras' load_weights():
+
+        by_name=False: The layers of the archive that have weights are
+            matched, in order, with the given layers that have weights.
+            Their counts must be equal.
+        by_name=True: Each layer of the archive is matched with the given
+            layers of the same name. Layers without a match are skipped.
+        workers: Number of threads that read the weights from the file
+            before they're assigned. 0 passes the memory-mapped views
+            directly, so the pages are read as TF copies them.
+
+        Raises ValueError on a mismatch in the number of layers or weights.
+        Weights are assigned as stored. The conversions Keras applies to
+        files saved by old Keras versions are not, so convert files of the
+        Keras version in use.
+        """
+        import keras.backend as K
+
+        layers = list(layers)
+        pairs = []
+        if by_name:
+            index = {}
+            for layer in layers:
+                index.setdefault(layer.name, []).append(layer)
+            for entry in self.layers:
+                for layer in index.get(entry["name"], []):
+                    pairs.append((layer, entry))
+        else:
+            layers = [l for l in layers if l.weights]
+            entries = [e for e in self.layers if e["weights"]]
+            if len(entries) != len(layers):
+                raise ValueError("You are trying to load a weight file containing {} "
+                                 "layers into a model with {} layers.".format(
+                                     len(entries), len(layers)))
+            pairs = list(zip(layers, entries))
+
+        assignments = []
+        for layer, entry in pairs:
+            symbolic = layer.weights
+            if len(symbolic) != len(entry["weights"]):
+                raise ValueError("Layer {} expects {} weight(s), but the saved "
+                                 "weights have {} element(s).".format(
+                                     layer.name, len(symbolic), len(entry["weights"])))
+            assignments.extend(zip(symbolic, self.weights(entry)))
+
+        if workers:
+            # Copying releases the GIL, so the threads read the file in parallel
+            with ThreadPoolExecutor(workers) as executor:
+                values = list(executor.map(np.array, [v for _, v in assignments]))
+            assignments = [(w, v) for (w, _), v in zip(assignments, values)]
+        K.batch_set_value(assignments)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a Keras .h5 weights file to a weight archive.')
+    parser.add_argument('h5_path', help='Keras .h5 weights file')
+    parser.add_argument('archive_path', help='Weight archive to write')
+    args = parser.parse_args()
+    convert_h5(args.h5_path, args.archive_path)
+    print("Wrote {} ({:.1f} MB)".format(
+        args.archive_path, os.path.getsize(args.archive_path) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,17 @@ MASK_PATH = '../dataset/masks/'
 TRAIN_CSV = 'train_new.csv'
 TEST_CSV = 'test_new.csv'
 
+# Run Mask R-CNN on overlapping full-resolution tiles instead of the whole
+# downscaled frame. Finds more of the distant (small) cars.
+TILED_INFERENCE = False
+TILE_SIZE = 1024
+TILE_OVERLAP = 128
+
+# Frozen inference graph saved by MaskRCNN.export_frozen_graph(). If the file
+# exists, it's loaded instead of building the model and loading the COCO
+# weights, which starts much faster.
+FROZEN_GRAPH_PATH = None
+
 # --------------------------------------- MASK R CNN SETUP --------------------------------------- #
 def init_maskrcnn():
   global class_names, rcnn_model
@@ -63,7 +74,15 @@ def init_maskrcnn():
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
 
-  config = InferenceConfig()
+  class TiledInferenceConfig(InferenceConfig):
+    # Tiles of a frame are run in batches
+    IMAGES_PER_GPU = 4
+
+  config = TiledInferenceConfig() if TILED_INFERENCE else InferenceConfig()
+
+  if FROZEN_GRAPH_PATH and os.path.exists(FROZEN_GRAPH_PATH):
+    rcnn_model = modellib.FrozenMaskRCNN(FROZEN_GRAPH_PATH, config=config)
+    return
 
   # Create model object in inference mode.
   rcnn_model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR, config=config)
@@ -71,6 +90,17 @@ def init_maskrcnn():
   # Load weights trained on MS-COCO
   rcnn_model.load_weights(COCO_MODEL_PATH, by_name=True)
 
+def run_maskrcnn(model, image, mask=None):
+  '''
+  Runs the Mask R-CNN model on one image and returns its results dict. Uses tiled
+  inference if TILED_INFERENCE is set, skipping the tiles that are fully
+  covered by the mask.
+  '''
+  if TILED_INFERENCE:
+    return model.detect_tiled(image, tile_size=TILE_SIZE,
+                              overlap=TILE_OVERLAP, mask=mask)
+  return model.detect([image])[0]
+
 # ---------------------------------------- Helper functions for training ---------------------------------------- #
 # Camera intrinsic parameters and transformation matrix
 fx = 2304.5479
@@ -147,6 +177,7 @@ def extract_bounding_box_info(rcnn_model, filenames, file_examples, show_images
     filename = filenames[k]
     # Load image
     image = skimage.io.imread(IMAGE_PATH + filename)
+    mask = None
     if (os.path.exists(MASK_PATH + filename)):
       mask_image = skimage.io.imread(MASK_PATH + filename)
       mask = mask_image > 128
@@ -156,8 +187,7 @@ def extract_bounding_box_info(rcnn_model, filenames, file_examples, show_images
     width = image.shape[1]
   
     # Run detection
-    results = rcnn_model.detect([image])
-    r = results[0]
+    r = run_maskrcnn(rcnn_model, image, mask)
 
     rois = r['rois']
     rois_with_index = []
@@ -560,8 +590,7 @@ def detect(image_path, model_path):
   width = image.shape[1]
 
   # Run detection through Mask-RCNN
-  results = rcnn_model.detect([image])
-  r = results[0]
+  r = run_maskrcnn(rcnn_model, image)
   rois = r['rois']
   car_inputs = []
 
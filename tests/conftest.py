@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# To find the local version of the library and the reference copies of the
+# original functions in benchmarks/
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "benchmarks"))
@@ -0,0 +1,49 @@
+"""
+Tests of the batched augmentation against the dense masks.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import utils
+from mrcnn.augmentation import BatchAugmenter
+
+
+def random_masks(rng, height, width, count):
+    """Random sparse blobs [height, width, count], so that thin rows and
+    columns at the edges of the boxes are common.
+    """
+    masks = np.zeros([height, width, count], dtype=bool)
+    for i in range(count):
+        h, w = rng.randint(1, height // 2), rng.randint(1, width // 2)
+        y, x = rng.randint(0, height - h), rng.randint(0, width - w)
+        masks[y:y + h, x:x + w, i] = rng.rand(h, w) > 0.7
+        # Single pixels on the edges of the box
+        masks[y, x + rng.randint(w), i] = True
+        masks[y + h - 1, x + rng.randint(w), i] = True
+        masks[y + rng.randint(h), x, i] = True
+    return masks
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_boxes_match_augmented_masks(seed):
+    rng = np.random.RandomState(seed)
+    augmenter = BatchAugmenter(fliplr=0.5, flipud=0.5, scale=(0.5, 1.5),
+                               translate=0.3, brightness=10)
+    shapes = [(64, 80), (64, 80), (33, 47)]
+    images = [rng.randint(0, 256, s + (3,)).astype(np.uint8) for s in shapes]
+    dense = [random_masks(rng, s[0], s[1], 8) for s in shapes]
+    masks = [utils.CompactMasks.from_dense(m) for m in dense]
+    seeds = rng.randint(0, 2 ** 31 - 1, len(images))
+
+    out_images, out_masks, out_boxes = augmenter.augment(images, masks, seeds)
+    for i, (image, mask, bbox) in enumerate(zip(out_images, out_masks, out_boxes)):
+        # The dense masks through the same transform
+        params = augmenter.sample_params(np.random.RandomState(seeds[i]), images[i].shape)
+        rows, cols = params["rows"], params["cols"]
+        expected = dense[i][np.maximum(rows, 0)][:, np.maximum(cols, 0)]
+        expected[rows < 0] = False
+        expected[:, cols < 0] = False
+        assert image.shape == images[i].shape
+        np.testing.assert_array_equal(mask.to_dense(), expected)
+        np.testing.assert_array_equal(bbox, utils.extract_bboxes(expected))
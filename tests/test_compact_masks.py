@@ -0,0 +1,117 @@
+"""
+Tests of utils.CompactMasks against the dense mask functions.
+"""
+
+import warnings
+import numpy as np
+import pytest
+import scipy.ndimage
+
+from mrcnn import utils
+
+
+def random_masks(rng, height, width, count=6):
+    """Random blobs [height, width, count], some of them on the edges of
+    the image, plus an empty mask.
+    """
+    masks = np.zeros([height, width, count + 1], dtype=bool)
+    for i in range(count):
+        h = rng.randint(1, height + 1)
+        w = rng.randint(1, width + 1)
+        # Every other mask touches the bottom or right edge
+        y = height - h if i % 2 else rng.randint(0, height - h + 1)
+        x = width - w if i % 4 == 1 else rng.randint(0, width - w + 1)
+        masks[y:y + h, x:x + w, i] = rng.rand(h, w) > 0.3
+        masks[y + h - 1, x:x + w, i] = True
+        masks[y:y + h, x + w - 1, i] = True
+    return masks
+
+
+SIZES = [(1, 1), (2, 3), (15, 17), (28, 28), (64, 31), (480, 640), (427, 640)]
+SCALES = [0.25, 0.5, 0.7, 1, 1.1, 1.6, 1.7, 2, 1024 / 640, 800 / 427]
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("scale", SCALES)
+def test_resize_matches_resize_mask(size, scale):
+    rng = np.random.RandomState(size[0] * 1000 + size[1])
+    masks = random_masks(rng, *size)
+    padding = [(1, 2), (3, 0), (0, 0)]
+    compact = utils.CompactMasks.from_dense(masks).resize(scale, padding)
+    dense = utils.resize_mask(masks, scale, padding)
+    assert compact.shape == dense.shape[:2]
+    np.testing.assert_array_equal(compact.to_dense(), dense)
+    np.testing.assert_array_equal(compact.extract_bboxes(), utils.extract_bboxes(dense))
+
+
+@pytest.mark.parametrize("scale", [0.5, 1.6, 2])
+def test_resize_crop_matches_resize_mask(scale):
+    rng = np.random.RandomState(0)
+    masks = random_masks(rng, 120, 90)
+    h, w = int(round(120 * scale)), int(round(90 * scale))
+    for crop in [(0, 0, h // 2, w // 2), (h // 3, w // 4, h - h // 3, w - w // 4)]:
+        compact = utils.CompactMasks.from_dense(masks).resize(scale, None, crop)
+        dense = utils.resize_mask(masks, scale, None, crop)
+        np.testing.assert_array_equal(compact.to_dense(), dense)
+
+
+def test_resize_mask_matches_zoom_inside():
+    # Away from the last row and column, which zoom() can drop, the mapping
+    # is the one of scipy.ndimage.zoom().
+    rng = np.random.RandomState(1)
+    for size in [(480, 640), (28, 28), (15, 15), (333, 500)]:
+        masks = rng.rand(size[0], size[1], 2) > 0.5
+        for scale in [0.5, 1.6, 1.7, 2.13]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                zoomed = scipy.ndimage.zoom(masks, zoom=[scale, scale, 1], order=0)
+            resized = utils.resize_mask(masks, scale, [(0, 0), (0, 0), (0, 0)])
+            assert resized.shape == zoomed.shape
+            np.testing.assert_array_equal(resized[:-1, :-1], zoomed[:-1, :-1])
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("scale", SCALES)
+def test_zoom_index(size, scale):
+    rows = utils.zoom_index(size[0], scale)
+    assert rows.shape[0] == int(round(size[0] * scale))
+    assert np.all(np.diff(rows) >= 0)
+    if rows.shape[0] > 1:
+        assert rows[0] == 0 and rows[-1] == size[0] - 1
+
+
+def test_remap_matches_dense():
+    rng = np.random.RandomState(2)
+    masks = random_masks(rng, 100, 80)
+    compact = utils.CompactMasks.from_dense(masks)
+    for scale, shift, flip in [(1.3, (5, -7), False), (0.6, (-10, 3), True),
+                               (1, (0, 0), True), (2.5, (40, 30), False)]:
+        rows = np.floor((np.arange(100) + 0.5 - 50 - shift[0]) / scale + 50).astype(np.int64)
+        cols = np.floor((np.arange(80) + 0.5 - 40 - shift[1]) / scale + 40).astype(np.int64)
+        rows[(rows < 0) | (rows >= 100)] = -1
+        cols[(cols < 0) | (cols >= 80)] = -1
+        if flip:
+            cols = np.where(cols >= 0, 79 - cols, -1)
+        dense = masks[np.maximum(rows, 0)][:, np.maximum(cols, 0)]
+        dense[rows < 0] = False
+        dense[:, cols < 0] = False
+        remapped = compact.remap(rows, cols)
+        np.testing.assert_array_equal(remapped.to_dense(), dense)
+        np.testing.assert_array_equal(remapped.extract_bboxes(), utils.extract_bboxes(dense))
+
+
+def test_fliplr_and_select_match_dense():
+    masks = random_masks(np.random.RandomState(3), 50, 70)
+    compact = utils.CompactMasks.from_dense(masks)
+    np.testing.assert_array_equal(compact.fliplr().to_dense(), np.fliplr(masks))
+    ids = np.array([True, False, True, True, False, False, True])
+    np.testing.assert_array_equal(compact.select(ids).to_dense(), masks[:, :, ids])
+    np.testing.assert_array_equal(compact.areas(), masks.sum(axis=(0, 1)))
+
+
+def test_minimize_matches_minimize_mask():
+    masks = random_masks(np.random.RandomState(4), 200, 150)[..., :-1]
+    compact = utils.CompactMasks.from_dense(masks)
+    bbox = utils.extract_bboxes(masks)
+    np.testing.assert_array_equal(compact.minimize(bbox, (56, 56)),
+                                  utils.minimize_mask(bbox, masks, (56, 56)))
@@ -0,0 +1,57 @@
+"""
+Tests of the multiprocess batch loader.
+"""
+
+import os
+import numpy as np
+import pytest
+
+from mrcnn.data_loader import ShardedLoader
+
+
+class CountingSequence(object):
+    """Batches that identify their epoch and index. The worker that loads
+    batch kill_index exits without a word, as when it's killed for lack of
+    memory.
+    """
+
+    def __init__(self, length, kill_index=None):
+        self.length = length
+        self.kill_index = kill_index
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index == self.kill_index:
+            os._exit(9)
+        return [np.array([self.epoch, index])], [np.zeros([2, 3], dtype=np.float32)]
+
+
+@pytest.mark.parametrize("workers", [0, 1, 3])
+def test_batches_in_order(workers):
+    loader = ShardedLoader(CountingSequence(7), workers=workers, prefetch=2)
+    generator = loader.generator(epoch=1, index=5)
+    try:
+        keys = [tuple(next(generator)[0][0]) for _ in range(10)]
+    finally:
+        generator.close()
+    expected = [(1, 5), (1, 6)] + [(2, i) for i in range(7)] + [(3, 0)]
+    assert keys == expected
+    assert loader.position == (3, 1)
+
+
+def test_dead_worker_raises():
+    loader = ShardedLoader(CountingSequence(9, kill_index=4), workers=3, prefetch=2)
+    generator = loader.generator()
+    try:
+        with pytest.raises(RuntimeError, match="worker 1 exited"):
+            for _ in range(9):
+                next(generator)
+    finally:
+        generator.close()
+        loader.close()
@@ -0,0 +1,85 @@
+"""
+Tests of model.AccumulatedSGD: accumulation_steps batches give the same
+weight updates as plain SGD on one batch that has all of them.
+"""
+
+import numpy as np
+import pytest
+
+
+modellib = pytest.importorskip("mrcnn.model")
+keras = modellib.keras
+K = modellib.K
+
+
+def train(optimizer, batches, initial_weights):
+    """Trains a small regression model on the batches, one batch per step.
+    Returns the weights after each step.
+    """
+    K.clear_session()
+    inputs = keras.layers.Input(shape=(4,))
+    x = keras.layers.Dense(8, activation="tanh")(inputs)
+    outputs = keras.layers.Dense(1)(x)
+    model = keras.models.Model(inputs, outputs)
+    model.set_weights(initial_weights)
+    model.compile(optimizer=optimizer, loss="mse")
+    history = []
+    for x, y in batches:
+        model.train_on_batch(x, y)
+        history.append(model.get_weights())
+    return history
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.RandomState(0)
+    x = rng.randn(6 * 8, 4).astype(np.float32)
+    y = rng.randn(6 * 8, 1).astype(np.float32)
+    K.clear_session()
+    inputs = keras.layers.Input(shape=(4,))
+    outputs = keras.layers.Dense(1)(keras.layers.Dense(8, activation="tanh")(inputs))
+    initial_weights = keras.models.Model(inputs, outputs).get_weights()
+    return x, y, initial_weights
+
+
+@pytest.mark.parametrize("steps", [2, 3])
+@pytest.mark.parametrize("nesterov", [False, True])
+def test_accumulation_matches_large_batch(data, steps, nesterov):
+    x, y, initial_weights = data
+    small = [(x[i:i + 8], y[i:i + 8]) for i in range(0, len(x), 8)]
+    large = [(x[i:i + 8 * steps], y[i:i + 8 * steps])
+             for i in range(0, len(x), 8 * steps)]
+
+    accumulated = train(
+        modellib.AccumulatedSGD(accumulation_steps=steps, lr=0.1, momentum=0.9,
+                                nesterov=nesterov), small, initial_weights)
+    expected = train(keras.optimizers.SGD(lr=0.1, momentum=0.9, nesterov=nesterov),
+                     large, initial_weights)
+
+    for i, weights in enumerate(accumulated):
+        # Weights change on the last batch of each cycle only
+        cycle, position = divmod(i, steps)
+        if position == steps - 1:
+            target = expected[cycle]
+        elif cycle > 0:
+            target = expected[cycle - 1]
+        else:
+            target = initial_weights
+        for w, t in zip(weights, target):
+            np.testing.assert_allclose(w, t, rtol=1e-5, atol=1e-6)
+
+
+def test_dropped_batch_is_not_counted(data):
+    x, y, initial_weights = data
+    bad_y = y[:8].copy()
+    bad_y[0] = np.inf
+    # Cycles of 3 batches with the middle one dropped give the mean of
+    # the other 2, which is SGD on the 16 samples
+    batches = [(x[:8], y[:8]), (x[:8], bad_y), (x[8:16], y[8:16])]
+    accumulated = train(
+        modellib.AccumulatedSGD(accumulation_steps=3, dynamic_loss_scale=True,
+                                lr=0.1, momentum=0.9), batches, initial_weights)
+    expected = train(keras.optimizers.SGD(lr=0.1, momentum=0.9),
+                     [(x[:16], y[:16])], initial_weights)
+    for w, t in zip(accumulated[-1], expected[0]):
+        np.testing.assert_allclose(w, t, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,93 @@
+"""
+Tests of the anchor pruning of build_rpn_targets() and utils.BoxIndex
+against the reference copy of the original code in benchmarks/.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import utils
+import reference_utils
+
+
+BACKBONE_STRIDES = [4, 8, 16, 32, 64]
+
+
+def pyramid_anchors(dtype):
+    shapes = np.array([[1024 // s, 1024 // s] for s in BACKBONE_STRIDES])
+    return utils.generate_pyramid_anchors(
+        (32, 64, 128, 256, 512), [0.5, 1, 2], shapes, BACKBONE_STRIDES, 1).astype(dtype)
+
+
+def random_boxes(rng, count, min_size, max_size):
+    size = rng.randint(min_size, max_size, (count, 2))
+    corner = (rng.rand(count, 2) * (1024 - size)).astype(np.int32)
+    return np.concatenate([corner, corner + size], axis=1).astype(np.int32)
+
+
+@pytest.fixture(scope="module", params=[np.float64, np.float32])
+def anchors(request):
+    anchors = pyramid_anchors(request.param)
+    return anchors, utils.BoxIndex(anchors)
+
+
+@pytest.mark.parametrize("threshold", [0.0, 0.001, 0.1, 0.3, 0.7])
+def test_box_index_finds_all_overlaps(anchors, threshold):
+    anchors, index = anchors
+    rng = np.random.RandomState(0)
+    boxes = np.concatenate([random_boxes(rng, 30, 2, 60),
+                            random_boxes(rng, 30, 8, 1000)])
+    ids = index.query(boxes, threshold)
+    overlaps = utils.compute_overlaps(anchors, boxes)
+    if threshold:
+        expected = np.where(np.any(overlaps >= threshold, axis=1))[0]
+    else:
+        expected = np.where(np.any(overlaps > 0, axis=1))[0]
+    assert np.all(np.isin(expected, ids))
+    assert np.all(np.diff(ids) > 0)
+
+
+def test_box_index_per_box_threshold(anchors):
+    anchors, index = anchors
+    rng = np.random.RandomState(1)
+    boxes = random_boxes(rng, 40, 4, 300)
+    thresholds = rng.rand(40) * 0.8
+    ids = index.query(boxes, thresholds)
+    overlaps = utils.compute_overlaps(anchors, boxes)
+    expected = np.where(np.any(overlaps >= thresholds, axis=1))[0]
+    assert np.all(np.isin(expected, ids))
+
+
+def test_box_index_prunes(anchors):
+    anchors, index = anchors
+    boxes = random_boxes(np.random.RandomState(2), 100, 8, 400)
+    assert index.query(boxes, 0.3).shape[0] < 0.2 * anchors.shape[0]
+
+
+class RPNConfig(object):
+    RPN_TRAIN_ANCHORS_PER_IMAGE = 256
+    RPN_BBOX_STD_DEV = np.array([0.1, 0.1, 0.2, 0.2])
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_build_rpn_targets_matches_reference(anchors, seed):
+    modellib = pytest.importorskip("mrcnn.model")
+    anchors, index = anchors
+    rng = np.random.RandomState(seed)
+    count = [1, 5, 20, 50, 100][seed % 5]
+    # Small boxes have no anchor with IoU >= 0.3 and take the fallback path
+    gt_boxes = random_boxes(rng, count, 2 if seed % 2 else 8, [60, 400, 1000][seed % 3])
+    gt_class_ids = rng.randint(1, 81, count).astype(np.int32)
+    if seed % 4 == 0 and count > 1:
+        # Crowd boxes
+        gt_class_ids[:max(count // 10, 1)] *= -1
+
+    np.random.seed(0)
+    rpn_match, rpn_bbox = modellib.build_rpn_targets(
+        (1024, 1024, 3), anchors, gt_class_ids, gt_boxes, RPNConfig(),
+        anchor_index=index)
+    np.random.seed(0)
+    ref_match, ref_bbox = reference_utils.build_rpn_targets(
+        (1024, 1024, 3), anchors, gt_class_ids, gt_boxes, RPNConfig())
+    np.testing.assert_array_equal(rpn_match, ref_match)
+    np.testing.assert_allclose(rpn_bbox, ref_bbox, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,111 @@
+"""
+Tests of the on-disk sample cache.
+"""
+
+import io
+import struct
+import numpy as np
+import pytest
+
+from mrcnn import utils
+from mrcnn.config import Config
+from mrcnn import sample_cache
+from mrcnn.sample_cache import SampleCache
+
+
+class ShapesDataset(utils.Dataset):
+    """Random images of different sizes with rectangle masks."""
+
+    def __init__(self, count, seed=0):
+        super(ShapesDataset, self).__init__()
+        self.add_class("shapes", 1, "rectangle")
+        rng = np.random.RandomState(seed)
+        for i in range(count):
+            height, width = rng.randint(40, 120, 2)
+            self.add_image("shapes", image_id=i, path=None, height=height,
+                           width=width, seed=rng.randint(1 << 30),
+                           instances=i % 4)
+        self.prepare()
+
+    def load_image(self, image_id):
+        info = self.image_info[image_id]
+        rng = np.random.RandomState(info["seed"])
+        return rng.randint(0, 256, (info["height"], info["width"], 3)).astype(np.uint8)
+
+    def load_mask(self, image_id):
+        info = self.image_info[image_id]
+        rng = np.random.RandomState(info["seed"] + 1)
+        mask = np.zeros([info["height"], info["width"], info["instances"]], dtype=bool)
+        for i in range(info["instances"]):
+            y, x = rng.randint(0, info["height"] - 10), rng.randint(0, info["width"] - 10)
+            mask[y:y + rng.randint(2, 40), x:x + rng.randint(2, 40), i] = True
+        return mask, np.ones([info["instances"]], dtype=np.int32)
+
+
+class CacheConfig(Config):
+    NAME = "cache_test"
+    IMAGE_MIN_DIM = 64
+    IMAGE_MAX_DIM = 128
+    MINI_MASK_SHAPE = (14, 14)
+
+
+@pytest.mark.parametrize("mode", ["square", "pad64"])
+def test_cached_samples_match_preprocessing(tmpdir, mode):
+    config = CacheConfig()
+    config.IMAGE_RESIZE_MODE = mode
+    dataset = ShapesDataset(11)
+    cache = SampleCache.open_or_build(dataset, config, str(tmpdir), shard_size=4,
+                                      verbose=0)
+    assert len(cache) == 11
+    for image_id in dataset.image_ids:
+        image = dataset.load_image(image_id)
+        masks, class_ids = dataset.load_compact_mask(image_id)
+        image, window, scale, padding, crop = utils.resize_training_image(image, config)
+        masks = masks.resize(scale, padding, crop)
+        sample = cache.load(image_id)
+        np.testing.assert_array_equal(sample["image"], image)
+        assert sample["window"] == tuple(window)
+        np.testing.assert_array_equal(sample["masks"].to_dense(), masks.to_dense())
+        np.testing.assert_array_equal(sample["bbox"], masks.extract_bboxes())
+        np.testing.assert_array_equal(
+            sample["mini_masks"],
+            masks.minimize(masks.extract_bboxes(), config.MINI_MASK_SHAPE))
+
+
+@pytest.mark.parametrize("expected_appends", [1, 3, 100])
+def test_shard_array_grows_and_trims(tmpdir, expected_appends):
+    filename = str(tmpdir.join("array.npy"))
+    array = sample_cache._ShardArray(filename, np.int32, (2,), expected_appends)
+    rows = [np.arange(2 * n, dtype=np.int32).reshape([n, 2]) + n for n in [3, 0, 7, 1, 40]]
+    for r in rows:
+        array.append(r)
+    array.close()
+    np.testing.assert_array_equal(np.load(filename), np.concatenate(rows))
+
+
+def test_shard_array_header_size_change(tmpdir, monkeypatch):
+    # A header that changes size moves the data, which is then copied
+    write_header = np.lib.format.write_array_header_1_0
+
+    def padded_header(fp, d):
+        buffer = io.BytesIO()
+        write_header(buffer, d)
+        header = buffer.getvalue()
+        body = header[10:-1] + b" " * 64 + b"\n"
+        fp.write(header[:8] + struct.pack("<H", len(body)) + body)
+
+    monkeypatch.setattr(np.lib.format, "write_array_header_1_0", padded_header)
+    filename = str(tmpdir.join("array.npy"))
+    array = sample_cache._ShardArray(filename, np.int64, (3,))
+    values = np.arange(3 * 500, dtype=np.int64).reshape([-1, 3])
+    for start in range(0, 500, 7):
+        array.append(values[start:start + 7])
+    array.close()
+    np.testing.assert_array_equal(np.load(filename), values)
+
+
+def test_shard_array_empty(tmpdir):
+    filename = str(tmpdir.join("array.npy"))
+    array = sample_cache._ShardArray(filename, bool, (14, 14), 10)
+    array.close()
+    assert np.load(filename).shape == (0, 14, 14)
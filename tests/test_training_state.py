@@ -0,0 +1,129 @@
+"""
+Tests of mrcnn/training_state.py: save/load round trips, random states,
+find_last() and the TrainingStateCheckpoint callback.
+"""
+
+import os
+import random
+import numpy as np
+import pytest
+
+keras = pytest.importorskip("keras")
+from mrcnn import training_state
+
+
+class FixedOptimizer(object):
+    """Stands for a compiled optimizer: get_weights() is all save() uses."""
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def get_weights(self):
+        return self.weights
+
+
+def small_model(seed):
+    np.random.seed(seed)
+    inputs = keras.layers.Input(shape=(4,))
+    x = keras.layers.Dense(8, name="hidden")(inputs)
+    x = keras.layers.Dropout(0.5, name="dropout")(x)
+    outputs = keras.layers.Dense(2, name="output")(x)
+    model = keras.models.Model(inputs, outputs)
+    for layer in model.layers:
+        layer.set_weights([np.random.randn(*w.shape).astype(np.float32)
+                           for w in layer.get_weights()])
+    return model
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join(training_state.STATE_FILENAME))
+    model = small_model(0)
+    optimizer_weights = [np.int64(120), np.random.randn(4, 8).astype(np.float32)]
+    state = {"epoch": 3, "step": 40, "layers": "heads",
+             "loader_position": [3, 80], "seed": 7}
+    training_state.save(path, model, FixedOptimizer(optimizer_weights), state)
+
+    saved = training_state.load(path)
+    # Layers without weights aren't stored
+    assert sorted(saved["weights"]) == ["hidden", "output"]
+    for name, weights in saved["weights"].items():
+        for w, expected in zip(weights, model.get_layer(name).get_weights()):
+            np.testing.assert_array_equal(w, expected)
+    assert len(saved["optimizer"]) == 2
+    for w, expected in zip(saved["optimizer"], optimizer_weights):
+        np.testing.assert_array_equal(w, expected)
+    for key, value in state.items():
+        assert saved["state"][key] == value
+
+    # The weights set on another model make it the same model
+    other = small_model(1)
+    for name, weights in saved["weights"].items():
+        other.get_layer(name).set_weights(weights)
+    x = np.random.randn(3, 4).astype(np.float32)
+    np.testing.assert_array_equal(other.predict(x, verbose=0), model.predict(x, verbose=0))
+
+
+def test_random_state_is_restored(tmpdir):
+    path = str(tmpdir.join(training_state.STATE_FILENAME))
+    np.random.seed(5)
+    random.seed(5)
+    np.random.randn()  # Leaves a cached gaussian
+    training_state.save(path, small_model(0), None, {"epoch": 0, "step": 0})
+    # small_model() reseeds NumPy, so draw after saving
+    expected = (np.random.randn(10), [random.random() for _ in range(10)])
+
+    np.random.seed(9)
+    random.seed(9)
+    saved = training_state.load(path)
+    assert saved["optimizer"] == []
+    training_state.restore_random_state(saved["state"])
+    np.testing.assert_array_equal(np.random.randn(10), expected[0])
+    assert [random.random() for _ in range(10)] == expected[1]
+
+
+def test_save_replaces_previous_file(tmpdir):
+    path = str(tmpdir.join(training_state.STATE_FILENAME))
+    model = small_model(0)
+    training_state.save(path, model, None, {"epoch": 1, "step": 0})
+    training_state.save(path, model, None, {"epoch": 2, "step": 0})
+    assert os.listdir(str(tmpdir)) == [training_state.STATE_FILENAME]
+    assert training_state.load(path)["state"]["epoch"] == 2
+
+
+def test_find_last(tmpdir):
+    model_dir = str(tmpdir)
+    assert training_state.find_last(os.path.join(model_dir, "missing"), "coco") is None
+    for name in ["coco20240101T0000", "coco20240102T0000", "coco20240103T0000",
+                 "shapes20240104T0000"]:
+        os.makedirs(os.path.join(model_dir, name))
+    assert training_state.find_last(model_dir, "COCO") is None
+
+    for name in ["coco20240101T0000", "coco20240102T0000", "shapes20240104T0000"]:
+        open(os.path.join(model_dir, name, training_state.STATE_FILENAME), "w").close()
+    # The last directory that has a state file, of that config name
+    assert training_state.find_last(model_dir, "COCO") == os.path.join(
+        model_dir, "coco20240102T0000", training_state.STATE_FILENAME)
+
+
+def test_checkpoint_steps():
+    saved = []
+    callback = training_state.TrainingStateCheckpoint(
+        lambda epoch, step: saved.append((epoch, step)), steps=4, step_offset=6)
+    # Resumed at step 6 of epoch 2, epochs of 10 steps
+    for epoch in [2, 3]:
+        callback.on_epoch_begin(epoch)
+        for batch in range(4 if epoch == 2 else 10):
+            callback.on_batch_end(batch)
+        callback.on_epoch_end(epoch)
+    assert saved == [(2, 8), (3, 0), (3, 4), (3, 8), (4, 0)]
+
+
+def test_checkpoint_epochs_only():
+    saved = []
+    callback = training_state.TrainingStateCheckpoint(
+        lambda epoch, step: saved.append((epoch, step)))
+    callback.on_epoch_begin(0)
+    for batch in range(10):
+        callback.on_batch_end(batch)
+    callback.on_epoch_end(0)
+    assert saved == [(1, 0)]
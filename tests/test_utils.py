@@ -0,0 +1,89 @@
+"""
+Tests of the NumPy functions of mrcnn/utils.py against the reference copy
+of the original code in benchmarks/.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import utils
+import reference_utils
+
+
+def random_boxes(rng, count, image_size=1024, min_size=2, max_size=400):
+    size = rng.randint(min_size, max_size, (count, 2))
+    corner = (rng.rand(count, 2) * (image_size - size)).astype(np.int32)
+    return np.concatenate([corner, corner + size], axis=1).astype(np.int32)
+
+
+@pytest.mark.parametrize("dtypes", [(np.int32, np.int32), (np.float32, np.float32),
+                                    (np.float32, np.int32), (np.float64, np.float32)])
+@pytest.mark.parametrize("chunk_size", [1, 1000, 2 ** 16])
+def test_compute_overlaps_matches_reference(dtypes, chunk_size):
+    rng = np.random.RandomState(0)
+    boxes1 = random_boxes(rng, 500).astype(dtypes[0])
+    boxes2 = random_boxes(rng, 40).astype(dtypes[1])
+    overlaps = utils.compute_overlaps(boxes1, boxes2, chunk_size=chunk_size)
+    np.testing.assert_array_equal(overlaps,
+                                  reference_utils.compute_overlaps(boxes1, boxes2))
+
+
+def test_compute_overlaps_empty():
+    boxes = random_boxes(np.random.RandomState(1), 5)
+    assert utils.compute_overlaps(boxes, boxes[:0]).shape == (5, 0)
+    assert utils.compute_overlaps(boxes[:0], boxes).shape == (0, 5)
+
+
+def pyramid_anchors():
+    shapes = np.array([[256 // s, 256 // s] for s in (4, 8, 16, 32, 64)])
+    return utils.generate_pyramid_anchors(
+        (32, 64, 128, 256, 512), [0.5, 1, 2], shapes, (4, 8, 16, 32, 64), 1)
+
+
+@pytest.mark.parametrize("threshold", [0.0, 0.001, 0.3, 0.7, "per_box"])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_compute_overlaps_sparse(threshold, dtype):
+    rng = np.random.RandomState(2)
+    anchors = pyramid_anchors().astype(dtype)
+    boxes = random_boxes(rng, 30, image_size=256, max_size=200)
+    if threshold == "per_box":
+        threshold = rng.rand(boxes.shape[0]) * 0.5
+    sparse = utils.compute_overlaps_sparse(anchors, boxes, threshold)
+    assert sparse.shape == (anchors.shape[0], boxes.shape[0])
+    assert sparse.has_sorted_indices
+
+    # Same values as the dense kernel for the pairs above the threshold
+    dense = utils.compute_overlaps(anchors, boxes)
+    expected = np.where((dense >= threshold) & (dense > 0), dense, 0)
+    np.testing.assert_array_equal(sparse.toarray(), expected)
+    assert sparse.nnz == np.count_nonzero(expected)
+
+    # Same result with a prebuilt index
+    indexed = utils.compute_overlaps_sparse(anchors, boxes, threshold,
+                                            index=utils.BoxIndex(anchors))
+    np.testing.assert_array_equal(indexed.toarray(), expected)
+
+
+def test_compute_overlaps_sparse_empty():
+    anchors = pyramid_anchors()
+    sparse = utils.compute_overlaps_sparse(anchors, np.zeros([0, 4], np.int32))
+    assert sparse.shape == (anchors.shape[0], 0) and sparse.nnz == 0
+    # Boxes that no anchor overlaps
+    far = np.array([[1000, 1000, 1010, 1010]], np.int32)
+    assert utils.compute_overlaps_sparse(anchors, far).nnz == 0
+
+
+def test_sparse_row_max_and_argmax_rows():
+    rng = np.random.RandomState(3)
+    anchors = pyramid_anchors()
+    boxes = random_boxes(rng, 20, image_size=256, max_size=200)
+    sparse = utils.compute_overlaps_sparse(anchors, boxes, 0.2)
+    dense = sparse.toarray()
+
+    row_max, row_argmax = utils.sparse_row_max(sparse)
+    np.testing.assert_array_equal(row_max, dense.max(axis=1))
+    np.testing.assert_array_equal(row_argmax, dense.argmax(axis=1))
+
+    column_max = dense.max(axis=0)
+    expected = np.where(np.any((dense == column_max) & (dense > 0), axis=1))[0]
+    np.testing.assert_array_equal(utils.sparse_argmax_rows(sparse, column_max), expected)
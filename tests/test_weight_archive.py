@@ -0,0 +1,133 @@
+"""
+Tests of mrcnn/weight_archive.py: the file format, the .h5 conversion, and
+MaskRCNN.load_weights() from archives against loading the .h5 file.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import weight_archive
+
+
+def random_layers(rng):
+    return [("conv1", [("conv1/kernel:0", rng.randn(3, 3, 3, 8).astype(np.float32)),
+                       ("conv1/bias:0", rng.randn(8).astype(np.float32))]),
+            ("pool", []),
+            ("bn", [("bn/gamma:0", rng.randn(8).astype(np.float16)),
+                    ("bn/count:0", rng.randint(0, 100, (1,)).astype(np.int64))]),
+            ("fc", [("fc/kernel:0", rng.randn(5, 7).astype(np.float64))])]
+
+
+def test_write_read_round_trip(tmpdir):
+    path = str(tmpdir.join("weights.mrw"))
+    layers = random_layers(np.random.RandomState(0))
+    weight_archive.write(path, layers)
+
+    assert weight_archive.is_archive(path)
+    archive = weight_archive.WeightArchive(path)
+    assert archive.layer_names == [name for name, _ in layers]
+    for entry, (name, weights) in zip(archive.layers, layers):
+        arrays = archive.weights(entry)
+        assert [w["name"] for w in entry["weights"]] == [n for n, _ in weights]
+        for array, w, (_, expected) in zip(arrays, entry["weights"], weights):
+            assert array.dtype == expected.dtype
+            np.testing.assert_array_equal(array, expected)
+            # Views of the file, aligned and read-only
+            assert (archive.data_start + w["offset"]) % weight_archive.ALIGNMENT == 0
+            assert not array.flags.writeable
+
+
+def test_is_archive(tmpdir):
+    other = tmpdir.join("weights.h5")
+    other.write_binary(b"\x89HDF\r\n\x1a\n" + b"\0" * 64)
+    assert not weight_archive.is_archive(str(other))
+    assert not weight_archive.is_archive(str(tmpdir.join("missing.mrw")))
+
+
+@pytest.mark.parametrize("nested", [False, True])
+def test_convert_h5(tmpdir, nested):
+    h5py = pytest.importorskip("h5py")
+    h5_path = str(tmpdir.join("weights.h5"))
+    path = str(tmpdir.join("weights.mrw"))
+    layers = random_layers(np.random.RandomState(1))
+    # The layout of Keras' save_weights(), or of save() with nested=True
+    with h5py.File(h5_path, "w") as f:
+        group = f.create_group("model_weights") if nested else f
+        group.attrs["layer_names"] = [name.encode("utf8") for name, _ in layers]
+        for name, weights in layers:
+            layer = group.create_group(name)
+            layer.attrs["weight_names"] = [n.encode("utf8") for n, _ in weights]
+            for weight_name, value in weights:
+                layer.create_dataset(weight_name, data=value)
+    weight_archive.convert_h5(h5_path, path)
+
+    archive = weight_archive.WeightArchive(path)
+    assert archive.layer_names == [name for name, _ in layers]
+    for entry, (_, weights) in zip(archive.layers, layers):
+        for array, (_, expected) in zip(archive.weights(entry), weights):
+            assert array.dtype == expected.dtype
+            np.testing.assert_array_equal(array, expected)
+
+
+class TestLoadWeights(object):
+    """MaskRCNN.load_weights() from an archive against the .h5 file."""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.modellib = pytest.importorskip("mrcnn.model")
+        self.h5_path = str(tmpdir.join("weights.h5"))
+        self.path = str(tmpdir.join("weights.mrw"))
+        self.build(seed=0).keras_model.save_weights(self.h5_path)
+        weight_archive.convert_h5(self.h5_path, self.path)
+
+    def build(self, seed, order=("a", "b", "c")):
+        """A MaskRCNN wrapping a small Keras model with random weights."""
+        keras = self.modellib.keras
+        rng = np.random.RandomState(seed)
+        inputs = keras.layers.Input(shape=(4,))
+        x = inputs
+        for name in order:
+            x = keras.layers.Dense(4, name=name)(x)
+            if name == "b":
+                x = keras.layers.BatchNormalization(name="bn")(x)
+        keras_model = keras.models.Model(inputs, x)
+        keras_model.set_weights([rng.randn(*w.shape).astype(np.float32)
+                                 for w in keras_model.get_weights()])
+        model = self.modellib.MaskRCNN.__new__(self.modellib.MaskRCNN)
+        model.keras_model = keras_model
+        # Not testing the log directory
+        model.set_log_dir = lambda model_path=None: None
+        return model
+
+    def assert_same(self, a, b):
+        for wa, wb in zip(a.keras_model.get_weights(), b.keras_model.get_weights()):
+            np.testing.assert_array_equal(wa, wb)
+
+    @pytest.mark.parametrize("by_name,exclude,workers", [
+        (False, None, 0), (True, None, 0), (True, ["b", "bn"], 0), (False, ["c"], 2)])
+    def test_same_as_h5(self, by_name, exclude, workers):
+        from_h5 = self.build(seed=1)
+        from_h5.load_weights(self.h5_path, by_name=by_name, exclude=exclude)
+        from_archive = self.build(seed=1)
+        from_archive.load_weights(self.path, by_name=by_name, exclude=exclude,
+                                  workers=workers)
+        self.assert_same(from_h5, from_archive)
+        if exclude:
+            # Excluded layers keep their weights
+            untouched = self.build(seed=1)
+            for name in exclude:
+                for w, expected in zip(from_archive.keras_model.get_layer(name).get_weights(),
+                                       untouched.keras_model.get_layer(name).get_weights()):
+                    np.testing.assert_array_equal(w, expected)
+
+    def test_by_name_with_other_layer_order(self):
+        # By name, the order of the layers in the model doesn't matter
+        from_h5 = self.build(seed=1, order=("c", "a", "b"))
+        from_h5.load_weights(self.h5_path, by_name=True)
+        from_archive = self.build(seed=1, order=("c", "a", "b"))
+        from_archive.load_weights(self.path, by_name=True)
+        self.assert_same(from_h5, from_archive)
+
+    def test_layer_count_mismatch(self):
+        with pytest.raises(ValueError):
+            self.build(seed=1, order=("a", "b")).load_weights(self.path)